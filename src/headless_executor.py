@@ -0,0 +1,60 @@
+import argparse
+import os
+import sys
+from multiprocessing import freeze_support
+
+import numpy as np
+
+from mlib.core.logger import LoggingMode, MLogger
+
+# 指数表記なし、有効小数点桁数6、30を超えると省略あり、一行の文字数200
+np.set_printoptions(suppress=True, precision=6, threshold=30, linewidth=200)
+
+if __name__ == "__main__":
+    try:
+        # Windowsマルチプロセス対策
+        freeze_support()
+    except:
+        pass
+
+    # 引数の取得
+    parser = argparse.ArgumentParser()
+    parser.add_argument("--model", required=True, type=str)
+    parser.add_argument("--motion", required=True, nargs="+", type=str)
+    parser.add_argument("--config", required=True, type=str)
+    parser.add_argument("--summary", default="", type=str)
+    parser.add_argument("--max_workers", default=0, type=int)
+    parser.add_argument("--verbose", default=20, type=int)
+    parser.add_argument("--log_mode", default=0, type=int)
+    parser.add_argument("--out_log", default=0, type=int)
+    parser.add_argument("--lang", default="ja", type=str)
+
+    args = parser.parse_args()
+
+    # ロガーの初期化
+    MLogger.initialize(
+        args.lang, os.path.dirname(os.path.abspath(__file__)), LoggingMode(args.log_mode), level=args.verbose, is_out_log=args.out_log
+    )
+
+    # 画面(wx/OpenGL)を使わずに表情生成を行う
+    from service.usecase.headless_usecase import HeadlessConfig, HeadlessLoggerConfig, HeadlessUsecase
+
+    # 並列処理用のプロセスでも同じ設定でロガーを初期化する
+    logger_config = HeadlessLoggerConfig(args.lang, os.path.dirname(os.path.abspath(__file__)), args.log_mode, args.verbose, args.out_log)
+
+    usecase = HeadlessUsecase()
+    config = HeadlessConfig.read(args.config)
+
+    # モデルは一度だけ読み込んで、全モーションで使い回す
+    model = usecase.read_model(args.model)
+
+    results = usecase.execute_batch(
+        model,
+        args.motion,
+        config,
+        args.summary or usecase.create_summary_path(args.motion, config),
+        args.max_workers or None,
+        logger_config,
+    )
+
+    sys.exit(0 if all(result.is_success for result in results) else 1)
@@ -48,6 +48,13 @@ class MainFrame(BaseFrame):
         MLogger.console_handler = ConsoleHandler(self.file_panel.console_ctrl.text_ctrl)
         MLogger.console_handler2 = ConsoleHandler(self.config_panel.console_ctrl.text_ctrl)
 
+        self.Bind(wx.EVT_CLOSE, self.on_close_workers)
+
+    def on_close_workers(self, event: wx.Event) -> None:
+        # 使い回している読み込み用のプロセスを終了する(画面を閉じる処理自体は続けて行う)
+        self.load_worker.shutdown()
+        event.Skip()
+
     def on_change_tab(self, event: wx.Event) -> None:
         self.selected_tab_idx = self.notebook.GetSelection()
 
@@ -14,6 +14,8 @@ from service.form.widgets.blink_ctrl_set import BlinkCtrlSet
 from service.form.widgets.morph_ctrl_set import MorphCtrlSet
 from service.worker.config.blink_worker import BlinkWorker
 from service.worker.config.gaze_worker import GazeWorker
+from service.worker.config.prefetch_worker import PrefetchWorker
+from service.worker.config.preview_worker import PreviewWorker
 from service.worker.config.repair_morph_worker import RepairMorphWorker
 
 logger = MLogger(os.path.basename(__file__))
@@ -26,6 +28,8 @@ class ConfigPanel(CanvasPanel):
         self.gaze_worker = GazeWorker(self.frame, self.on_config_result)
         self.blink_worker = BlinkWorker(self.frame, self.on_config_result)
         self.repair_worker = RepairMorphWorker(self.frame, self.on_config_result)
+        self.preview_worker = PreviewWorker(self.frame, self.on_preview_result)
+        self.prefetch_worker = PrefetchWorker()
         self.bone_matrixes = VmdBoneFrameTrees()
         self.show_config = True
 
@@ -120,6 +124,13 @@ class ConfigPanel(CanvasPanel):
         self.play_ctrl.Bind(wx.EVT_BUTTON, self.on_play)
         self.play_sizer.Add(self.play_ctrl, 0, wx.ALL, 3)
 
+        self.live_preview_ctrl = wx.CheckBox(self.config_scrolled_window, wx.ID_ANY, __("ライブプレビュー"))
+        self.live_preview_ctrl.SetToolTip(
+            __("目線・まばたきの設定を変更すると、自動で生成し直してビューワーに表示します\n出力するには各生成ボタンを押してください")
+        )
+        self.live_preview_ctrl.Bind(wx.EVT_CHECKBOX, self.on_change_live_preview)
+        self.play_sizer.Add(self.live_preview_ctrl, 0, wx.ALL, 3)
+
         self.config_window_sizer.Add(self.play_sizer, 0, wx.ALL, 3)
 
         # --------------
@@ -142,7 +153,13 @@ class ConfigPanel(CanvasPanel):
         self.gaze_sizer.Add(self.gaze_infection_title_ctrl, 0, wx.ALL, 3)
 
         self.gaze_infection_ctrl = WheelSpinCtrlDouble(
-            self.config_scrolled_window, initial=0.5, min=0.1, max=1.0, inc=0.01, size=wx.Size(60, -1)
+            self.config_scrolled_window,
+            initial=0.5,
+            min=0.1,
+            max=1.0,
+            inc=0.01,
+            size=wx.Size(60, -1),
+            change_event=self.on_change_gaze_config,
         )
         self.gaze_infection_ctrl.SetToolTip(gaze_infection_tooltip)
         self.gaze_sizer.Add(self.gaze_infection_ctrl, 0, wx.ALL, 3)
@@ -157,7 +174,13 @@ class ConfigPanel(CanvasPanel):
         self.gaze_sizer.Add(self.gaze_ratio_x_title_ctrl, 0, wx.ALL, 3)
 
         self.gaze_ratio_x_ctrl = WheelSpinCtrlDouble(
-            self.config_scrolled_window, initial=0.7, min=0.5, max=1.5, inc=0.01, size=wx.Size(60, -1)
+            self.config_scrolled_window,
+            initial=0.7,
+            min=0.5,
+            max=1.5,
+            inc=0.01,
+            size=wx.Size(60, -1),
+            change_event=self.on_change_gaze_config,
         )
         self.gaze_ratio_x_ctrl.SetToolTip(gaze_ratio_x_tooltip)
         self.gaze_sizer.Add(self.gaze_ratio_x_ctrl, 0, wx.ALL, 3)
@@ -171,7 +194,9 @@ class ConfigPanel(CanvasPanel):
         self.gaze_limit_upper_x_title_ctrl.SetToolTip(gaze_limit_upper_x_tooltip)
         self.gaze_sizer.Add(self.gaze_limit_upper_x_title_ctrl, 0, wx.ALL, 3)
 
-        self.gaze_limit_upper_x_ctrl = WheelSpinCtrl(self.config_scrolled_window, initial=3, min=0, max=45, size=wx.Size(60, -1))
+        self.gaze_limit_upper_x_ctrl = WheelSpinCtrl(
+            self.config_scrolled_window, initial=3, min=0, max=45, size=wx.Size(60, -1), change_event=self.on_change_gaze_config
+        )
         self.gaze_limit_upper_x_ctrl.SetToolTip(gaze_limit_upper_x_tooltip)
         self.gaze_sizer.Add(self.gaze_limit_upper_x_ctrl, 0, wx.ALL, 3)
 
@@ -184,7 +209,9 @@ class ConfigPanel(CanvasPanel):
         self.gaze_limit_lower_x_title_ctrl.SetToolTip(gaze_limit_lower_x_tooltip)
         self.gaze_sizer.Add(self.gaze_limit_lower_x_title_ctrl, 0, wx.ALL, 3)
 
-        self.gaze_limit_lower_x_ctrl = WheelSpinCtrl(self.config_scrolled_window, initial=-8, min=-45, max=0, size=wx.Size(60, -1))
+        self.gaze_limit_lower_x_ctrl = WheelSpinCtrl(
+            self.config_scrolled_window, initial=-8, min=-45, max=0, size=wx.Size(60, -1), change_event=self.on_change_gaze_config
+        )
         self.gaze_limit_lower_x_ctrl.SetToolTip(gaze_limit_lower_x_tooltip)
         self.gaze_sizer.Add(self.gaze_limit_lower_x_ctrl, 0, wx.ALL, 3)
 
@@ -198,7 +225,13 @@ class ConfigPanel(CanvasPanel):
         self.gaze_sizer.Add(self.gaze_ratio_y_title_ctrl, 0, wx.ALL, 3)
 
         self.gaze_ratio_y_ctrl = WheelSpinCtrlDouble(
-            self.config_scrolled_window, initial=0.7, min=0.5, max=1.5, inc=0.01, size=wx.Size(60, -1)
+            self.config_scrolled_window,
+            initial=0.7,
+            min=0.5,
+            max=1.5,
+            inc=0.01,
+            size=wx.Size(60, -1),
+            change_event=self.on_change_gaze_config,
         )
         self.gaze_ratio_y_ctrl.SetToolTip(gaze_ratio_y_tooltip)
         self.gaze_sizer.Add(self.gaze_ratio_y_ctrl, 0, wx.ALL, 3)
@@ -212,7 +245,9 @@ class ConfigPanel(CanvasPanel):
         self.gaze_limit_upper_y_title_ctrl.SetToolTip(gaze_limit_upper_y_tooltip)
         self.gaze_sizer.Add(self.gaze_limit_upper_y_title_ctrl, 0, wx.ALL, 3)
 
-        self.gaze_limit_upper_y_ctrl = WheelSpinCtrl(self.config_scrolled_window, initial=13, min=0, max=45, size=wx.Size(60, -1))
+        self.gaze_limit_upper_y_ctrl = WheelSpinCtrl(
+            self.config_scrolled_window, initial=13, min=0, max=45, size=wx.Size(60, -1), change_event=self.on_change_gaze_config
+        )
         self.gaze_limit_upper_y_ctrl.SetToolTip(gaze_limit_upper_y_tooltip)
         self.gaze_sizer.Add(self.gaze_limit_upper_y_ctrl, 0, wx.ALL, 3)
 
@@ -225,7 +260,9 @@ class ConfigPanel(CanvasPanel):
         self.gaze_limit_lower_y_title_ctrl.SetToolTip(gaze_limit_lower_y_tooltip)
         self.gaze_sizer.Add(self.gaze_limit_lower_y_title_ctrl, 0, wx.ALL, 3)
 
-        self.gaze_limit_lower_y_ctrl = WheelSpinCtrl(self.config_scrolled_window, initial=-13, min=-45, max=0, size=wx.Size(60, -1))
+        self.gaze_limit_lower_y_ctrl = WheelSpinCtrl(
+            self.config_scrolled_window, initial=-13, min=-45, max=0, size=wx.Size(60, -1), change_event=self.on_change_gaze_config
+        )
         self.gaze_limit_lower_y_ctrl.SetToolTip(gaze_limit_lower_y_tooltip)
         self.gaze_sizer.Add(self.gaze_limit_lower_y_ctrl, 0, wx.ALL, 3)
 
@@ -238,7 +275,9 @@ class ConfigPanel(CanvasPanel):
         self.gaze_reset_title_ctrl.SetToolTip(gaze_reset_tooltip)
         self.gaze_sizer.Add(self.gaze_reset_title_ctrl, 0, wx.ALL, 3)
 
-        self.gaze_reset_ctrl = WheelSpinCtrl(self.config_scrolled_window, initial=7, min=5, max=15, size=wx.Size(60, -1))
+        self.gaze_reset_ctrl = WheelSpinCtrl(
+            self.config_scrolled_window, initial=7, min=5, max=15, size=wx.Size(60, -1), change_event=self.on_change_gaze_config
+        )
         self.gaze_reset_ctrl.SetToolTip(gaze_reset_tooltip)
         self.gaze_sizer.Add(self.gaze_reset_ctrl, 0, wx.ALL, 3)
 
@@ -356,6 +395,10 @@ class ConfigPanel(CanvasPanel):
     def stop_play(self) -> None:
         self.play_ctrl.SetLabelText(__("再生"))
         self.Enable(True)
+        # 停止した位置の前後を先読みする
+        if self.canvas.model_sets:
+            model_set = self.canvas.model_sets[0]
+            self.prefetch_worker.request(model_set.model, model_set.motion, self.fno)
 
     def start_play(self) -> None:
         self.play_ctrl.SetLabelText(__("停止"))
@@ -369,6 +412,7 @@ class ConfigPanel(CanvasPanel):
     def Enable(self, enable: bool):
         self.frame_slider.Enable(enable)
         self.play_ctrl.Enable(enable)
+        self.live_preview_ctrl.Enable(enable)
 
         self.create_gaze_btn_ctrl.Enable(enable)
         self.gaze_infection_ctrl.Enable(enable)
@@ -389,20 +433,74 @@ class ConfigPanel(CanvasPanel):
 
     def on_frame_change(self, event: wx.Event):
         self.Enable(False)
-        self.canvas.change_motion(event, True, 0)
+        self.change_frame(event)
         self.Enable(True)
 
+    def change_frame(self, event: wx.Event) -> None:
+        """先読み済みの変形結果があればそれを表示し、なければその場で変形する"""
+        if not self.canvas.model_sets or self.canvas.playing:
+            self.canvas.change_motion(event, True, 0)
+            return
+
+        model_set = self.canvas.model_sets[0]
+        animation = self.prefetch_worker.get(model_set.model, model_set.motion, self.fno)
+        if animation:
+            # ボーンウェイト表示などの表示状態は、今表示している変形結果から引き継ぐ
+            if self.canvas.animations:
+                animation.is_show_bone_weight = self.canvas.animations[0].is_show_bone_weight
+            self.canvas.animations[0] = animation
+            self.canvas.Refresh()
+        else:
+            self.canvas.change_motion(event, True, 0)
+            if self.canvas.animations:
+                self.prefetch_worker.put(model_set.model, model_set.motion, self.fno, self.canvas.animations[0])
+
+        self.prefetch_worker.request(model_set.model, model_set.motion, self.fno)
+
     def on_create_gaze(self, event: wx.Event) -> None:
+        # プレビュー生成が止まってから生成を始める(モデルやキャッシュを同時に使わない)
         self.Enable(False)
-        self.gaze_worker.start()
+        # 表示中のモーションを書き換えるので、先読みも止める
+        self.prefetch_worker.stop()
+        self.preview_worker.cancel(self.gaze_worker.start)
 
     def on_create_blink(self, event: wx.Event) -> None:
+        # プレビュー生成が止まってから生成を始める(モデルやキャッシュを同時に使わない)
         self.Enable(False)
-        self.blink_worker.start()
+        # 表示中のモーションを書き換えるので、先読みも止める
+        self.prefetch_worker.stop()
+        self.preview_worker.cancel(self.blink_worker.start)
 
     def on_repair_morph(self, event: wx.Event) -> None:
+        # プレビュー生成が止まってから生成を始める(モデルやキャッシュを同時に使わない)
         self.Enable(False)
-        self.repair_worker.start()
+        # 表示中のモーションを書き換えるので、先読みも止める
+        self.prefetch_worker.stop()
+        self.preview_worker.cancel(self.repair_worker.start)
+
+    def on_change_gaze_config(self, event: wx.Event) -> None:
+        if self.live_preview_ctrl.GetValue():
+            self.preview_worker.schedule(is_gaze=True)
+
+    def on_change_blink_config(self, event: wx.Event) -> None:
+        if self.live_preview_ctrl.GetValue():
+            self.preview_worker.schedule(is_blink=True)
+
+    def on_change_live_preview(self, event: wx.Event) -> None:
+        if self.live_preview_ctrl.GetValue():
+            return
+
+        # プレビューをやめたら、生成済みのモーションの表示に戻す
+        self.preview_worker.cancel()
+        if self.frame.file_panel.motion_ctrl.data:
+            self.canvas.model_sets[0].motion = self.frame.file_panel.motion_ctrl.data
+            self.on_frame_change(wx.EVT_BUTTON)
+
+    def on_preview_result(self, motion: VmdMotion) -> None:
+        if not self.live_preview_ctrl.GetValue():
+            return
+        self.canvas.model_sets[0].motion = motion
+        self.on_frame_change(wx.EVT_BUTTON)
 
     def on_config_result(self, result: bool, data: tuple[VmdMotion, VmdMotion], elapsed_time: str):
         self.console_ctrl.write(f"\n----------------\n{elapsed_time}")
@@ -412,6 +510,8 @@ class ConfigPanel(CanvasPanel):
         self.frame.file_panel.motion_ctrl.data = motion
         self.canvas.model_sets[0].motion = motion
         self.frame.file_panel.output_motion_ctrl.data = output_motion
+        # モーションの中身が変わったので先読みし直す
+        self.prefetch_worker.clear()
         # 関連ボーン・モーフのキーがある箇所に飛ぶ
         key_fnos = [fno for bone_name in ("両目", "左目", "右目") for fno in output_motion.bones[bone_name].indexes] + [
             fno for bone_name in ("まばたき", "あ", "い", "う", "え", "お") for fno in output_motion.bones[bone_name].indexes
@@ -10,6 +10,9 @@ from mlib.service.form.widgets.console_ctrl import ConsoleCtrl
 from mlib.service.form.widgets.exec_btn_ctrl import ExecButton
 from mlib.service.form.widgets.file_ctrl import MPmxFilePickerCtrl, MVmdFilePickerCtrl
 from mlib.utils.file_utils import separate_path
+from service.usecase.analysis_cache import AnalysisCache
+from service.usecase.bone_matrix_cache import DEFAULT_WINDOW_SIZE, BoneMatrixCache
+from service.usecase.stage_cache import StageCache
 
 logger = MLogger(os.path.basename(__file__))
 __ = logger.get_text
@@ -19,6 +22,13 @@ class FilePanel(BasePanel):
     def __init__(self, frame: BaseFrame, tab_idx: int, *args, **kw) -> None:
         super().__init__(frame, tab_idx, *args, **kw)
 
+        # 目線生成・まばたき生成で共有するボーン行列(長尺モーションでも変形結果を丸ごと保持しないよう時間窓毎に変形する)
+        self.bone_matrix_cache = BoneMatrixCache(DEFAULT_WINDOW_SIZE)
+        # 目線生成・まばたき生成の処理段階毎の結果
+        self.stage_cache = StageCache()
+        # 目線生成・まばたき生成の変動量のディスクキャッシュ(起動し直しても同じモーションなら使い回す)
+        self.analysis_cache = AnalysisCache()
+
         self._initialize_ui()
 
     def _initialize_ui(self) -> None:
@@ -82,6 +92,8 @@ class FilePanel(BasePanel):
 
     def on_change_model_pmx(self, event: wx.Event) -> None:
         self.model_ctrl.unwrap()
+        self.bone_matrix_cache.clear()
+        self.stage_cache.clear()
         if self.model_ctrl.read_name():
             self.model_ctrl.read_digest()
             self.create_output_path()
@@ -89,6 +101,8 @@ class FilePanel(BasePanel):
 
     def on_change_motion(self, event: wx.Event) -> None:
         self.motion_ctrl.unwrap()
+        self.bone_matrix_cache.clear()
+        self.stage_cache.clear()
         if self.motion_ctrl.read_name():
             self.motion_ctrl.read_digest()
             self.create_output_path()
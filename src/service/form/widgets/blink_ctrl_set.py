@@ -131,7 +131,9 @@ class BlinkCtrlSet:
         self.linkage_depth_title_ctrl.SetToolTip(linkage_depth_tooltip)
         self.sizer.Add(self.linkage_depth_title_ctrl, 0, wx.ALL, 3)
 
-        self.linkage_depth_ctrl = WheelSpinCtrlDouble(self.window, initial=0.5, min=0, max=1, inc=0.1, size=wx.Size(60, -1))
+        self.linkage_depth_ctrl = WheelSpinCtrlDouble(
+            self.window, initial=0.5, min=0, max=1, inc=0.1, size=wx.Size(60, -1), change_event=self.on_change_config
+        )
         self.linkage_depth_ctrl.SetToolTip(linkage_depth_tooltip)
         self.sizer.Add(self.linkage_depth_ctrl, 0, wx.ALL, 3)
 
@@ -142,7 +144,9 @@ class BlinkCtrlSet:
         self.blink_span_title_ctrl.SetToolTip(blink_span_tooltip)
         self.sizer.Add(self.blink_span_title_ctrl, 0, wx.ALL, 3)
 
-        self.blink_span_ctrl = WheelSpinCtrl(self.window, initial=60, min=10, max=150, size=wx.Size(60, -1))
+        self.blink_span_ctrl = WheelSpinCtrl(
+            self.window, initial=60, min=10, max=150, size=wx.Size(60, -1), change_event=self.on_change_config
+        )
         self.blink_span_ctrl.SetToolTip(blink_span_tooltip)
         self.sizer.Add(self.blink_span_ctrl, 0, wx.ALL, 3)
 
@@ -181,6 +185,10 @@ class BlinkCtrlSet:
     def on_change_probability(self, event: wx.Event) -> None:
         condition_name = self.condition_choice_ctrl.GetStringSelection()
         self.condition_probabilities[condition_name] = self.condition_probability_ctrl.GetValue()
+        self.on_change_config(event)
+
+    def on_change_config(self, event: wx.Event) -> None:
+        self.parent.on_change_blink_config(event)
 
     def on_change_condition_right(self, event: wx.Event) -> None:
         selection = self.condition_choice_ctrl.GetSelection()
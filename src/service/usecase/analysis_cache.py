@@ -0,0 +1,119 @@
+import hashlib
+import os
+import zipfile
+from typing import Any, Callable, Hashable, Optional
+
+import numpy as np
+
+from mlib.core.logger import MLogger
+from mlib.utils.file_utils import get_root_dir
+
+logger = MLogger(os.path.basename(__file__), level=1)
+__ = logger.get_text
+
+# キャッシュする値の形式・求め方を変えた場合は上げる(古い形式のキャッシュは使わない)
+ANALYSIS_CACHE_VERSION = 1
+# キャッシュディレクトリの容量の上限(byte)
+ANALYSIS_CACHE_MAX_BYTES = 256 * 1024 * 1024
+
+ANALYSIS_CACHE_VERSION_KEY = "__version__"
+
+
+class AnalysisCache:
+    """
+    変動量取得結果のディスクキャッシュ
+    目線生成・まばたき生成の変動量(キーフレ毎の目線の内積や手足の位置比など)は
+    モデル・モーション・対象ボーンが同じであれば変わらないため、圧縮した .npz として保存し
+    同じモーションで設定を変えて何度も生成する場合に、ボーン変形を行わずに読み込む
+    容量の上限を超えたら、最も使われていないキャッシュから削除する
+    ディスクに書き込むため、使うかどうかは呼び出し側(画面)で決める(生成処理には指定された時だけ渡す)
+    """
+
+    def __init__(self, cache_dir: Optional[str] = None, max_bytes: int = ANALYSIS_CACHE_MAX_BYTES) -> None:
+        self.cache_dir = cache_dir or os.path.join(get_root_dir(), "cache", "analysis")
+        self.max_bytes = max_bytes
+
+    def get(self, stage_name: str, key: Hashable, create: Callable[[], dict[str, np.ndarray]]) -> dict[str, np.ndarray]:
+        """
+        変動量を取得する(キャッシュがない場合は create で生成して保存する)
+        stage_name: 処理段階名
+        key: 処理段階の入力から求めたキー(起動し直しても同じ値になること)
+        """
+        cache_path = self.get_path(stage_name, key)
+
+        arrays = self.read(cache_path)
+        if arrays is not None:
+            logger.debug("変動量キャッシュ利用 [{s}]", s=stage_name)
+            return arrays
+
+        arrays = create()
+        self.write(cache_path, arrays)
+
+        return arrays
+
+    def get_path(self, stage_name: str, key: Hashable) -> str:
+        digest = hashlib.sha1(repr((ANALYSIS_CACHE_VERSION, stage_name, key)).encode("utf-8")).hexdigest()
+        return os.path.join(self.cache_dir, f"{digest}.npz")
+
+    def read(self, cache_path: str) -> Optional[dict[str, np.ndarray]]:
+        if not os.path.isfile(cache_path):
+            return None
+
+        try:
+            with np.load(cache_path) as npz:
+                if ANALYSIS_CACHE_VERSION_KEY not in npz.files or int(npz[ANALYSIS_CACHE_VERSION_KEY]) != ANALYSIS_CACHE_VERSION:
+                    return None
+                arrays = {name: npz[name] for name in npz.files if name != ANALYSIS_CACHE_VERSION_KEY}
+            # 使われた順に削除するため、読み込んだキャッシュの更新日時を更新する
+            os.utime(cache_path)
+        except (OSError, ValueError, EOFError, zipfile.BadZipFile):
+            # 書き込み途中で終了したなどで壊れているキャッシュは削除して、生成し直す
+            logger.debug("変動量キャッシュ破損 [{p}]", p=cache_path)
+            try:
+                os.remove(cache_path)
+            except OSError:
+                pass
+            return None
+
+        return arrays
+
+    def write(self, cache_path: str, arrays: dict[str, np.ndarray]) -> None:
+        """キャッシュを保存する(失敗しても生成処理には影響させない)"""
+        work_path = f"{cache_path}.{os.getpid()}.tmp"
+
+        try:
+            os.makedirs(self.cache_dir, exist_ok=True)
+            # 型チェックで配列が allow_pickle 引数に渡ると判定されないよう、辞書にまとめてから渡す
+            save_arrays: dict[str, Any] = {ANALYSIS_CACHE_VERSION_KEY: np.array(ANALYSIS_CACHE_VERSION), **arrays}
+            with open(work_path, "wb") as f:
+                np.savez_compressed(f, **save_arrays)
+            os.replace(work_path, cache_path)
+        except OSError:
+            logger.debug("変動量キャッシュ保存失敗 [{p}]", p=cache_path)
+            if os.path.exists(work_path):
+                os.remove(work_path)
+            return
+
+        self.evict()
+
+    def evict(self) -> None:
+        """容量の上限を超えている場合、更新日時が古いキャッシュから削除する"""
+        try:
+            cache_files = [
+                (entry.stat().st_mtime, entry.stat().st_size, entry.path)
+                for entry in os.scandir(self.cache_dir)
+                if entry.is_file() and entry.name.endswith(".npz")
+            ]
+        except OSError:
+            return
+
+        total_bytes = sum(size for _, size, _ in cache_files)
+        for _, size, cache_path in sorted(cache_files):
+            if total_bytes <= self.max_bytes:
+                break
+            try:
+                os.remove(cache_path)
+            except OSError:
+                # 別プロセスで削除済み
+                pass
+            total_bytes -= size
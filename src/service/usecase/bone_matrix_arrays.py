@@ -0,0 +1,41 @@
+import os
+
+import numpy as np
+
+from mlib.core.logger import MLogger
+from mlib.vmd.vmd_tree import VmdBoneFrameTrees
+
+logger = MLogger(os.path.basename(__file__), level=1)
+__ = logger.get_text
+
+
+def get_global_matrix_array(matrixes: VmdBoneFrameTrees, fnos: list[int], bone_name: str) -> np.ndarray:
+    """指定ボーンのキーフレ毎のグローバル行列 (キーフレ数, 4, 4)"""
+    return np.array([matrixes[fno, bone_name].global_matrix.vector for fno in fnos], dtype=np.float64).reshape(-1, 4, 4)
+
+
+def get_position_array(matrixes: VmdBoneFrameTrees, fnos: list[int], bone_name: str) -> np.ndarray:
+    """指定ボーンのキーフレ毎のグローバル位置 (キーフレ数, 3)"""
+    return np.array([matrixes[fno, bone_name].position.vector for fno in fnos], dtype=np.float64).reshape(-1, 3)
+
+
+def get_direction_vectors(global_matrixes: np.ndarray, positions: np.ndarray, local_direction: np.ndarray) -> np.ndarray:
+    """
+    ボーンのローカル方向をグローバル座標に変換した、キーフレ毎の向きの単位ベクトル (キーフレ数, 3)
+    global_matrixes: グローバル行列 (キーフレ数, 4, 4)
+    positions: グローバル位置 (キーフレ数, 3)
+    local_direction: ボーンから見た向き (3,)
+    """
+    global_directions = global_matrixes @ np.append(local_direction, 1.0)
+    vectors = global_directions[:, :3] - positions
+    norms = np.linalg.norm(vectors, axis=1, keepdims=True)
+
+    # 長さ0のベクトルはそのまま0とする
+    return np.divide(vectors, norms, out=np.zeros_like(vectors), where=0 < norms)
+
+
+def get_direction_dots(vectors: np.ndarray) -> np.ndarray:
+    """キーフレ毎の直前キーフレとの向きの内積 (キーフレ数,) 先頭は変化なしとして1とする"""
+    dots = np.ones(len(vectors), dtype=np.float64)
+    dots[1:] = np.einsum("ij,ij->i", vectors[1:], vectors[:-1])
+    return dots
@@ -0,0 +1,290 @@
+import hashlib
+import os
+from threading import Lock
+from typing import Optional
+
+import numpy as np
+
+from mlib.core.logger import MLogger
+from mlib.pmx.pmx_collection import PmxModel
+from mlib.pmx.pmx_part import MorphType
+from mlib.vmd.vmd_collection import VmdMotion
+from service.usecase.bone_matrix_arrays import get_global_matrix_array, get_position_array
+from service.usecase.cancel_token import CancelToken
+
+logger = MLogger(os.path.basename(__file__), level=1)
+__ = logger.get_text
+
+# 画面から使う場合の時間窓の長さ(キーフレ番号の幅)
+DEFAULT_WINDOW_SIZE = 3000
+
+
+class BoneMatrixCache:
+    """
+    ボーン行列キャッシュ
+    目線生成・まばたき生成で同じモーションのボーン変形を求め直さないよう、変形結果から取り出したボーン毎の配列を保持する
+    キーはボーン毎に、モデルのハッシュ、モーションのハッシュ、そのボーンの変形結果に影響するキーフレの内容から求め、
+    キーフレが変わったボーンだけを変形し直す
+    (影響するキーフレは、親ボーン・付与親・IKボーンとそのターゲットを辿ったボーンと、それらを動かすボーンモーフ・IKのON/OFF)
+    変形したボーンの親ボーンの配列も保持するので、目線生成で両目を変形した後のまばたき生成では、
+    両目キーフレが変わった両目だけを変形し直し、上半身などは目線生成の変形結果を使う
+    ライブプレビューの複数スレッドから参照されるため、保持内容の読み書きはロックする(変形自体はロックの外で行う)
+    時間窓を指定した場合は、キーフレ番号の時間窓毎に変形して、変形結果は配列を取り出したら捨てる
+    時間窓で区切るのはボーン変形だけで、取り出した配列は全キーフレ分を保持する
+    (配列はボーン・キーフレ毎に行列1つと位置1つで、ボーン変形結果に比べて小さい)
+    """
+
+    def __init__(self, window_size: int = 0) -> None:
+        """
+        window_size: 長尺モーション用の時間窓の長さ(キーフレ番号の幅。0の場合は全キーフレをまとめて変形する)
+        """
+        self.window_size = window_size
+        # ボーン毎の変形結果の配列
+        self.bone_arrays: dict[str, BoneFrameArrays] = {}
+        # モデル毎の、ボーン毎に変形結果に影響するボーン・モーフ
+        self.dependency_digest: Optional[str] = None
+        self.dependency_bone_names: dict[str, set[str]] = {}
+        self.dependency_morph_names: dict[str, set[str]] = {}
+        self.lock = Lock()
+
+    def clear(self) -> None:
+        with self.lock:
+            self.bone_arrays = {}
+
+    def animate_bone_arrays(
+        self,
+        model: PmxModel,
+        motion: VmdMotion,
+        fnos: list[int],
+        bone_names: list[str],
+        cancel_token: Optional[CancelToken] = None,
+    ) -> dict[str, tuple[np.ndarray, np.ndarray]]:
+        """
+        指定キーフレ・ボーンのグローバル行列 (キーフレ数, 4, 4) とグローバル位置 (キーフレ数, 3) を取得する
+        fnos: 取得するキーフレ(昇順)
+        bone_names: 配列を取得するボーン
+        cancel_token: 中断要求(時間窓毎に確認する。中断までに変形した時間窓の配列は保持する)
+        キーが変わっていないボーンは保持している配列を使い、足りないキーフレ・ボーンだけを変形する
+        (各キーフレの変形はそのキーフレの姿勢だけで決まるため、キーフレ・ボーンを分けて変形しても全てをまとめて変形した結果と同じ)
+        """
+        cancel_token = cancel_token or CancelToken()
+        cancel_token.check()
+
+        sorted_fnos = np.array(fnos, dtype=np.int64)
+        keys = dict([(bone_name, self.create_key(model, motion, [bone_name])) for bone_name in bone_names])
+
+        with self.lock:
+            bone_arrays = dict([(bone_name, self.bone_arrays.get(bone_name)) for bone_name in bone_names])
+
+        # ボーン毎に変形が足りないキーフレ
+        missing_fnos: dict[str, np.ndarray] = {}
+        for bone_name in bone_names:
+            cached_arrays = bone_arrays[bone_name]
+            if cached_arrays is None or cached_arrays.key != keys[bone_name]:
+                missing_fnos[bone_name] = sorted_fnos
+            elif not cached_arrays.is_cover(sorted_fnos):
+                missing_fnos[bone_name] = np.setdiff1d(sorted_fnos, cached_arrays.fnos)
+
+        if missing_fnos:
+            self.animate_missing_bones(model, motion, missing_fnos, cancel_token)
+            with self.lock:
+                bone_arrays = dict([(bone_name, self.bone_arrays.get(bone_name)) for bone_name in bone_names])
+        else:
+            logger.debug("ボーン行列キャッシュ利用")
+
+        results: dict[str, tuple[np.ndarray, np.ndarray]] = {}
+        for bone_name in bone_names:
+            cached_arrays = bone_arrays[bone_name]
+            assert cached_arrays is not None and cached_arrays.key == keys[bone_name] and cached_arrays.is_cover(sorted_fnos)
+            results[bone_name] = cached_arrays.take(sorted_fnos)
+
+        return results
+
+    def animate_missing_bones(
+        self, model: PmxModel, motion: VmdMotion, missing_fnos: dict[str, np.ndarray], cancel_token: CancelToken
+    ) -> None:
+        """
+        変形が足りないボーンを、足りないキーフレだけ変形して配列を保持する
+        変形したボーンの親ボーンも変形結果に含まれるので、親ボーンの配列も合わせて保持する
+        """
+        animate_bone_names = sorted(missing_fnos.keys())
+        animate_fnos = np.unique(np.concatenate(list(missing_fnos.values())))
+        tree_bone_names = sorted(
+            set([tree_bone_name for bone_name in animate_bone_names for tree_bone_name in model.bone_trees[bone_name].names])
+        )
+        tree_keys = dict([(bone_name, self.create_key(model, motion, [bone_name])) for bone_name in tree_bone_names])
+
+        if self.window_size:
+            window_nos = animate_fnos // self.window_size
+            window_fnos_list = [animate_fnos[window_nos == window_no] for window_no in np.unique(window_nos).tolist()]
+        else:
+            window_fnos_list = [animate_fnos]
+
+        for window_fnos in window_fnos_list:
+            cancel_token.check()
+
+            logger.debug("ボーン変形 [{s}-{e}]", s=window_fnos[0], e=window_fnos[-1])
+            fno_list = window_fnos.tolist()
+            matrixes = motion.animate_bone(fno_list, model, animate_bone_names, out_fno_log=True)
+            window_arrays = dict(
+                [
+                    (bone_name, (get_global_matrix_array(matrixes, fno_list, bone_name), get_position_array(matrixes, fno_list, bone_name)))
+                    for bone_name in tree_bone_names
+                ]
+            )
+
+            # 中断した場合も、変形し終わった時間窓の配列は次の変形で使い回す
+            with self.lock:
+                for bone_name in tree_bone_names:
+                    cached_arrays = self.bone_arrays.get(bone_name)
+                    global_matrixes, positions = window_arrays[bone_name]
+                    if cached_arrays is None or cached_arrays.key != tree_keys[bone_name]:
+                        self.bone_arrays[bone_name] = BoneFrameArrays(tree_keys[bone_name], window_fnos, global_matrixes, positions)
+                    else:
+                        self.bone_arrays[bone_name] = cached_arrays.merge(window_fnos, global_matrixes, positions)
+
+    def create_key(self, model: PmxModel, motion: VmdMotion, bone_names: list[str]) -> tuple[str, str, str]:
+        return (model.digest, motion.digest, self.get_keyframe_digest(model, motion, bone_names))
+
+    def get_keyframe_digest(self, model: PmxModel, motion: VmdMotion, bone_names: list[str]) -> str:
+        """変形結果に影響するキーフレ(対象ボーンに影響するボーン・ボーンモーフ・IKのON/OFF)の内容のハッシュ"""
+        dependency_bone_names, dependency_morph_names = self.get_dependency_names(model, bone_names)
+
+        sha1 = hashlib.sha1()
+        # キーフレのないボーン・モーフは、参照しただけで空の一覧ができていても同じハッシュにする
+        for bone_name in dependency_bone_names:
+            if bone_name not in motion.bones.names:
+                continue
+            bone_frames = np.array(
+                [
+                    [
+                        bf.index,
+                        *bf.position.vector,
+                        bf.rotation.scalar,
+                        bf.rotation.x,
+                        bf.rotation.y,
+                        bf.rotation.z,
+                        *bf.interpolations.vals,
+                    ]
+                    for bf in motion.bones[bone_name]
+                ],
+                dtype=np.float64,
+            )
+            if len(bone_frames):
+                sha1.update(bone_name.encode("utf-8"))
+                sha1.update(bone_frames.tobytes())
+
+        for morph_name in dependency_morph_names:
+            if morph_name not in motion.morphs.names:
+                continue
+            morph_frames = np.array([[mf.index, mf.ratio] for mf in motion.morphs[morph_name]], dtype=np.float64)
+            if len(morph_frames):
+                sha1.update(morph_name.encode("utf-8"))
+                sha1.update(morph_frames.tobytes())
+
+        ik_bone_names = set([bone_name for bone_name in dependency_bone_names if model.bones[bone_name].is_ik])
+        for sif in motion.show_iks:
+            for ik in sif.iks:
+                if ik.name in ik_bone_names:
+                    sha1.update(f"{sif.index}:{ik.name}:{ik.onoff}".encode("utf-8"))
+
+        return sha1.hexdigest()
+
+    def get_dependency_names(self, model: PmxModel, bone_names: list[str]) -> tuple[list[str], list[str]]:
+        """指定ボーンの変形結果に影響するボーン名(自身を含む)とモーフ名"""
+        with self.lock:
+            if self.dependency_digest != model.digest:
+                self.dependency_digest = model.digest
+                self.dependency_bone_names = {}
+                self.dependency_morph_names = {}
+            for bone_name in bone_names:
+                if bone_name not in self.dependency_bone_names:
+                    self.dependency_bone_names[bone_name], self.dependency_morph_names[bone_name] = self.create_dependency_names(
+                        model, bone_name
+                    )
+            dependency_bone_names = set([name for bone_name in bone_names for name in self.dependency_bone_names[bone_name]])
+            dependency_morph_names = set([name for bone_name in bone_names for name in self.dependency_morph_names[bone_name]])
+
+        return sorted(dependency_bone_names), sorted(dependency_morph_names)
+
+    def create_dependency_names(self, model: PmxModel, bone_name: str) -> tuple[set[str], set[str]]:
+        """
+        指定ボーンの変形結果に影響するボーン名とモーフ名を求める
+        親ボーン・付与親を辿り、IKリンクになっているボーンはIKボーンとそのターゲットも辿る
+        モーフは、辿ったボーンを動かすボーンモーフと、それを含むグループモーフ
+        """
+        # IKリンクのボーンINDEX毎に、そのリンクを動かすIKボーンINDEX
+        ik_indexes: dict[int, set[int]] = {}
+        for bone in model.bones:
+            if bone.is_ik:
+                for link in bone.ik.links:
+                    ik_indexes.setdefault(link.bone_index, set()).add(bone.index)
+
+        bone_indexes: set[int] = {model.bones[bone_name].index}
+        queue = [model.bones[bone_name].index]
+        while queue:
+            bone = model.bones[queue.pop()]
+            dependency_indexes = [bone.parent_index]
+            if bone.is_external_rotation or bone.is_external_translation:
+                dependency_indexes.append(bone.effect_index)
+            for ik_index in ik_indexes.get(bone.index, set()):
+                dependency_indexes.extend([ik_index, model.bones[ik_index].ik.bone_index])
+            for dependency_index in dependency_indexes:
+                if 0 <= dependency_index and dependency_index not in bone_indexes:
+                    bone_indexes.add(dependency_index)
+                    queue.append(dependency_index)
+
+        bone_morph_indexes = set(
+            [
+                morph.index
+                for morph in model.morphs
+                if morph.morph_type == MorphType.BONE and any([offset.bone_index in bone_indexes for offset in morph.offsets])
+            ]
+        )
+        morph_indexes = bone_morph_indexes | set(
+            [
+                morph.index
+                for morph in model.morphs
+                if morph.morph_type == MorphType.GROUP and any([offset.morph_index in bone_morph_indexes for offset in morph.offsets])
+            ]
+        )
+
+        return (
+            set([model.bones[bone_index].name for bone_index in bone_indexes]),
+            set([model.morphs[morph_index].name for morph_index in morph_indexes]),
+        )
+
+
+class BoneFrameArrays:
+    """ボーン毎の、変形したキーフレとそのグローバル行列・グローバル位置"""
+
+    def __init__(self, key: tuple[str, str, str], fnos: np.ndarray, global_matrixes: np.ndarray, positions: np.ndarray) -> None:
+        """
+        key: 変形した時のボーンのキー
+        fnos: 変形したキーフレ(昇順)
+        global_matrixes: キーフレ毎のグローバル行列 (キーフレ数, 4, 4)
+        positions: キーフレ毎のグローバル位置 (キーフレ数, 3)
+        """
+        self.key = key
+        self.fnos = fnos
+        self.global_matrixes = global_matrixes
+        self.positions = positions
+
+    def is_cover(self, fnos: np.ndarray) -> bool:
+        """指定キーフレを全て含んでいるか"""
+        return bool(np.all(np.isin(fnos, self.fnos)))
+
+    def take(self, fnos: np.ndarray) -> tuple[np.ndarray, np.ndarray]:
+        """指定キーフレ(昇順)のグローバル行列とグローバル位置"""
+        indexes = np.searchsorted(self.fnos, fnos)
+        return self.global_matrixes[indexes], self.positions[indexes]
+
+    def merge(self, fnos: np.ndarray, global_matrixes: np.ndarray, positions: np.ndarray) -> "BoneFrameArrays":
+        """変形したキーフレを追加した配列(同じキーフレは保持済みのものを使う)"""
+        merged_fnos, indexes = np.unique(np.concatenate([self.fnos, fnos]), return_index=True)
+        return BoneFrameArrays(
+            self.key,
+            merged_fnos,
+            np.concatenate([self.global_matrixes, global_matrixes])[indexes],
+            np.concatenate([self.positions, positions])[indexes],
+        )
@@ -0,0 +1,34 @@
+import os
+from threading import Event
+
+from mlib.core.logger import MLogger
+
+logger = MLogger(os.path.basename(__file__), level=1)
+__ = logger.get_text
+
+
+class CanceledException(Exception):
+    """処理が中断された"""
+
+    pass
+
+
+class CancelToken:
+    """
+    処理の中断要求
+    別スレッドから cancel を呼ぶと、処理側の次の check で CanceledException を送出して処理を打ち切る
+    """
+
+    def __init__(self) -> None:
+        self.event = Event()
+
+    def cancel(self) -> None:
+        self.event.set()
+
+    @property
+    def is_canceled(self) -> bool:
+        return self.event.is_set()
+
+    def check(self) -> None:
+        if self.event.is_set():
+            raise CanceledException()
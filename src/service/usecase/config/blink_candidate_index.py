@@ -0,0 +1,76 @@
+import os
+from bisect import bisect_left, bisect_right
+from typing import Optional
+
+import numpy as np
+
+from mlib.core.logger import MLogger
+
+logger = MLogger(os.path.basename(__file__), level=1)
+__ = logger.get_text
+
+# 次のまばたき候補を探す範囲の長さ(前のまばたきから間隔を空けた位置からのキーフレ数)
+BLINK_RANGE_LENGTH = 100
+# 候補が見つからない場合に探す範囲を広げる回数
+BLINK_RANGE_EXPAND_COUNT = 4
+
+
+class BlinkCandidateIndex:
+    """
+    まばたき候補キーフレの索引
+    候補キーフレをソート済み配列で保持し、範囲の検索は二分探索、範囲内で最も重い候補の検索はスパーステーブルで行う
+    (同じ重みの候補が複数ある場合は前の候補を優先する)
+    """
+
+    def __init__(self, blink_weight_fnos: dict[int, float]) -> None:
+        """
+        blink_weight_fnos: 候補キーフレ毎のまばたきの重み
+        """
+        self.fnos: list[int] = sorted(blink_weight_fnos.keys())
+        self.weights = np.array([blink_weight_fnos[fno] for fno in self.fnos], dtype=np.float64)
+
+        # tables[k][i]: i から 2^k 個の候補の中で最も重い候補のINDEX
+        self.tables: list[np.ndarray] = [np.arange(len(self.fnos), dtype=np.int64)]
+        width = 1
+        while width * 2 <= len(self.fnos):
+            prev_table = self.tables[-1]
+            self.tables.append(self._select(prev_table[: len(prev_table) - width], prev_table[width:]))
+            width *= 2
+
+    def _select(self, left_indexes: np.ndarray, right_indexes: np.ndarray) -> np.ndarray:
+        """2つの候補のうち重い方(同じ重みの場合は前の方)のINDEX"""
+        left_weights = self.weights[left_indexes]
+        right_weights = self.weights[right_indexes]
+        return np.where(
+            left_weights > right_weights,
+            left_indexes,
+            np.where(right_weights > left_weights, right_indexes, np.minimum(left_indexes, right_indexes)),
+        )
+
+    def get_heaviest_fno(self, start_fno: int, end_fno: int) -> Optional[int]:
+        """start_fno < fno < end_fno の範囲で最も重い候補キーフレ(候補がない場合は None)"""
+        start_index = bisect_right(self.fnos, start_fno)
+        end_index = bisect_left(self.fnos, end_fno)
+        if end_index <= start_index:
+            return None
+
+        # 範囲を前後から覆う 2^k 個ずつの区間の結果を比較する
+        k = (end_index - start_index).bit_length() - 1
+        left_index = int(self.tables[k][start_index])
+        right_index = int(self.tables[k][end_index - (1 << k)])
+        if self.weights[right_index] > self.weights[left_index]:
+            return self.fnos[right_index]
+        if self.weights[left_index] > self.weights[right_index]:
+            return self.fnos[left_index]
+        return self.fnos[min(left_index, right_index)]
+
+    def get_next_fno(self, prev_fno: int, blink_span: int) -> Optional[int]:
+        """
+        前のまばたきから blink_span 以上空けた範囲で最も重い候補キーフレ
+        範囲内に候補がない場合は範囲を広げて探し、それでも見つからない場合は None
+        """
+        for n in range(1, BLINK_RANGE_EXPAND_COUNT + 1):
+            fno = self.get_heaviest_fno(prev_fno + blink_span, prev_fno + ((blink_span + BLINK_RANGE_LENGTH) * n))
+            if fno is not None:
+                return fno
+        return None
@@ -1,14 +1,21 @@
 import os
 from enum import Enum
+from typing import Optional
 
 import numpy as np
 
 from mlib.core.interpolation import Interpolation, get_infections
 from mlib.core.logger import MLogger
-from mlib.core.math import MQuaternion, MVector2D, MVector3D
+from mlib.core.math import MQuaternion, MVector2D
 from mlib.pmx.pmx_collection import PmxModel
 from mlib.vmd.vmd_collection import VmdMotion
 from mlib.vmd.vmd_part import VmdBoneFrame, VmdMorphFrame
+from service.usecase.analysis_cache import AnalysisCache
+from service.usecase.bone_matrix_arrays import get_direction_dots, get_direction_vectors
+from service.usecase.bone_matrix_cache import BoneMatrixCache
+from service.usecase.config.blink_candidate_index import BlinkCandidateIndex
+from service.usecase.cancel_token import CancelToken
+from service.usecase.stage_cache import StageCache
 
 logger = MLogger(os.path.basename(__file__), level=1)
 __ = logger.get_text
@@ -30,8 +37,21 @@ class BlinkUsecase:
         eyebrow_below_name: str,
         blink_name: str,
         smile_name: str,
+        bone_matrix_cache: Optional[BoneMatrixCache] = None,
+        stage_cache: Optional[StageCache] = None,
+        cancel_token: Optional[CancelToken] = None,
+        analysis_cache: Optional[AnalysisCache] = None,
     ) -> None:
-        """まばたき生成"""
+        """
+        まばたき生成
+        bone_matrix_cache: ボーン行列キャッシュ(目線生成と変形結果を共有する)
+        stage_cache: 処理段階毎のキャッシュ(発生確率などを変えた再生成では変動量取得・変曲点抽出を使い回す)
+        cancel_token: 中断要求(ライブプレビューで設定が変わった時に途中で打ち切る)
+        analysis_cache: 変動量のディスクキャッシュ(起動し直しても同じモーションの変動量取得を使い回す。指定がなければディスクには保存しない)
+        """
+        bone_matrix_cache = bone_matrix_cache or BoneMatrixCache()
+        stage_cache = stage_cache or StageCache()
+        cancel_token = cancel_token or CancelToken()
 
         # 既存キーフレ削除
         del motion.bones["右目"]
@@ -39,14 +59,6 @@ class BlinkUsecase:
         del motion.morphs[blink_name]
         del motion.morphs[eyebrow_below_name]
 
-        # まばたきをする可能性があるキーフレ一覧
-        # 手足の動きもキーフレを取る
-        eye_fnos = sorted(
-            set([bf.index for bone_name in model.bone_trees["両目"].names for bf in motion.bones[bone_name]]) | {motion.bones.max_fno}
-        )
-
-        logger.info("目線変動量取得", decoration=MLogger.Decoration.LINE)
-
         kick_probability = condition_probabilities[BlinkConditions.AFTER_KICK.value.name] * 0.01
         wrist_probability = condition_probabilities[BlinkConditions.WRIST_CROSS.value.name] * 0.01
 
@@ -56,48 +68,35 @@ class BlinkUsecase:
         if 0 < wrist_probability:
             target_bone_names.extend(["左手首", "右手首"])
 
-        logger.info("両目変動量")
-        eye_matrixes = motion.animate_bone(eye_fnos, model, target_bone_names, out_fno_log=True)
-
-        prev_blink = None
-        blink_vectors: list[MVector3D] = []
-        blink_dots: list[float] = []
-        upper_ratio_ys: list[float] = []
-        left_ankle_ys: list[float] = []
-        right_ankle_ys: list[float] = []
-        left_wrist_distance_ratios: list[float] = []
-        right_wrist_distance_ratios: list[float] = []
-        for fidx, fno in enumerate(eye_fnos):
-            logger.count("目線変動量取得", index=fidx, total_index_count=len(eye_fnos), display_block=100)
-            eye_global_direction_vector = eye_matrixes[fno, "両目"].global_matrix * MVector3D(0, 0, -1)
-            eye_vector = (eye_global_direction_vector - eye_matrixes[fno, "両目"].position).normalized() * -1
-            upper_ratio_ys.append(eye_matrixes[fno, "上半身"].position.y / model.bones["上半身"].position.y)
-            if 0 < kick_probability:
-                left_ankle_ys.append(eye_matrixes[fno, "左足首"].position.y / model.bones["左ひざ"].position.y)
-                right_ankle_ys.append(eye_matrixes[fno, "右足首"].position.y / model.bones["右ひざ"].position.y)
-            if 0 < wrist_probability:
-                left_wrist_distance_ratios.append(
-                    eye_matrixes[fno, "左手首"].position.distance(eye_matrixes[fno, "両目"].position)
-                    / model.bones["左手首"].position.distance(model.bones["左ひじ"].position)
-                )
-                right_wrist_distance_ratios.append(
-                    eye_matrixes[fno, "右手首"].position.distance(eye_matrixes[fno, "両目"].position)
-                    / model.bones["右手首"].position.distance(model.bones["右ひじ"].position)
-                )
+        # 目線変動量は対象ボーンに影響するボーンのキーフレが変わらない限り同じ
+        analysis_key = (
+            bone_matrix_cache.create_key(model, motion, target_bone_names),
+            tuple(target_bone_names),
+            motion.bones.max_fno,
+        )
 
-            if not prev_blink:
-                # 初回はスルー
-                prev_blink = eye_vector
-                blink_dots.append(1.0)
-                continue
+        def analyze() -> BlinkAnalysis:
+            if not analysis_cache:
+                return self.analyze_blink(model, motion, bone_matrix_cache, target_bone_names, cancel_token)
+            return BlinkAnalysis.from_arrays(
+                analysis_cache.get(
+                    "まばたき変動量取得",
+                    analysis_key,
+                    lambda: self.analyze_blink(model, motion, bone_matrix_cache, target_bone_names, cancel_token).to_arrays(),
+                )
+            )
 
-            # 両目の向き
-            blink_dot = eye_vector.dot(prev_blink)
-            # logger.debug(f"fno[{fno:04d}], eye[{eye_global_direction_vector}], blink[{eye_vector}], dot[{blink_dot:.3f}]")
+        logger.info("目線変動量取得", decoration=MLogger.Decoration.LINE)
+        analysis: BlinkAnalysis = stage_cache.get("まばたき変動量取得", analysis_key, analyze)
+        eye_fnos = analysis.eye_fnos
+        blink_dots = analysis.blink_dots
+        upper_ratio_ys = analysis.upper_ratio_ys
+        left_ankle_ys = analysis.left_ankle_ys
+        right_ankle_ys = analysis.right_ankle_ys
+        left_wrist_distance_ratios = analysis.left_wrist_distance_ratios
+        right_wrist_distance_ratios = analysis.right_wrist_distance_ratios
 
-            blink_dots.append(blink_dot)
-            blink_vectors.append(eye_vector)
-            prev_blink = eye_vector
+        cancel_token.check()
 
         blink_weight_fnos: dict[int, float] = {}
         blink_type_fnos: dict[int, str] = {}
@@ -107,7 +106,7 @@ class BlinkUsecase:
         if 0 < normal_probability:
             logger.info("まばたきポイント検出 [前のまばたきから一定時間経過した時]", decoration=MLogger.Decoration.LINE)
 
-            normal_dots = get_infections(blink_dots, 0.02)
+            normal_dots = stage_cache.get("まばたき変曲点抽出", (analysis_key, 0.02), lambda: get_infections(blink_dots, 0.02))
             logger.info("変曲点抽出 候補キーフレ[{d}件]", d=len(normal_dots))
 
             for fidx in normal_dots:
@@ -128,7 +127,7 @@ class BlinkUsecase:
 
             # ジャンプ（足首の動き）の箇所を抽出する
             kick_fidxs = sorted(
-                set(np.where(np.array(left_ankle_ys) > 1.2)[0].tolist()) | set(np.where(np.array(right_ankle_ys) > 1.2)[0].tolist())
+                set(np.where(left_ankle_ys > 1.2)[0].tolist()) | set(np.where(right_ankle_ys > 1.2)[0].tolist())
             )
             logger.info("変曲点抽出 候補キーフレ[{d}件]", d=len(kick_fidxs))
 
@@ -149,8 +148,8 @@ class BlinkUsecase:
 
             # ジャンプ（足首の動き）の箇所を抽出する
             wrist_fidxs = sorted(
-                set(np.where(np.array(left_wrist_distance_ratios) < 0.6)[0].tolist())
-                | set(np.where(np.array(right_wrist_distance_ratios) < 0.6)[0].tolist())
+                set(np.where(left_wrist_distance_ratios < 0.6)[0].tolist())
+                | set(np.where(right_wrist_distance_ratios < 0.6)[0].tolist())
             )
             logger.info("変曲点抽出 候補キーフレ[{d}件]", d=len(wrist_fidxs))
 
@@ -171,7 +170,7 @@ class BlinkUsecase:
         if 0 < jump_probability:
             logger.info("まばたきポイント検出 [ジャンプの着地後]", decoration=MLogger.Decoration.LINE)
 
-            jump_fidxs = np.where(np.array(upper_ratio_ys) > 1.1)[0]
+            jump_fidxs = np.where(upper_ratio_ys > 1.1)[0]
             logger.info("変曲点抽出 候補キーフレ[{d}件]", d=len(jump_fidxs))
 
             # ジャンプ（上半身のY位置が高い）の箇所を抽出する
@@ -189,7 +188,7 @@ class BlinkUsecase:
         if 0 < turn_probability:
             logger.info("まばたきポイント検出 [ターンの開始時]", decoration=MLogger.Decoration.LINE)
 
-            turn_fidxs = get_infections(blink_dots, 0.6)
+            turn_fidxs = stage_cache.get("まばたき変曲点抽出", (analysis_key, 0.6), lambda: get_infections(blink_dots, 0.6))
             logger.info("変曲点抽出 候補キーフレ[{d}件]", d=len(turn_fidxs))
 
             for fidx in turn_fidxs:
@@ -206,7 +205,7 @@ class BlinkUsecase:
         if 0 < opening_probability or 0 < ending_probability:
             logger.info("まばたきポイント検出 [モーションの開始・終了]", decoration=MLogger.Decoration.LINE)
 
-            infection_fnos = get_infections(blink_dots, 0.2)
+            infection_fnos = stage_cache.get("まばたき変曲点抽出", (analysis_key, 0.2), lambda: get_infections(blink_dots, 0.2))
             logger.info("変曲点抽出 候補キーフレ[{d}件]", d=2)
 
             # 最初の変曲点までのキーフレ間が一定区間ある場合、登録対象
@@ -227,6 +226,8 @@ class BlinkUsecase:
                 blink_type_fnos[fno] = __("モーションの終了")
                 blink_double_fnos[fno] = True
 
+        cancel_token.check()
+
         logger.info("まばたき生成", decoration=MLogger.Decoration.LINE)
 
         eyebrow_below_ratio = linkage_depth * 0.5
@@ -235,14 +236,21 @@ class BlinkUsecase:
 
         smile_probability = condition_probabilities[BlinkConditions.SMILE.value.name] * 0.01
 
+        # 範囲内で最も重いまばたき候補を探すための索引
+        candidate_index = BlinkCandidateIndex(blink_weight_fnos)
+
+        # まばたき毎の基準キーフレ (開始, 閉じる, 停止, 半開き, 開く, 二重の前半か, 二重の後半か, 笑いを含めるか)
+        blink_anchors: list[tuple[int, int, int, int, int, bool, bool, bool]] = []
+
         nums = 0
         # 最初のまばたきを対象とする
-        fno = sorted(blink_weight_fnos.keys())[0]
+        fno = candidate_index.fnos[0]
         is_double_before = False
         is_double_after = False
         prev_fno = start_fno = close_fno = weight_fno = open_fno = end_fno = 0
-        range_fnos: dict[int, float] = {}
+        next_fno: Optional[int] = None
         while prev_fno < eye_fnos[-1]:
+            cancel_token.check()
             # 重み付けをしたまばたき -----------
             weight = blink_weight_fnos.get(fno, 0.3)
             blink_type = blink_type_fnos.get(fno, __("連続"))
@@ -263,149 +271,18 @@ class BlinkUsecase:
 
             # 最初は静止 (二重まばたきの場合は半開き)
             start_fno = fno - weight_blink - 4 + np.random.randint(-1, 1)
-            mf1 = VmdMorphFrame(start_fno, blink_name)
-            mf1.ratio = 0.2 if is_double_after else 0.0
-            motion.morphs[blink_name].append(mf1)
-            output_motion.morphs[blink_name].append(mf1.copy())
-
             # 閉じる
             close_fno = fno - weight_blink - 1
-            mf2 = VmdMorphFrame(close_fno, blink_name)
-            mf2.ratio = 1.0
-            motion.morphs[blink_name].append(mf2)
-            output_motion.morphs[blink_name].append(mf2.copy())
-
             # 停止
             weight_fno = fno
-            mf3 = VmdMorphFrame(weight_fno, blink_name)
-            mf3.ratio = 1.0
-            motion.morphs[blink_name].append(mf3)
-            output_motion.morphs[blink_name].append(mf3.copy())
-
             if not is_double_before:
                 # 半開き
                 open_fno = fno + weight_blink + 2 + np.random.randint(-1, 1)
-                mf4 = VmdMorphFrame(open_fno, blink_name)
-                mf4.ratio = 0.5
-                motion.morphs[blink_name].append(mf4)
-                output_motion.morphs[blink_name].append(mf4.copy())
-
                 # 開く (二重まばたきの場合はスルー)
                 end_fno = fno + weight_blink + 6 + np.random.randint(-1, 1)
-                mf5 = VmdMorphFrame(end_fno, blink_name)
-                mf5.ratio = 0.0
-                motion.morphs[blink_name].append(mf5)
-                output_motion.morphs[blink_name].append(mf5.copy())
-
-            if is_smile:
-                # 笑い（一定確率） -------
-
-                smf1 = VmdMorphFrame(start_fno - 2, smile_name)
-                smf1.ratio = 0.2 if is_double_after else 0.0
-                motion.morphs[smile_name].append(smf1)
-                output_motion.morphs[smile_name].append(smf1.copy())
-
-                smf2 = VmdMorphFrame(int((start_fno + close_fno) / 2), smile_name)
-                smf2.ratio = 0.3
-                motion.morphs[smile_name].append(smf2)
-                output_motion.morphs[smile_name].append(smf2.copy())
-
-                smf3 = VmdMorphFrame(close_fno, smile_name)
-                smf3.ratio = 0.0
-                motion.morphs[smile_name].append(smf3)
-                output_motion.morphs[smile_name].append(smf3.copy())
-
-                smf4 = VmdMorphFrame(weight_fno, smile_name)
-                smf4.ratio = 0.0
-                motion.morphs[smile_name].append(smf4)
-                output_motion.morphs[smile_name].append(smf4.copy())
-
-                if not is_double_before:
-                    smf5 = VmdMorphFrame(open_fno, smile_name)
-                    smf5.ratio = 0.3
-                    motion.morphs[smile_name].append(smf5)
-                    output_motion.morphs[smile_name].append(smf5.copy())
-
-                    smf6 = VmdMorphFrame(end_fno + 2, smile_name)
-                    smf6.ratio = 0.0
-                    motion.morphs[smile_name].append(smf6)
-                    output_motion.morphs[smile_name].append(smf6.copy())
-
-            # 眉を下げる -------
-
-            bmf1 = VmdMorphFrame(start_fno - 1, eyebrow_below_name)
-            bmf1.ratio = 0.2 if is_double_after else 0.0
-            motion.morphs[eyebrow_below_name].append(bmf1)
-            output_motion.morphs[eyebrow_below_name].append(bmf1.copy())
-
-            bmf2 = VmdMorphFrame(close_fno - 1, eyebrow_below_name)
-            bmf2.ratio = eyebrow_below_ratio
-            motion.morphs[eyebrow_below_name].append(bmf2)
-            output_motion.morphs[eyebrow_below_name].append(bmf2.copy())
-
-            if not is_double_before:
-                bmf3 = VmdMorphFrame(open_fno + 1, eyebrow_below_name)
-                bmf3.ratio = eyebrow_below_ratio
-                motion.morphs[eyebrow_below_name].append(bmf3)
-                output_motion.morphs[eyebrow_below_name].append(bmf3.copy())
-
-                bmf4 = VmdMorphFrame(end_fno + 1, eyebrow_below_name)
-                bmf4.ratio = 0.0
-                motion.morphs[eyebrow_below_name].append(bmf4)
-                output_motion.morphs[eyebrow_below_name].append(bmf4.copy())
-
-            # 閉じるのに合わせて目線を下に ---------
-
-            # 最初は静止
-            start_left_bf = VmdBoneFrame(start_fno - 1, "左目")
-            if is_double_after:
-                start_left_bf.interpolations.rotation = CLOSE_INTERPOLATION.copy()
-                start_left_bf.rotation = start_double_qq.copy()
-            motion.bones["左目"].append(start_left_bf)
-            output_motion.bones["左目"].append(start_left_bf.copy())
-
-            start_right_bf = VmdBoneFrame(start_fno - 1, "右目")
-            if is_double_after:
-                start_right_bf.interpolations.rotation = CLOSE_INTERPOLATION.copy()
-                start_right_bf.rotation = start_double_qq.copy()
-            motion.bones["右目"].append(start_right_bf)
-            output_motion.bones["右目"].append(start_right_bf.copy())
-
-            # 閉じるよりも少し後に目を下に
-            close_left_bf = VmdBoneFrame(close_fno - 1, "左目")
-            close_left_bf.interpolations.rotation = CLOSE_INTERPOLATION.copy()
-            close_left_bf.rotation = close_qq.copy()
-            motion.bones["左目"].append(close_left_bf)
-            output_motion.bones["左目"].append(close_left_bf.copy())
-
-            close_right_bf = VmdBoneFrame(close_fno - 1, "右目")
-            close_right_bf.interpolations.rotation = CLOSE_INTERPOLATION.copy()
-            close_right_bf.rotation = close_qq.copy()
-            motion.bones["右目"].append(close_right_bf)
-            output_motion.bones["右目"].append(close_right_bf.copy())
-
-            # 開くのより少し後まで目を下に
-            weight_left_bf = VmdBoneFrame(weight_fno + 2, "左目")
-            weight_left_bf.rotation = close_qq.copy()
-            motion.bones["左目"].append(weight_left_bf)
-            output_motion.bones["左目"].append(weight_left_bf.copy())
-
-            weight_right_bf = VmdBoneFrame(weight_fno + 2, "右目")
-            weight_right_bf.rotation = close_qq.copy()
-            motion.bones["右目"].append(weight_right_bf)
-            output_motion.bones["右目"].append(weight_right_bf.copy())
 
-            if not is_double_before:
-                # 最後は元に戻す
-                end_left_bf = VmdBoneFrame(end_fno - 2, "左目")
-                end_left_bf.interpolations.rotation = CLOSE_INTERPOLATION.copy()
-                motion.bones["左目"].append(end_left_bf)
-                output_motion.bones["左目"].append(end_left_bf.copy())
-
-                end_right_bf = VmdBoneFrame(end_fno - 2, "右目")
-                end_right_bf.interpolations.rotation = CLOSE_INTERPOLATION.copy()
-                motion.bones["右目"].append(end_right_bf)
-                output_motion.bones["右目"].append(end_right_bf.copy())
+            # キーフレはまばたき毎の基準キーフレを全て決めてから、テンプレートを当てはめてまとめて登録する
+            blink_anchors.append((start_fno, close_fno, weight_fno, open_fno, end_fno, is_double_before, is_double_after, is_smile))
 
             logger.debug(
                 f"まばたき[{weight}(DB:{is_double_before}, DA:{is_double_after})] start[{start_fno}], close[{close_fno}], "
@@ -416,24 +293,12 @@ class BlinkUsecase:
             prev_fno = fno
             nums += 1
 
-            # 前のキーフレから100F (3秒近く)分を抽出
-            range_fnos = {}
-            n = 1
-            while not range_fnos:
-                range_fnos = dict(
-                    [
-                        (f, blink_weight_fnos[f])
-                        for f in sorted(blink_weight_fnos.keys())
-                        if prev_fno + blink_span < f < prev_fno + ((blink_span + 100) * n)
-                    ]
-                )
-                n += 1
-                if n > 5:
-                    prev_fno = eye_fnos[-1]
-                    break
+            # 前のキーフレから100F (3秒近く)分の範囲の中で最も重いまばたきを抽出する（同じのがある場合は前のを優先）
+            next_fno = candidate_index.get_next_fno(prev_fno, blink_span)
+            if next_fno is None:
+                prev_fno = eye_fnos[-1]
 
             if prev_fno < eye_fnos[-1]:
-                # 範囲の中で最も重いまばたきを抽出する（同じのがある場合は前のを優先）
                 # ランダムで二回連続の瞬きをする
                 if is_double_before:
                     fno = weight_fno + 7
@@ -443,7 +308,276 @@ class BlinkUsecase:
                     is_double_before = False
                     if is_double_after:
                         is_double_after = False
-                    fno = list(range_fnos.keys())[int(np.argmax(list(range_fnos.values())))]
+                    fno = next_fno
+
+        cancel_token.check()
+
+        logger.info("まばたきキーフレ登録 [{n}件]", n=nums)
+
+        anchors = BlinkAnchors(blink_anchors)
+
+        # まばたき
+        self.append_morph_frames(
+            motion,
+            output_motion,
+            blink_name,
+            anchors,
+            anchors.all,
+            [
+                (BlinkAnchors.START, 0, 0.0, 0.2, False),
+                (BlinkAnchors.CLOSE, 0, 1.0, 1.0, False),
+                (BlinkAnchors.WEIGHT, 0, 1.0, 1.0, False),
+                (BlinkAnchors.OPEN, 0, 0.5, 0.5, True),
+                (BlinkAnchors.END, 0, 0.0, 0.0, True),
+            ],
+        )
+
+        # 笑い（一定確率）
+        self.append_morph_frames(
+            motion,
+            output_motion,
+            smile_name,
+            anchors,
+            anchors.is_smile,
+            [
+                (BlinkAnchors.START, -2, 0.0, 0.2, False),
+                (BlinkAnchors.START_CLOSE, 0, 0.3, 0.3, False),
+                (BlinkAnchors.CLOSE, 0, 0.0, 0.0, False),
+                (BlinkAnchors.WEIGHT, 0, 0.0, 0.0, False),
+                (BlinkAnchors.OPEN, 0, 0.3, 0.3, True),
+                (BlinkAnchors.END, 2, 0.0, 0.0, True),
+            ],
+        )
+
+        # 眉を下げる
+        self.append_morph_frames(
+            motion,
+            output_motion,
+            eyebrow_below_name,
+            anchors,
+            anchors.all,
+            [
+                (BlinkAnchors.START, -1, 0.0, 0.2, False),
+                (BlinkAnchors.CLOSE, -1, eyebrow_below_ratio, eyebrow_below_ratio, False),
+                (BlinkAnchors.OPEN, 1, eyebrow_below_ratio, eyebrow_below_ratio, True),
+                (BlinkAnchors.END, 1, 0.0, 0.0, True),
+            ],
+        )
+
+        # 閉じるのに合わせて目線を下に
+        for eye_bone_name in ["左目", "右目"]:
+            self.append_bone_frames(
+                motion,
+                output_motion,
+                eye_bone_name,
+                anchors,
+                [
+                    # 最初は静止
+                    (BlinkAnchors.START, -1, None, start_double_qq, False, True, False),
+                    # 閉じるよりも少し後に目を下に
+                    (BlinkAnchors.CLOSE, -1, close_qq, close_qq, True, True, False),
+                    # 開くのより少し後まで目を下に
+                    (BlinkAnchors.WEIGHT, 2, close_qq, close_qq, False, False, False),
+                    # 最後は元に戻す
+                    (BlinkAnchors.END, -2, None, None, True, True, True),
+                ],
+            )
+
+    def append_morph_frames(
+        self,
+        motion: VmdMotion,
+        output_motion: VmdMotion,
+        morph_name: str,
+        anchors: "BlinkAnchors",
+        blink_mask: np.ndarray,
+        template: list[tuple[int, int, float, float, bool]],
+    ) -> None:
+        """
+        まばたきのモーフキーフレをテンプレートから一括で生成して登録する
+        blink_mask: キーフレを登録するまばたき
+        template: (基準キーフレ, 基準からのずれ, 変形量, 二重まばたきの後半の変形量, 二重まばたきの前半では登録しないか) のリスト
+        """
+        template_nos, fnos, is_double_afters = anchors.expand(
+            blink_mask, [(anchor, offset, is_single) for anchor, offset, _, _, is_single in template]
+        )
+        ratios = np.where(
+            is_double_afters,
+            np.array([double_after_ratio for _, _, _, double_after_ratio, _ in template])[template_nos],
+            np.array([ratio for _, _, ratio, _, _ in template])[template_nos],
+        )
+
+        for fno, ratio in zip(fnos.tolist(), ratios.tolist()):
+            # 元モーションと出力モーションには別々に生成したキーフレを登録する(コピーしない)
+            motion.morphs[morph_name].append(VmdMorphFrame(fno, morph_name, ratio))
+            output_motion.morphs[morph_name].append(VmdMorphFrame(fno, morph_name, ratio))
+
+    def append_bone_frames(
+        self,
+        motion: VmdMotion,
+        output_motion: VmdMotion,
+        bone_name: str,
+        anchors: "BlinkAnchors",
+        template: list[tuple[int, int, Optional[MQuaternion], Optional[MQuaternion], bool, bool, bool]],
+    ) -> None:
+        """
+        まばたきのボーンキーフレをテンプレートから一括で生成して登録する
+        template: (基準キーフレ, 基準からのずれ, 回転, 二重まばたきの後半の回転,
+                   閉じる補間曲線を使うか, 二重まばたきの後半で閉じる補間曲線を使うか, 二重まばたきの前半では登録しないか) のリスト
+                   (回転が None の場合は回転なし)
+        """
+        template_nos, fnos, is_double_afters = anchors.expand(
+            anchors.all, [(anchor, offset, is_single) for anchor, offset, *_, is_single in template]
+        )
+
+        for template_no, fno, is_double_after in zip(template_nos.tolist(), fnos.tolist(), is_double_afters.tolist()):
+            _, _, rotation, double_after_rotation, is_close, is_double_after_close, _ = template[template_no]
+            if is_double_after:
+                rotation = double_after_rotation
+                is_close = is_double_after_close
+
+            for target_motion in [motion, output_motion]:
+                bf = VmdBoneFrame(fno, bone_name)
+                if is_close:
+                    bf.interpolations.rotation = CLOSE_INTERPOLATION.copy()
+                if rotation is not None:
+                    bf.rotation = rotation.copy()
+                target_motion.bones[bone_name].append(bf)
+
+    def analyze_blink(
+        self,
+        model: PmxModel,
+        motion: VmdMotion,
+        bone_matrix_cache: BoneMatrixCache,
+        target_bone_names: list[str],
+        cancel_token: Optional[CancelToken] = None,
+    ) -> "BlinkAnalysis":
+        """
+        まばたき候補を判定するための目線・手足の変動量取得
+        cancel_token: 中断要求(時間窓毎の変形の間で確認する)
+        時間窓で区切るのはボーン変形だけで、両目・手足の変動量は全キーフレ分の配列でまとめて求める
+        """
+        # まばたきをする可能性があるキーフレ一覧
+        # 手足の動きもキーフレを取る
+        eye_fnos = sorted(
+            set([bf.index for bone_name in model.bone_trees["両目"].names for bf in motion.bones[bone_name]]) | {motion.bones.max_fno}
+        )
+
+        logger.info("両目変動量")
+        eye_arrays = bone_matrix_cache.animate_bone_arrays(model, motion, eye_fnos, ["上半身"] + target_bone_names, cancel_token)
+
+        eye_global_matrixes, eye_positions = eye_arrays["両目"]
+        # 両目の向き
+        blink_vectors = get_direction_vectors(eye_global_matrixes, eye_positions, np.array([0.0, 0.0, -1.0])) * -1
+
+        analysis = BlinkAnalysis(
+            eye_fnos,
+            get_direction_dots(blink_vectors),
+            eye_arrays["上半身"][1][:, 1] / model.bones["上半身"].position.y,
+        )
+
+        if "左足首" in target_bone_names:
+            analysis.left_ankle_ys = eye_arrays["左足首"][1][:, 1] / model.bones["左ひざ"].position.y
+            analysis.right_ankle_ys = eye_arrays["右足首"][1][:, 1] / model.bones["右ひざ"].position.y
+        if "左手首" in target_bone_names:
+            analysis.left_wrist_distance_ratios = np.linalg.norm(
+                eye_arrays["左手首"][1] - eye_positions, axis=1
+            ) / model.bones["左手首"].position.distance(model.bones["左ひじ"].position)
+            analysis.right_wrist_distance_ratios = np.linalg.norm(
+                eye_arrays["右手首"][1] - eye_positions, axis=1
+            ) / model.bones["右手首"].position.distance(model.bones["右ひじ"].position)
+
+        return analysis
+
+
+class BlinkAnchors:
+    """
+    まばたき毎の基準キーフレを列毎の配列で保持する
+    テンプレートの (基準キーフレ, 基準からのずれ) を全まばたきに一度に当てはめてキーフレ番号の配列を求める
+    """
+
+    START = 0
+    CLOSE = 1
+    WEIGHT = 2
+    OPEN = 3
+    END = 4
+    # 開始と閉じるの中間
+    START_CLOSE = 5
+
+    def __init__(self, blink_anchors: list[tuple[int, int, int, int, int, bool, bool, bool]]) -> None:
+        """
+        blink_anchors: まばたき毎の (開始, 閉じる, 停止, 半開き, 開く, 二重の前半か, 二重の後半か, 笑いを含めるか)
+        """
+        values = np.array(blink_anchors, dtype=np.int64).reshape(-1, 8)
+        start_close_fnos = ((values[:, 0] + values[:, 1]) / 2).astype(np.int64)
+        # 基準キーフレの列 (基準キーフレ種類, まばたき数)
+        self.fnos = np.vstack([values[:, :5].T, start_close_fnos])
+        self.is_double_before = values[:, 5].astype(bool)
+        self.is_double_after = values[:, 6].astype(bool)
+        self.is_smile = values[:, 7].astype(bool)
+        self.all = np.ones(len(values), dtype=bool)
+
+    def expand(self, blink_mask: np.ndarray, template: list[tuple[int, int, bool]]) -> tuple[np.ndarray, np.ndarray, np.ndarray]:
+        """
+        テンプレートを全まばたきに当てはめて、登録するキーフレ毎の
+        (テンプレートの行番号, キーフレ番号, 二重まばたきの後半か) の配列をまばたき順・テンプレート順で返す
+        blink_mask: キーフレを登録するまばたき
+        template: (基準キーフレ, 基準からのずれ, 二重まばたきの前半では登録しないか) のリスト
+        """
+        blink_nos: list[np.ndarray] = [np.zeros(0, dtype=np.int64)]
+        template_nos: list[np.ndarray] = [np.zeros(0, dtype=np.int64)]
+        fnos: list[np.ndarray] = [np.zeros(0, dtype=np.int64)]
+        for n, (anchor, offset, is_single) in enumerate(template):
+            mask = blink_mask & ~self.is_double_before if is_single else blink_mask
+            blink_nos.append(np.where(mask)[0])
+            template_nos.append(np.full(np.count_nonzero(mask), n, dtype=np.int64))
+            fnos.append(self.fnos[anchor][mask] + offset)
+
+        all_blink_nos = np.concatenate(blink_nos)
+        all_template_nos = np.concatenate(template_nos)
+        # 同じキーフレに複数登録する場合は、まばたき順・テンプレート順で後のものが優先されるよう並べる
+        order = np.lexsort((all_template_nos, all_blink_nos))
+
+        return all_template_nos[order], np.concatenate(fnos)[order], self.is_double_after[all_blink_nos[order]]
+
+
+class BlinkAnalysis:
+    def __init__(self, eye_fnos: list[int], blink_dots: np.ndarray, upper_ratio_ys: np.ndarray) -> None:
+        """
+        まばたき候補判定用の変動量
+        eye_fnos: まばたきをする可能性があるキーフレ一覧
+        blink_dots: キーフレ毎の直前との両目の向きの内積
+        upper_ratio_ys: キーフレ毎の上半身の高さ(初期位置比)
+        """
+        self.eye_fnos = eye_fnos
+        self.blink_dots = blink_dots
+        self.upper_ratio_ys = upper_ratio_ys
+        # 足首の高さ(ひざの初期位置比)
+        self.left_ankle_ys = np.zeros(0)
+        self.right_ankle_ys = np.zeros(0)
+        # 手首と両目の距離(腕の長さ比)
+        self.left_wrist_distance_ratios = np.zeros(0)
+        self.right_wrist_distance_ratios = np.zeros(0)
+
+    def to_arrays(self) -> dict[str, np.ndarray]:
+        """ディスクキャッシュに保存する配列"""
+        return {
+            "eye_fnos": np.array(self.eye_fnos, dtype=np.int64),
+            "blink_dots": self.blink_dots,
+            "upper_ratio_ys": self.upper_ratio_ys,
+            "left_ankle_ys": self.left_ankle_ys,
+            "right_ankle_ys": self.right_ankle_ys,
+            "left_wrist_distance_ratios": self.left_wrist_distance_ratios,
+            "right_wrist_distance_ratios": self.right_wrist_distance_ratios,
+        }
+
+    @classmethod
+    def from_arrays(cls, arrays: dict[str, np.ndarray]) -> "BlinkAnalysis":
+        analysis = cls(arrays["eye_fnos"].tolist(), arrays["blink_dots"], arrays["upper_ratio_ys"])
+        analysis.left_ankle_ys = arrays["left_ankle_ys"]
+        analysis.right_ankle_ys = arrays["right_ankle_ys"]
+        analysis.left_wrist_distance_ratios = arrays["left_wrist_distance_ratios"]
+        analysis.right_wrist_distance_ratios = arrays["right_wrist_distance_ratios"]
+        return analysis
 
 
 class BlinkCondition:
@@ -1,5 +1,7 @@
 import os
+from typing import Optional
 
+import numpy as np
 from numpy.linalg import solve
 
 from mlib.core.interpolation import IP_MAX, create_interpolation, get_infections
@@ -8,6 +10,11 @@ from mlib.core.math import MQuaternion, MVector2D, MVector3D
 from mlib.pmx.pmx_collection import PmxModel
 from mlib.vmd.vmd_collection import VmdMotion
 from mlib.vmd.vmd_part import VmdBoneFrame
+from service.usecase.analysis_cache import AnalysisCache
+from service.usecase.bone_matrix_arrays import get_direction_dots, get_direction_vectors
+from service.usecase.bone_matrix_cache import BoneMatrixCache
+from service.usecase.cancel_token import CancelToken
+from service.usecase.stage_cache import StageCache
 
 logger = MLogger(os.path.basename(__file__), level=1)
 __ = logger.get_text
@@ -30,47 +37,48 @@ class GazeUsecase:
         gaze_limit_upper_y: int,
         gaze_limit_lower_y: int,
         gaze_reset_num: int,
+        bone_matrix_cache: Optional[BoneMatrixCache] = None,
+        stage_cache: Optional[StageCache] = None,
+        cancel_token: Optional[CancelToken] = None,
+        analysis_cache: Optional[AnalysisCache] = None,
     ) -> None:
-        """目線生成"""
+        """
+        目線生成
+        bone_matrix_cache: ボーン行列キャッシュ(まばたき生成と変形結果を共有する)
+        stage_cache: 処理段階毎のキャッシュ(パラメーターだけを変えた再生成では変動量取得・変曲点抽出を使い回す)
+        cancel_token: 中断要求(ライブプレビューで設定が変わった時に途中で打ち切る)
+        analysis_cache: 変動量のディスクキャッシュ(起動し直しても同じモーションの変動量取得を使い回す。指定がなければディスクには保存しない)
+        """
+        bone_matrix_cache = bone_matrix_cache or BoneMatrixCache()
+        stage_cache = stage_cache or StageCache()
+        cancel_token = cancel_token or CancelToken()
 
         if "両目" in motion.bones.names:
             # 既存の両目キーフレは削除
             del motion.bones["両目"]
 
-        # 目線が動く可能性があるキーフレ一覧
-        eye_fnos = sorted(set([bf.index for bone_name in model.bone_trees["両目"].names for bf in motion.bones[bone_name]]))
+        # 目線の変動量は両目に影響するボーンのキーフレが変わらない限り同じ
+        analysis_key = bone_matrix_cache.create_key(model, motion, ["両目"])
 
         logger.info("目線変動量取得", decoration=MLogger.Decoration.LINE)
-        eye_matrixes = motion.animate_bone(eye_fnos, model, ["両目"], out_fno_log=True)
-
-        prev_gaze = None
-        gaze_vectors: list[MVector3D] = []
-        gaze_dots: list[float] = []
-        for fidx, fno in enumerate(eye_fnos):
-            logger.count("目線変動量取得", index=fidx, total_index_count=len(eye_fnos), display_block=100)
-            eye_global_direction_vector = eye_matrixes[fno, "両目"].global_matrix * Z_AXIS
-            gaze_vector = (eye_global_direction_vector - eye_matrixes[fno, "両目"].position).normalized()
-
-            if not prev_gaze:
-                # 初回はスルー
-                prev_gaze = gaze_vector
-                gaze_dots.append(1.0)
-                continue
+        eye_fnos, gaze_dots, gaze_vectors = stage_cache.get(
+            "目線変動量取得",
+            analysis_key,
+            lambda: self.read_gaze_analysis(model, motion, bone_matrix_cache, analysis_cache, analysis_key, cancel_token),
+        )
 
-            # 目線の向き
-            gaze_dot = gaze_vector.dot(prev_gaze)
-            # logger.debug(f"fno[{fno:04d}], eye[{eye_global_direction_vector}], gaze[{gaze_vector}], dot[{gaze_dot:.3f}]")
-
-            gaze_dots.append(gaze_dot)
-            gaze_vectors.append(gaze_vector)
-            prev_gaze = gaze_vector
+        cancel_token.check()
 
         logger.info("目線変曲点抽出", decoration=MLogger.Decoration.LINE)
         # logger.debug(gaze_dots)
 
-        infection_eyes = get_infections(gaze_dots, (1 - gaze_infection) * 0.02)
+        infection_eyes = stage_cache.get(
+            "目線変曲点抽出", (analysis_key, gaze_infection), lambda: get_infections(gaze_dots, (1 - gaze_infection) * 0.02)
+        )
         # logger.debug(infection_eyes)
 
+        cancel_token.check()
+
         logger.info("目線生成", decoration=MLogger.Decoration.LINE)
 
         # 最初は静止
@@ -85,6 +93,7 @@ class GazeUsecase:
 
         for i, iidx in enumerate(infection_eyes):
             logger.count("目線生成", index=i, total_index_count=len(infection_eyes), display_block=1000)
+            cancel_token.check()
 
             if 1 > i:
                 continue
@@ -97,8 +106,8 @@ class GazeUsecase:
                     # 前の目線からあまりにも近い場合スルー
                     continue
 
-            gaze_vector = gaze_vectors[iidx - 1]
-            infection_gaze_vector = gaze_vectors[iidx]
+            gaze_vector = MVector3D(*gaze_vectors[iidx - 1])
+            infection_gaze_vector = MVector3D(*gaze_vectors[iidx])
 
             # 目線の変動が一定以上であれば目線を動かす
             gaze_full_qq = MQuaternion.rotate(gaze_vector, infection_gaze_vector)
@@ -135,6 +144,7 @@ class GazeUsecase:
 
         for i, (iidx, next_iidx) in enumerate(zip(infection_eyes[:-1], infection_eyes[1:])):
             logger.count("目線クリア", index=i, total_index_count=len(infection_eyes), display_block=100)
+            cancel_token.check()
 
             fno = eye_fnos[iidx]
             next_fno = eye_fnos[next_iidx]
@@ -156,36 +166,42 @@ class GazeUsecase:
             logger.debug("目線クリア 始[{d}] 終[{r}]", d=bf.index, r=next_bf.index)
 
         eye_fnos = output_motion.bones["両目"].indexes
-        for fidx, (prev_fno, now_fno, next_fno) in enumerate(zip(eye_fnos[:-2:2], eye_fnos[1:-1:2], eye_fnos[2::2])):
-            logger.count("目線補間曲線", index=fidx, total_index_count=len(eye_fnos), display_block=100)
-
-            prev_bf = output_motion.bones["両目"][prev_fno]
-            now_bf = output_motion.bones["両目"][now_fno]
-            next_bf = output_motion.bones["両目"][next_fno]
-
-            prev_degree = prev_bf.rotation.to_signed_degrees(Z_AXIS)
-            now_degree = now_bf.rotation.to_signed_degrees(Z_AXIS)
-            next_degree = next_bf.rotation.to_signed_degrees(Z_AXIS)
-
-            prev_degree = 1
-            now_degree = now_bf.rotation.dot(prev_bf.rotation)
-            next_degree = next_bf.rotation.dot(now_bf.rotation)
-
-            x1 = 0
-            x2 = now_fno - prev_fno
-            x3 = next_fno - prev_fno
-
-            a, b, c = solve([[x1**2, x1, 1], [x2**2, x2, 1], [x3**2, x3, 1]], [prev_degree, now_degree, next_degree])
-
-            now_degrees: list[float] = []
-            for fidx in range(now_fno - prev_fno):
-                now_degrees.append(a * fidx**2 + b * fidx + c)
-            now_interpolation = create_interpolation(now_degrees)
-
-            next_degrees: list[float] = []
-            for fidx in range(now_fno - prev_fno, next_fno - prev_fno):
-                next_degrees.append(a * fidx**2 + b * fidx + c)
-            next_interpolation = create_interpolation(next_degrees)
+        # 補間曲線は 2キーフレ毎に、前・今・次の3キーフレの回転の変化を二次関数で近似して求める
+        triple_fnos = np.array(list(zip(eye_fnos[:-2:2], eye_fnos[1:-1:2], eye_fnos[2::2])), dtype=np.int64).reshape(-1, 3)
+        if not len(triple_fnos):
+            return
+
+        cancel_token.check()
+
+        triple_bfs = [[output_motion.bones["両目"][fno] for fno in fnos] for fnos in triple_fnos.tolist()]
+
+        # 前のキーフレからの経過キーフレ数と、直前のキーフレの回転との内積 (前のキーフレは1)
+        xs = triple_fnos - triple_fnos[:, :1]
+        ys = np.array(
+            [[1, now_bf.rotation.dot(prev_bf.rotation), next_bf.rotation.dot(now_bf.rotation)] for prev_bf, now_bf, next_bf in triple_bfs],
+            dtype=np.float64,
+        )
+
+        # 全区間の y = ax^2 + bx + c をまとめて解く
+        coefficients = solve(np.stack([xs**2, xs, np.ones_like(xs)], axis=2).astype(np.float64), ys[:, :, np.newaxis])[:, :, 0]
+
+        # 全区間の全キーフレの近似値をまとめて求める(区間毎に 0 から次のキーフレまでの経過キーフレ数を並べる)
+        segment_lengths = xs[:, 2]
+        segment_starts = np.concatenate([[0], np.cumsum(segment_lengths)[:-1]])
+        segment_xs = np.arange(int(np.sum(segment_lengths))) - np.repeat(segment_starts, segment_lengths)
+        segment_coefficients = np.repeat(coefficients, segment_lengths, axis=0)
+        segment_degrees = (
+            segment_coefficients[:, 0] * segment_xs**2 + segment_coefficients[:, 1] * segment_xs + segment_coefficients[:, 2]
+        ).tolist()
+
+        for fidx, ((prev_bf, now_bf, next_bf), (a, b, c), segment_start, (_, now_x, next_x)) in enumerate(
+            zip(triple_bfs, coefficients.tolist(), segment_starts.tolist(), xs.tolist())
+        ):
+            logger.count("目線補間曲線", index=fidx, total_index_count=len(triple_bfs), display_block=100)
+            cancel_token.check()
+
+            now_interpolation = create_interpolation(segment_degrees[segment_start : segment_start + now_x])
+            next_interpolation = create_interpolation(segment_degrees[segment_start + now_x : segment_start + next_x])
 
             prev_bf.interpolations.rotation.end = MVector2D(IP_MAX, IP_MAX) - now_interpolation.start
             now_bf.interpolations.rotation.start = now_interpolation.start
@@ -198,6 +214,47 @@ class GazeUsecase:
                 + f"now[{now_bf.index}][{now_bf.interpolations.rotation}]"
             )
 
+    def read_gaze_analysis(
+        self,
+        model: PmxModel,
+        motion: VmdMotion,
+        bone_matrix_cache: BoneMatrixCache,
+        analysis_cache: Optional[AnalysisCache],
+        analysis_key: tuple,
+        cancel_token: Optional[CancelToken] = None,
+    ) -> tuple[list[int], np.ndarray, np.ndarray]:
+        """目線変動量取得(ディスクキャッシュが指定されていれば、保存済みのものを読み込む)"""
+
+        def analyze() -> dict[str, np.ndarray]:
+            eye_fnos, gaze_dots, gaze_vectors = self.analyze_gaze(model, motion, bone_matrix_cache, cancel_token)
+            return {"eye_fnos": np.array(eye_fnos, dtype=np.int64), "gaze_dots": gaze_dots, "gaze_vectors": gaze_vectors}
+
+        arrays = analysis_cache.get("目線変動量取得", analysis_key, analyze) if analysis_cache else analyze()
+
+        return arrays["eye_fnos"].tolist(), arrays["gaze_dots"], arrays["gaze_vectors"]
+
+    def analyze_gaze(
+        self, model: PmxModel, motion: VmdMotion, bone_matrix_cache: BoneMatrixCache, cancel_token: Optional[CancelToken] = None
+    ) -> tuple[list[int], np.ndarray, np.ndarray]:
+        """
+        目線変動量取得
+        目線が動く可能性があるキーフレ一覧、キーフレ毎の直前との目線の内積、目線の向き(先頭キーフレを除く)を返す
+        cancel_token: 中断要求(時間窓毎の変形の間で確認する)
+        時間窓で区切るのはボーン変形だけで、目線の内積・向きは全キーフレ分の配列でまとめて求める
+        """
+        # 目線が動く可能性があるキーフレ一覧
+        eye_fnos = sorted(set([bf.index for bone_name in model.bone_trees["両目"].names for bf in motion.bones[bone_name]]))
+
+        eye_arrays = bone_matrix_cache.animate_bone_arrays(model, motion, eye_fnos, ["両目"], cancel_token)
+
+        eye_vectors = get_direction_vectors(*eye_arrays["両目"], Z_AXIS.vector)
+        # 目線の向き
+        gaze_dots = get_direction_dots(eye_vectors)
+        # 初回はスルー
+        gaze_vectors = eye_vectors[1:]
+
+        return eye_fnos, gaze_dots, gaze_vectors
+
 
 def fitted_x_function(x: float):
     y = (
@@ -0,0 +1,259 @@
+import os
+from collections import OrderedDict
+from typing import Optional
+
+import numpy as np
+from numpy.typing import DTypeLike
+
+from mlib.core.logger import MLogger
+from service.usecase.config.morph_offset_store import MorphOffsetMatrix, MorphOffsetStore
+
+logger = MLogger(os.path.basename(__file__), level=1)
+__ = logger.get_text
+
+# 破綻チェックで一度に確保する作業領域の上限(byte)
+DEFAULT_MEMORY_BUDGET = 256 * 1024 * 1024
+# 頂点が動いたとみなす変形量(np.isclose の既定の許容誤差と同じ)
+MOVED_TOLERANCE = 1e-08
+# 同じ状態とみなすモーフ変形量の刻み
+CHECK_RATIO_STEP = 1e-06
+# モーフ変形量の状態毎の破綻チェック結果を保持する件数
+CHECK_RESULT_CACHE_SIZE = 65536
+
+
+class MorphBreakageChecker:
+    """
+    モーフ破綻チェック
+    複数キーフレのモーフ変形量行列 (キーフレ数×モーフ数) とモーフ変形量の疎行列の積で、
+    キーフレ毎の頂点変形量をまとめて求めて破綻しているか判定する
+    チェック対象モーフのいずれかで変形する頂点(影響頂点)だけを、影響頂点リスト内の位置で詰めて保持・計算する
+    キーフレ毎の頂点変形量の作業領域は確保したものを使い回す
+    モーフ変形量を丸めた状態毎に結果を保持し、同じ状態のキーフレ(リップシンクの同じ母音の連続など)はチェックし直さない
+    """
+
+    def __init__(
+        self,
+        morph_names: list[str],
+        matrix: MorphOffsetMatrix,
+        repair_vertex_positions: np.ndarray,
+        linear_morph_indexes: np.ndarray,
+        nonlinear_morph_indexes: np.ndarray,
+        support_vertex_indexes: np.ndarray,
+        offset_store: Optional[MorphOffsetStore] = None,
+        memory_budget: int = DEFAULT_MEMORY_BUDGET,
+        dtype: DTypeLike = np.float64,
+    ) -> None:
+        """
+        morph_names: チェック対象モーフ名リスト(モーフ変形量行列の列の並び)
+        matrix: 変形量に比例するモーフの疎行列(行は影響頂点リスト内の位置)
+        repair_vertex_positions: 破綻とみなす頂点変形量 (影響頂点数, 3)
+        linear_morph_indexes: 変形量に比例するモーフの列INDEX
+        nonlinear_morph_indexes: 回転を含むボーンモーフを持つモーフの列INDEX
+        support_vertex_indexes: 影響頂点リスト(チェック対象モーフのいずれかで変形する頂点INDEX、昇順)
+        offset_store: モデルのモーフ変形量ストア(回転を含むボーンモーフを持つモーフがある場合は必須)
+        memory_budget: 一度に確保する作業領域の上限(byte)
+        dtype: 頂点変形量の計算に使う型(np.float32 の場合は作業領域が半分になる)
+        """
+        self.morph_names = morph_names
+        self.dtype = np.dtype(dtype)
+        self.matrix = matrix.astype(self.dtype)
+        self.repair_vertex_positions = repair_vertex_positions.astype(self.dtype, copy=False)
+        # 変形量がない頂点は破綻とみなさない(閾値を無限大にしておく)
+        self.repair_thresholds = np.where(np.isclose(repair_vertex_positions, 0.0), np.inf, repair_vertex_positions).astype(self.dtype)
+        self.linear_morph_indexes = linear_morph_indexes
+        self.nonlinear_morph_indexes = nonlinear_morph_indexes
+        self.support_vertex_indexes = support_vertex_indexes
+        self.offset_store = offset_store
+        self.memory_budget = memory_budget
+        # 頂点変形量(符号あり・絶対値)と閾値との比較結果の作業領域 (キーフレ数, 影響頂点数*3)
+        self.morph_vertices_buffer = np.zeros((0, matrix.vertex_count * 3), dtype=self.dtype)
+        self.abs_morph_vertices_buffer = np.zeros((0, matrix.vertex_count * 3), dtype=self.dtype)
+        self.compare_buffer = np.zeros((0, matrix.vertex_count * 3), dtype=np.bool_)
+        # 丸めたモーフ変形量の状態毎の破綻チェック結果(LRU)
+        self.check_results: OrderedDict[bytes, bool] = OrderedDict()
+
+    @classmethod
+    def create(
+        cls,
+        offset_store: MorphOffsetStore,
+        morph_names: list[str],
+        repair_factor: float,
+        memory_budget: int = DEFAULT_MEMORY_BUDGET,
+        dtype: DTypeLike = np.float64,
+    ) -> "MorphBreakageChecker":
+        """
+        モーフ変形量ストアからチェック対象モーフの破綻チェックを生成する
+        repair_factor: 補正係数(モーフ最大変動量の何倍を超えたら破綻とみなすか)
+        dtype: 頂点変形量の計算に使う型
+        """
+        # 変形量に比例するモーフは疎行列でまとめて計算し、回転を含むボーンモーフを持つモーフは個別に計算する
+        linear_morph_indexes = np.array(
+            [midx for midx, morph_name in enumerate(morph_names) if offset_store.is_linear(morph_name)], dtype=np.int64
+        )
+        nonlinear_morph_indexes = np.array(
+            [midx for midx, morph_name in enumerate(morph_names) if not offset_store.is_linear(morph_name)], dtype=np.int64
+        )
+        # 頂点全体ではなく、チェック対象モーフの影響頂点だけで計算する
+        support_vertex_indexes = offset_store.get_support_vertex_indexes(morph_names)
+        matrix = offset_store.create_matrix([morph_names[midx] for midx in linear_morph_indexes], support_vertex_indexes)
+
+        logger.info("モーフ最大変動量チェック", decoration=MLogger.Decoration.LINE)
+        logger.debug("影響頂点数: {s} / {v}", s=len(support_vertex_indexes), v=offset_store.vertex_count)
+
+        # モーフの変形量1.0の時の変形量の絶対値の最大を、モーフ毎に順番に取り込む
+        repair_vertex_positions = np.zeros((len(support_vertex_indexes), 3), dtype=dtype)
+        abs_positions_buffer = np.zeros((len(support_vertex_indexes), 3), dtype=dtype)
+
+        for morph_name in morph_names:
+            vertex_indexes, vertex_positions = offset_store.get_offsets(morph_name, 1.0)
+            support_indexes = np.searchsorted(support_vertex_indexes, vertex_indexes)
+            abs_positions = np.abs(vertex_positions, out=abs_positions_buffer[: len(support_indexes)], casting="same_kind")
+            repair_vertex_positions[support_indexes] = np.maximum(repair_vertex_positions[support_indexes], abs_positions)
+
+        repair_vertex_positions *= repair_factor
+
+        return cls(
+            morph_names,
+            matrix,
+            repair_vertex_positions,
+            linear_morph_indexes,
+            nonlinear_morph_indexes,
+            support_vertex_indexes,
+            offset_store,
+            memory_budget,
+            dtype,
+        )
+
+    @classmethod
+    def from_arrays(
+        cls,
+        morph_names: list[str],
+        arrays: dict[str, np.ndarray],
+        memory_budget: int = DEFAULT_MEMORY_BUDGET,
+        offset_store: Optional[MorphOffsetStore] = None,
+    ) -> "MorphBreakageChecker":
+        """
+        別プロセスから受け渡された配列で破綻チェックを復元する
+        計算に使う型は受け渡し元と同じ(破綻とみなす頂点変形量の型)
+        offset_store: モデルのモーフ変形量ストア(回転を含むボーンモーフを持つモーフがある場合は必須)
+        """
+        repair_vertex_positions = arrays["repair_vertex_positions"]
+        matrix = MorphOffsetMatrix(
+            len(repair_vertex_positions),
+            arrays["rows"],
+            arrays["indptr"],
+            arrays["cols"],
+            arrays["values"],
+        )
+        return cls(
+            morph_names,
+            matrix,
+            repair_vertex_positions,
+            arrays["linear_morph_indexes"],
+            arrays["nonlinear_morph_indexes"],
+            arrays["support_vertex_indexes"],
+            offset_store,
+            memory_budget=memory_budget,
+            dtype=repair_vertex_positions.dtype,
+        )
+
+    @property
+    def is_linear(self) -> bool:
+        """全てのチェック対象モーフが変形量に比例するか(別プロセスにモーフ変形量ストアを渡す必要がないか)"""
+        return not len(self.nonlinear_morph_indexes)
+
+    @property
+    def arrays(self) -> dict[str, np.ndarray]:
+        """破綻チェックを構成する配列(別プロセスへの受け渡し用)"""
+        return {
+            **self.matrix.arrays,
+            "repair_vertex_positions": self.repair_vertex_positions,
+            "support_vertex_indexes": self.support_vertex_indexes,
+            "linear_morph_indexes": self.linear_morph_indexes,
+            "nonlinear_morph_indexes": self.nonlinear_morph_indexes,
+        }
+
+    @property
+    def chunk_size(self) -> int:
+        """作業領域の上限に収まる、一度にチェックするキーフレ数"""
+        # キーフレ毎に確保する要素数
+        # 頂点変形量(符号あり・絶対値)、疎行列の積で取り出すモーフ変形量(型変換・絶対値)と要素毎の積、行毎の合計
+        frame_values = (
+            self.matrix.vertex_count * 3 * 2 + len(self.linear_morph_indexes) * 2 + len(self.matrix.values) + len(self.matrix.rows)
+        )
+        # 閾値との比較結果と頂点毎の判定結果
+        frame_bools = self.matrix.vertex_count * 3 + self.matrix.vertex_count
+        frame_bytes = frame_values * self.dtype.itemsize + frame_bools * np.dtype(np.bool_).itemsize
+        return max(1, self.memory_budget // max(1, frame_bytes))
+
+    def check(self, morph_ratios: np.ndarray) -> np.ndarray:
+        """
+        キーフレ毎に破綻しているか判定する
+        morph_ratios: モーフ変形量行列 (キーフレ数×モーフ数)
+        """
+        # 同じ状態のキーフレはまとめて1回だけ判定する
+        ratio_keys = np.rint(np.asarray(morph_ratios, dtype=np.float64) / CHECK_RATIO_STEP).astype(np.int64)
+        unique_ratio_keys, inverse_indexes = np.unique(ratio_keys, axis=0, return_inverse=True)
+
+        is_unique_brokens = np.zeros(len(unique_ratio_keys), dtype=np.bool_)
+        result_keys = [ratio_key.tobytes() for ratio_key in unique_ratio_keys]
+        uncached_indexes: list[int] = []
+        for kidx, result_key in enumerate(result_keys):
+            if result_key in self.check_results:
+                self.check_results.move_to_end(result_key)
+                is_unique_brokens[kidx] = self.check_results[result_key]
+            else:
+                uncached_indexes.append(kidx)
+
+        # 結果がない状態だけ、丸めた変形量で判定する
+        uncached_morph_ratios = unique_ratio_keys[uncached_indexes] * CHECK_RATIO_STEP
+        chunk_size = self.chunk_size
+        for start_idx in range(0, len(uncached_indexes), chunk_size):
+            chunk_indexes = uncached_indexes[start_idx : start_idx + chunk_size]
+            is_unique_brokens[chunk_indexes] = self._check_chunk(uncached_morph_ratios[start_idx : start_idx + chunk_size])
+
+        for kidx in uncached_indexes:
+            self.check_results[result_keys[kidx]] = bool(is_unique_brokens[kidx])
+        while len(self.check_results) > CHECK_RESULT_CACHE_SIZE:
+            # 最も使われていない結果を捨てる
+            self.check_results.popitem(last=False)
+
+        return is_unique_brokens[inverse_indexes.reshape(-1)]
+
+    def get_buffers(self, frame_count: int) -> tuple[np.ndarray, np.ndarray, np.ndarray]:
+        """指定キーフレ数分の頂点変形量(符号あり・絶対値)と比較結果の作業領域(足りない場合だけ確保し直す)"""
+        if len(self.morph_vertices_buffer) < frame_count:
+            self.morph_vertices_buffer = np.zeros((frame_count, self.matrix.vertex_count * 3), dtype=self.dtype)
+            self.abs_morph_vertices_buffer = np.zeros((frame_count, self.matrix.vertex_count * 3), dtype=self.dtype)
+            self.compare_buffer = np.zeros((frame_count, self.matrix.vertex_count * 3), dtype=np.bool_)
+        return (
+            self.morph_vertices_buffer[:frame_count],
+            self.abs_morph_vertices_buffer[:frame_count],
+            self.compare_buffer[:frame_count].reshape(frame_count, -1, 3),
+        )
+
+    def _check_chunk(self, morph_ratios: np.ndarray) -> np.ndarray:
+        linear_morph_ratios = morph_ratios[:, self.linear_morph_indexes]
+        morph_vertices_buffer, abs_morph_vertices_buffer, compare_buffer = self.get_buffers(len(morph_ratios))
+        morph_vertices = self.matrix.dot(linear_morph_ratios, out=morph_vertices_buffer)
+        abs_morph_vertices = self.matrix.dot(linear_morph_ratios, is_abs=True, out=abs_morph_vertices_buffer)
+
+        for fidx, nonlinear_morph_ratios in enumerate(morph_ratios[:, self.nonlinear_morph_indexes]):
+            for midx, ratio in zip(self.nonlinear_morph_indexes, nonlinear_morph_ratios):
+                if np.isclose(ratio, 0.0):
+                    continue
+                assert self.offset_store is not None, "回転を含むボーンモーフを持つモーフの破綻チェックにはモーフ変形量ストアが必要です"
+                vertex_indexes, vertex_positions = self.offset_store.get_offsets(self.morph_names[midx], ratio)
+                vertex_indexes = np.searchsorted(self.support_vertex_indexes, vertex_indexes)
+                morph_vertices[fidx, vertex_indexes] += vertex_positions
+                abs_morph_vertices[fidx, vertex_indexes] += np.abs(vertex_positions)
+
+        # 比較結果は作業領域に書き込んで使い回す
+        np.greater(abs_morph_vertices, self.repair_thresholds, out=compare_buffer)
+        broken_vertex_counts = np.count_nonzero(np.any(compare_buffer, axis=2), axis=1)
+        # 符号ありの作業領域はここで使い終わるので、そのまま絶対値にする
+        np.greater(np.abs(morph_vertices, out=morph_vertices), MOVED_TOLERANCE, out=compare_buffer)
+        moved_vertex_counts = np.count_nonzero(np.any(compare_buffer, axis=2), axis=1)
+
+        # 最大・最小を超える頂点が一定数ある場合、破綻している可能性があるとみなす
+        return broken_vertex_counts >= moved_vertex_counts * 0.1
@@ -0,0 +1,301 @@
+import os
+from collections import OrderedDict
+from typing import Optional
+
+import numpy as np
+
+from mlib.core.logger import MLogger
+from mlib.pmx.pmx_collection import PmxModel
+from mlib.pmx.pmx_part import GroupMorphOffset, MorphType, VertexMorphOffset
+from mlib.vmd.vmd_collection import VmdMotion
+from mlib.vmd.vmd_part import VmdMorphFrame
+from service.usecase.skinning_matrix import SkinningMatrix
+
+logger = MLogger(os.path.basename(__file__), level=1)
+__ = logger.get_text
+
+
+# ボーンモーフの変形量キャッシュを保持する件数
+BONE_MORPH_CACHE_SIZE = 256
+# ボーンモーフの変形量キャッシュを保持する際の変形量の刻み
+BONE_MORPH_RATIO_STEP = 0.001
+
+
+class MorphOffsetStore:
+    """
+    モデル単位で保持するモーフ変形量ストア
+    頂点モーフはモーフ毎に頂点INDEXと変形量の配列として保持し、
+    グループモーフは子の頂点モーフに係数を掛けて展開した状態で保持する
+    移動だけのボーンモーフは変形量に比例するため、変形量1.0の時の頂点変形量を頂点モーフと同じく保持する
+    回転を含むボーンモーフは (モーフ名, 変形量) 毎の頂点変形量をLRUで保持する
+    """
+
+    def __init__(
+        self,
+        model: PmxModel,
+        cached_offsets: Optional[dict[str, tuple[np.ndarray, np.ndarray]]] = None,
+        skinning_matrix: Optional[SkinningMatrix] = None,
+    ) -> None:
+        """
+        cached_offsets: モデルキャッシュから読み込んだ頂点モーフ毎の頂点INDEXリストと頂点変形量リスト
+        skinning_matrix: モデルキャッシュから読み込んだスキニング行列(指定がない場合はここで生成する)
+        """
+        self.model = model
+        self.skinning_matrix = skinning_matrix or SkinningMatrix.create(model)
+        self.vertex_count = len(model.vertices)
+        self.vertex_offsets: dict[str, tuple[np.ndarray, np.ndarray]] = dict(cached_offsets or {})
+        self.linear_bone_morphs: dict[str, bool] = {}
+        self.bone_offsets: OrderedDict[tuple[str, int], tuple[np.ndarray, np.ndarray]] = OrderedDict()
+
+    def get_vertex_offsets(self, morph_name: str) -> tuple[np.ndarray, np.ndarray]:
+        """
+        モーフ変形量1.0の時の頂点INDEXリストと頂点変形量リスト(同じ頂点の変形量は合算済み)
+        変形量に比例する部分(頂点モーフ・移動だけのボーンモーフ)のみを含む
+        """
+        if morph_name not in self.vertex_offsets:
+            self.vertex_offsets[morph_name] = self._create_vertex_offsets(morph_name)
+        return self.vertex_offsets[morph_name]
+
+    def is_linear(self, morph_name: str) -> bool:
+        """変形量が比例するモーフであるか(回転を含むボーンモーフを持たないか)"""
+        return not self.get_nonlinear_bone_morphs(morph_name)
+
+    def get_nonlinear_bone_morphs(self, morph_name: str) -> list[tuple[str, float]]:
+        """回転を含むボーンモーフ(グループモーフの場合は子モーフ)の名前と係数のリスト"""
+        morph = self.model.morphs[morph_name]
+        if morph.morph_type == MorphType.BONE:
+            return [] if self.is_linear_bone_morph(morph.name) else [(morph.name, 1.0)]
+
+        nonlinear_bone_morphs: list[tuple[str, float]] = []
+        if morph.morph_type == MorphType.GROUP:
+            for offset in morph.offsets:
+                part_offset: GroupMorphOffset = offset
+                part_morph = self.model.morphs[part_offset.morph_index]
+                if part_morph.morph_type == MorphType.BONE and not self.is_linear_bone_morph(part_morph.name):
+                    nonlinear_bone_morphs.append((part_morph.name, part_offset.morph_factor))
+        return nonlinear_bone_morphs
+
+    def is_linear_bone_morph(self, morph_name: str) -> bool:
+        """移動だけのボーンモーフであるか"""
+        if morph_name not in self.linear_bone_morphs:
+            self.linear_bone_morphs[morph_name] = all(
+                np.allclose(bone_offset.rotation.to_euler_degrees().vector, 0.0) for bone_offset in self.model.morphs[morph_name].offsets
+            )
+        return self.linear_bone_morphs[morph_name]
+
+    def get_offsets(self, morph_name: str, ratio: float) -> tuple[np.ndarray, np.ndarray]:
+        """指定変形量の時の頂点INDEXリストと頂点変形量リスト"""
+        vertex_indexes, positions = self.get_vertex_offsets(morph_name)
+        nonlinear_bone_morphs = self.get_nonlinear_bone_morphs(morph_name)
+        if not nonlinear_bone_morphs:
+            return vertex_indexes, positions * ratio
+
+        part_vertex_indexes: list[np.ndarray] = [vertex_indexes]
+        part_positions: list[np.ndarray] = [positions * ratio]
+        for bone_morph_name, morph_factor in nonlinear_bone_morphs:
+            bone_vertex_indexes, bone_positions = self.get_bone_offsets(bone_morph_name, ratio * morph_factor)
+            part_vertex_indexes.append(bone_vertex_indexes)
+            part_positions.append(bone_positions)
+
+        return coalesce_offsets(np.concatenate(part_vertex_indexes), np.concatenate(part_positions))
+
+    def get_bone_offsets(self, morph_name: str, ratio: float) -> tuple[np.ndarray, np.ndarray]:
+        """ボーンモーフの指定変形量の時の頂点INDEXリストと頂点変形量リスト(変形量を丸めてキャッシュする)"""
+        key = (morph_name, int(round(ratio / BONE_MORPH_RATIO_STEP)))
+        if key in self.bone_offsets:
+            self.bone_offsets.move_to_end(key)
+            return self.bone_offsets[key]
+
+        bone_offsets = self._create_bone_offsets(morph_name, key[1] * BONE_MORPH_RATIO_STEP)
+        self.bone_offsets[key] = bone_offsets
+        if len(self.bone_offsets) > BONE_MORPH_CACHE_SIZE:
+            # 最も使われていないキャッシュを捨てる
+            self.bone_offsets.popitem(last=False)
+
+        return bone_offsets
+
+    def create_matrix(self, morph_names: list[str], support_vertex_indexes: Optional[np.ndarray] = None) -> "MorphOffsetMatrix":
+        """
+        指定モーフの頂点変形量を疎行列にまとめる
+        support_vertex_indexes: 行とする頂点INDEXリスト(昇順、指定がない場合は全頂点)
+            指定モーフの変形対象頂点を全て含んでいること。行の頂点はこのリスト内の位置になる
+        """
+        morph_offsets = [self.get_vertex_offsets(morph_name) for morph_name in morph_names]
+        if support_vertex_indexes is None:
+            return MorphOffsetMatrix.create(self.vertex_count, morph_offsets)
+
+        return MorphOffsetMatrix.create(
+            len(support_vertex_indexes),
+            [(np.searchsorted(support_vertex_indexes, vertex_indexes), positions) for vertex_indexes, positions in morph_offsets],
+        )
+
+    def get_support_vertex_indexes(self, morph_names: list[str]) -> np.ndarray:
+        """指定モーフのいずれかで変形する可能性がある頂点INDEXリスト(昇順)"""
+        support_vertex_indexes: list[np.ndarray] = [np.zeros(0, dtype=np.int64)]
+        for morph_name in morph_names:
+            vertex_indexes, _ = self.get_vertex_offsets(morph_name)
+            support_vertex_indexes.append(vertex_indexes)
+            for bone_morph_name, _ in self.get_nonlinear_bone_morphs(morph_name):
+                # 回転を含むボーンモーフは、変形量によらず対象ボーンにウェイトが乗っている頂点が変形する
+                support_vertex_indexes.append(self.get_bone_vertex_indexes(bone_morph_name))
+        return np.unique(np.concatenate(support_vertex_indexes))
+
+    def get_bone_vertex_indexes(self, morph_name: str) -> np.ndarray:
+        """ボーンモーフの対象ボーンにウェイトが乗っている頂点INDEXリスト(昇順)"""
+        return self.skinning_matrix.get_vertex_indexes([bone_offset.bone_index for bone_offset in self.model.morphs[morph_name].offsets])
+
+    def _create_vertex_offsets(self, morph_name: str) -> tuple[np.ndarray, np.ndarray]:
+        morph = self.model.morphs[morph_name]
+        vertex_indexes: list[int] = []
+        positions: list[np.ndarray] = []
+
+        if morph.morph_type == MorphType.VERTEX:
+            for offset in morph.offsets:
+                vertex_offset: VertexMorphOffset = offset
+                vertex_indexes.append(vertex_offset.vertex_index)
+                positions.append(vertex_offset.position.vector)
+
+        elif morph.morph_type == MorphType.BONE:
+            if self.is_linear_bone_morph(morph.name):
+                bone_vertex_indexes, bone_positions = self._create_bone_offsets(morph.name, 1.0)
+                vertex_indexes.extend(bone_vertex_indexes.tolist())
+                positions.extend(bone_positions)
+
+        elif morph.morph_type == MorphType.GROUP:
+            for offset in morph.offsets:
+                part_offset: GroupMorphOffset = offset
+                part_morph = self.model.morphs[part_offset.morph_index]
+                if part_morph.morph_type == MorphType.VERTEX:
+                    for part_vertex_offset in part_morph.offsets:
+                        vertex_indexes.append(part_vertex_offset.vertex_index)
+                        # グループモーフの係数を掛けた変形量を子モーフの変形量とする
+                        positions.append(part_vertex_offset.position.vector * part_offset.morph_factor)
+                elif part_morph.morph_type == MorphType.BONE and self.is_linear_bone_morph(part_morph.name):
+                    bone_vertex_indexes, bone_positions = self._create_bone_offsets(part_morph.name, 1.0)
+                    vertex_indexes.extend(bone_vertex_indexes.tolist())
+                    positions.extend(bone_positions * part_offset.morph_factor)
+
+        if not vertex_indexes:
+            return np.zeros(0, dtype=np.int64), np.zeros((0, 3))
+
+        return coalesce_offsets(np.array(vertex_indexes, dtype=np.int64), np.array(positions))
+
+    def _create_bone_offsets(self, morph_name: str, ratio: float) -> tuple[np.ndarray, np.ndarray]:
+        """ボーンモーフを実際に変形させて頂点変形量を求める"""
+        morph = self.model.morphs[morph_name]
+
+        motion = VmdMotion()
+        motion.morphs[morph.name].append(VmdMorphFrame(0, morph.name, ratio))
+        morph_matrixes = motion.animate_bone([0], self.model)
+
+        # ボーンモーフの対象ボーンにウェイトが乗っている頂点だけを変形する
+        vertex_indexes = self.get_bone_vertex_indexes(morph.name)
+
+        bone_matrixes = np.tile(np.eye(4), (self.skinning_matrix.bone_count, 1, 1))
+        for bone_index in self.skinning_matrix.get_bone_indexes(vertex_indexes).tolist():
+            bone_matrixes[bone_index] = morph_matrixes[0, self.model.bones[bone_index].name].local_matrix.vector
+
+        # 変形後の頂点位置の差分を保持
+        positions = self.skinning_matrix.deform(vertex_indexes, bone_matrixes, np.zeros((len(vertex_indexes), 3)))
+
+        return vertex_indexes, positions
+
+
+def coalesce_offsets(vertex_indexes: np.ndarray, positions: np.ndarray) -> tuple[np.ndarray, np.ndarray]:
+    """同じ頂点への変形量を合算する"""
+    unique_vertex_indexes, inverse_indexes = np.unique(vertex_indexes, return_inverse=True)
+    unique_positions = np.zeros((len(unique_vertex_indexes), 3))
+    np.add.at(unique_positions, inverse_indexes, positions)
+
+    return unique_vertex_indexes, unique_positions
+
+
+class MorphOffsetMatrix:
+    """
+    複数モーフの頂点変形量を (頂点×軸) 行 × モーフ列 の疎行列(CSR)として保持する
+    キーフレのモーフ変形量ベクトルとの積で、全モーフの頂点変形量の合計を一度に求める
+    """
+
+    def __init__(self, vertex_count: int, rows: np.ndarray, indptr: np.ndarray, cols: np.ndarray, values: np.ndarray) -> None:
+        """
+        vertex_count: 頂点数
+        rows: 要素を持つ行(頂点INDEX*3+軸)のリスト
+        indptr: 行毎の要素の開始位置
+        cols: 要素毎のモーフ列INDEX
+        values: 要素毎の頂点変形量
+        """
+        self.vertex_count = vertex_count
+        self.rows = rows
+        self.indptr = indptr
+        self.cols = cols
+        self.values = values
+        self.abs_values = np.abs(values)
+
+    @classmethod
+    def create(cls, vertex_count: int, morph_offsets: list[tuple[np.ndarray, np.ndarray]]) -> "MorphOffsetMatrix":
+        """モーフ毎の頂点INDEXリストと頂点変形量リストから疎行列を生成する"""
+        entry_rows: list[np.ndarray] = [np.zeros(0, dtype=np.int64)]
+        entry_cols: list[np.ndarray] = [np.zeros(0, dtype=np.int64)]
+        entry_values: list[np.ndarray] = [np.zeros(0)]
+        for midx, (vertex_indexes, positions) in enumerate(morph_offsets):
+            # 行は頂点INDEX*3+軸
+            entry_rows.append((vertex_indexes[:, np.newaxis] * 3 + np.arange(3)).flatten())
+            entry_cols.append(np.full(len(vertex_indexes) * 3, midx, dtype=np.int64))
+            entry_values.append(positions.flatten())
+
+        rows = np.concatenate(entry_rows)
+        cols = np.concatenate(entry_cols)
+        values = np.concatenate(entry_values)
+
+        # 変形量がない要素は持たない
+        nonzero_mask = values != 0.0
+        rows = rows[nonzero_mask]
+        cols = cols[nonzero_mask]
+        values = values[nonzero_mask]
+
+        order = np.argsort(rows, kind="stable")
+        # 行ごとの開始位置
+        unique_rows, indptr = np.unique(rows[order], return_index=True)
+
+        return cls(vertex_count, unique_rows, indptr, cols[order], values[order])
+
+    @property
+    def arrays(self) -> dict[str, np.ndarray]:
+        """疎行列を構成する配列(別プロセスへの受け渡し用)"""
+        return {"rows": self.rows, "indptr": self.indptr, "cols": self.cols, "values": self.values}
+
+    def astype(self, dtype: np.dtype) -> "MorphOffsetMatrix":
+        """変形量を指定型で保持する疎行列(同じ型の場合はそのまま返す)"""
+        if self.values.dtype == dtype:
+            return self
+        return MorphOffsetMatrix(self.vertex_count, self.rows, self.indptr, self.cols, self.values.astype(dtype))
+
+    def dot(self, ratios: np.ndarray, is_abs: bool = False, out: Optional[np.ndarray] = None) -> np.ndarray:
+        """
+        モーフ変形量との積を求める(変形量の型で計算する)
+        ratios: モーフ変形量ベクトル (モーフ数) の場合は (頂点数, 3)、
+                モーフ変形量行列 (キーフレ数×モーフ数) の場合は (キーフレ数, 頂点数, 3) で返す
+        is_abs: モーフ毎の頂点変形量の絶対値の合計を求めるか否か
+        out: 結果を書き込む作業領域 (キーフレ数, 頂点数*3) (指定がない場合は確保する)
+        """
+        morph_ratios = np.atleast_2d(ratios).astype(self.values.dtype, copy=False)
+        if out is None:
+            morph_vertices = np.zeros((len(morph_ratios), self.vertex_count * 3), dtype=self.values.dtype)
+        else:
+            morph_vertices = out
+            morph_vertices.fill(0.0)
+
+        if len(self.rows):
+            # 要素毎のモーフ変形量 (要素数, キーフレ数) を取り出して、その領域に要素毎の積を書き込む
+            if is_abs:
+                products = np.abs(morph_ratios.T)[self.cols]
+                np.multiply(products, self.abs_values[:, np.newaxis], out=products)
+            else:
+                products = morph_ratios.T[self.cols]
+                np.multiply(products, self.values[:, np.newaxis], out=products)
+
+            morph_vertices[:, self.rows] = np.add.reduceat(products, self.indptr, axis=0).T
+
+        if ratios.ndim == 1:
+            return morph_vertices.reshape(-1, 3)
+        return morph_vertices.reshape(len(morph_ratios), -1, 3)
@@ -1,13 +1,20 @@
 import os
+from concurrent.futures import ProcessPoolExecutor
+from multiprocessing.shared_memory import SharedMemory
+from typing import Optional
 
 import numpy as np
+from numpy.typing import DTypeLike
 
 from mlib.core.logger import MLogger
-from mlib.core.math import MMatrix4x4, MVector3D
 from mlib.pmx.pmx_collection import PmxModel
-from mlib.pmx.pmx_part import BoneMorphOffset, GroupMorphOffset, MorphType, VertexMorphOffset
+from mlib.pmx.pmx_part import GroupMorphOffset, MorphType
 from mlib.vmd.vmd_collection import VmdMotion
 from mlib.vmd.vmd_part import VmdMorphFrame
+from service.usecase.config.morph_breakage_checker import DEFAULT_MEMORY_BUDGET, MorphBreakageChecker
+from service.usecase.config.morph_offset_store import MorphOffsetStore
+from service.usecase.model_cache import ModelCache
+from service.usecase.shared_arrays import SharedArrays, attach_shared_arrays
 
 logger = MLogger(os.path.basename(__file__), level=1)
 __ = logger.get_text
@@ -21,8 +28,18 @@ class RepairMorphUsecase:
         output_motion: VmdMotion,
         check_threshold: float,
         repair_factor: float,
+        offset_store: Optional[MorphOffsetStore] = None,
+        memory_budget: int = DEFAULT_MEMORY_BUDGET,
+        max_workers: Optional[int] = None,
+        dtype: DTypeLike = np.float64,
     ) -> None:
-        """モーフ破綻軽減"""
+        """
+        モーフ破綻軽減
+        offset_store: モデルのモーフ変形量ストア(指定がない場合はここで生成する)
+        memory_budget: 複数キーフレをまとめて破綻チェックする際の作業領域の上限(byte)
+        max_workers: 区間毎に並列で補正するプロセス数(指定がない場合はCPU数)
+        dtype: 破綻チェックで頂点変形量の計算に使う型(np.float32 の場合は作業領域が半分になる)
+        """
         # モーフによる変形があるキーフレ
         morph_fnos = sorted(set([mf.index for morph_name in motion.morphs.names for mf in motion.morphs[morph_name]]))
 
@@ -30,8 +47,6 @@ class RepairMorphUsecase:
             logger.warning("モーフによる変形があるキーフレが見つからなかったため、処理を中断します", decoration=MLogger.Decoration.BOX)
             return
 
-        model.update_vertices_by_bone()
-
         logger.info("チェック対象モーフ抽出", decoration=MLogger.Decoration.LINE)
 
         # グループモーフの場合、中身が頂点モーフかボーンモーフであるかのチェック
@@ -64,172 +79,394 @@ class RepairMorphUsecase:
                 target_morph_names.append(mfs.name)
                 continue
 
-        logger.info("モーフ最大変動量チェック", decoration=MLogger.Decoration.LINE)
-
-        # モーフの変形量1.0の時の変形を保持
-        morph_max_vertices: np.ndarray = np.zeros((len(target_morph_names), len(model.vertices), 3))
-
-        for midx, morph_name in enumerate(target_morph_names):
-            morph_max_vertices[midx] = self.get_vertex_positions(model, morph_name, 1.0)
+        if not offset_store:
+            offset_store = ModelCache().create_offset_store(model)
 
-        max_morph_vertex_positions = np.max(np.abs(morph_max_vertices), axis=0)
+        checker = MorphBreakageChecker.create(offset_store, target_morph_names, repair_factor, memory_budget, dtype)
 
         logger.info("モーフ破綻チェック", decoration=MLogger.Decoration.LINE)
 
-        for fidx, fno in enumerate(morph_fnos):
-            logger.count("モーフ破綻チェック", index=fidx, total_index_count=len(morph_fnos), display_block=100)
-
-            fno_morph_ratios: dict[str, float] = {}
-            fno_morph_reads: dict[str, bool] = {}
+        # 全キーフレのモーフ変形量行列 (キーフレ数×モーフ数)
+        morph_ratios = np.array([self.get_morph_ratios(motion, target_morph_names, fno) for fno in morph_fnos]).reshape(
+            len(morph_fnos), len(target_morph_names)
+        )
+        # モーフ変形量の合計が一定以上のキーフレだけチェックする
+        is_checks = np.sum(morph_ratios, axis=1) >= check_threshold
+
+        # 破綻の可能性があるキーフレをまとめて抽出する
+        broken_fnos = np.array(morph_fnos)[is_checks][checker.check(morph_ratios[is_checks])].tolist()
+        logger.info("破綻候補キーフレ [{d}件]", d=len(broken_fnos))
+
+        logger.info("モーフ破綻補正", decoration=MLogger.Decoration.LINE)
+
+        # 補正対象キーフレが重ならない区間に分ける
+        segments = self.split_segments(motion, target_morph_names, broken_fnos)
+        process_count = min(max_workers or os.cpu_count() or 1, len(segments))
+
+        if 1 < process_count and PARALLEL_MIN_FRAME_COUNT <= len(broken_fnos):
+            logger.info("モーフ破綻補正 並列処理 [区間: {s}][プロセス: {p}]", s=len(segments), p=process_count)
+            segment_repairs = self.repair_segments_parallel(motion, checker, target_morph_names, segments, check_threshold, process_count)
+        else:
+            segment_repairs = []
+            for sidx, segment_fnos in enumerate(segments):
+                logger.count("モーフ破綻補正", index=sidx, total_index_count=len(segments), display_block=100)
+                segment_repairs.append(self.repair_segment(motion, checker, target_morph_names, segment_fnos, check_threshold))
+
+        # 区間の順番で補正結果を反映する
+        for repairs in segment_repairs:
+            for repair in repairs:
+                motion.morphs[repair.morph_name][repair.key_fno].ratio = repair.repaired_ratio
+                # 出力は補正値のみ設定
+                output_motion.morphs[repair.morph_name].append(VmdMorphFrame(repair.key_fno, repair.morph_name, repair.repaired_ratio))
 
-            for morph_name in target_morph_names:
-                morph = model.morphs[morph_name]
-                if morph.morph_type in [MorphType.VERTEX, MorphType.BONE, MorphType.GROUP]:
-                    mf = motion.morphs[morph_name][fno]
-                    fno_morph_ratios[morph_name] = mf.ratio
-                    fno_morph_reads[morph_name] = mf.read
+                logger.info(
+                    "モーフ破綻補正[{f}][{m}][{m1}:{f1} ({r1:.3f} -> {r2:.3f})]",
+                    f=repair.fno,
+                    m=repair.morph_ratios_text,
+                    m1=repair.morph_name,
+                    f1=repair.key_fno,
+                    r1=repair.original_ratio,
+                    r2=repair.repaired_ratio,
+                )
 
-            if check_threshold > sum(list(fno_morph_ratios.values())):
-                continue
+    def split_segments(self, motion: VmdMotion, morph_names: list[str], fnos: list[int]) -> list[list[int]]:
+        """
+        補正で変更する可能性のあるキーフレ(前後のキーフレ)を共有するキーフレ同士を同じ区間にまとめる
+        区間同士は互いのモーフ変形量に影響しないため、独立して補正できる
+        """
+        # Union-Find で区間をまとめる
+        parents = list(range(len(fnos)))
+
+        def find(fidx: int) -> int:
+            while parents[fidx] != fidx:
+                parents[fidx] = parents[parents[fidx]]
+                fidx = parents[fidx]
+            return fidx
+
+        key_owners: dict[tuple[str, int], int] = {}
+        for fidx, fno in enumerate(fnos):
+            for morph_name in morph_names:
+                morph_start_fno, _, morph_end_fno = motion.morphs[morph_name].range_indexes(fno)
+                for key_fno in {morph_start_fno, morph_end_fno}:
+                    if np.isclose(motion.morphs[morph_name][key_fno].ratio, 0.0):
+                        # 変形量0のキーフレは補正されない
+                        continue
+                    key = (morph_name, key_fno)
+                    if key in key_owners:
+                        parents[find(fidx)] = find(key_owners[key])
+                    else:
+                        key_owners[key] = fidx
 
-            for _ in range(20):
-                morph_vertices: np.ndarray = np.zeros((len(target_morph_names), len(model.vertices), 3))
+        segments: dict[int, list[int]] = {}
+        for fidx, fno in enumerate(fnos):
+            segments.setdefault(find(fidx), []).append(fno)
 
-                for midx, (morph_name, ratio) in enumerate(fno_morph_ratios.items()):
-                    if np.isclose(ratio, 0.0):
-                        continue
-                    morph = model.morphs[morph_name]
-                    morph_vertices[midx] = self.get_vertex_positions(model, morph_name, ratio)
-
-                broken_vertex_indexes = np.unique(np.where(
-                    np.logical_and(
-                        np.sum(np.abs(morph_vertices), axis=0) > max_morph_vertex_positions * repair_factor,
-                        ~np.isclose(max_morph_vertex_positions * repair_factor, 0.0),
-                    )
-                )[0])
-
-                if len(broken_vertex_indexes) < len(np.unique(np.where(~np.isclose(np.sum(morph_vertices, axis=0), 0.0))[0])) * 0.1:
-                    # 破綻頂点が見つからなかった場合、終了
-                    break
+        # 区間の最初のキーフレ順に並べる
+        return sorted(segments.values(), key=lambda segment_fnos: segment_fnos[0])
 
-                # 最大・最小を超える頂点が一定数ある場合、破綻している可能性があるとみなす
-                key_morph_fnos: dict[str, int] = {}
-                key_morph_ratios: dict[str, float] = {}
-                key_morph_broken_vertices: dict[str, np.ndarray] = {}
-                for midx, (morph_name, ratio) in enumerate(fno_morph_ratios.items()):
-                    if np.isclose(ratio, 0.0):
-                        continue
-                    morph_start_fno, _, morph_end_fno = motion.morphs[morph_name].range_indexes(fno)
-                    # 絶対値で大きい方の変化量を採用する
-                    abs_ratios = [
-                        np.abs(motion.morphs[morph_name][morph_start_fno].ratio),
-                        np.abs(motion.morphs[morph_name][morph_end_fno].ratio),
-                    ]
-                    morph_ratio = np.max(abs_ratios)
-                    morph_flg = np.argmax(abs_ratios)
-                    key_morph_fnos[morph_name] = morph_start_fno if morph_flg == 0 else morph_end_fno
-                    key_morph_ratios[morph_name] = morph_ratio
-                    key_morph_broken_vertices[morph_name] = np.unique(np.where(morph_vertices[midx, broken_vertex_indexes] != 0.0)[0])
-
-                # 破綻頂点があるモーフのうち、1番目に変化量が大きいモーフ名(ただしまばたきは除く)
-                target_ratio_morph_names = [
-                    m for m, r in key_morph_ratios.items() if not np.isclose(r, 0.0) and m not in IGNORE_MORPH_NAMES
-                ]
-                target_ratio_morph_ratios = [
-                    r for m, r in key_morph_ratios.items() if not np.isclose(r, 0.0) and m not in IGNORE_MORPH_NAMES
+    def repair_segments_parallel(
+        self,
+        motion: VmdMotion,
+        checker: MorphBreakageChecker,
+        morph_names: list[str],
+        segments: list[list[int]],
+        check_threshold: float,
+        process_count: int,
+    ) -> list[list["MorphRepair"]]:
+        """
+        区間毎の補正を別プロセスで行う(モーフ変形量は共有メモリで受け渡す)
+        回転を含むボーンモーフを持つモーフの変形量を求め直すにはモデルが必要なため、別プロセスにはモデルを渡さず、
+        そのモーフが変形している区間だけは別プロセスの処理を待つ間に親プロセスで補正する
+        """
+        # 回転を含むボーンモーフを持つモーフがどのキーフレでも変形していない区間だけ別プロセスで補正する
+        # (変形量0のモーフは破綻チェックで変形量を求めず、補正対象にも選ばれない)
+        is_parallels = [self.is_linear_segment(motion, checker, morph_names, segment_fnos) for segment_fnos in segments]
+        parallel_segments = [segment_fnos for segment_fnos, is_parallel in zip(segments, is_parallels) if is_parallel]
+        if not parallel_segments:
+            return [self.repair_segment(motion, checker, morph_names, segment_fnos, check_threshold) for segment_fnos in segments]
+
+        # チェック対象モーフのキーフレだけを別プロセスに渡す
+        morph_motion = VmdMotion()
+        for morph_name in morph_names:
+            for mf in motion.morphs[morph_name]:
+                morph_motion.morphs[morph_name].append(mf.copy())
+
+        shared_arrays = SharedArrays(checker.arrays)
+        try:
+            with ProcessPoolExecutor(
+                max_workers=min(process_count, len(parallel_segments)),
+                initializer=initialize_repair_process,
+                initargs=(morph_motion, morph_names, shared_arrays.specs, check_threshold, checker.memory_budget),
+            ) as executor:
+                parallel_repairs = executor.map(repair_segment_process, parallel_segments)
+
+                # 区間同士は独立しているので、別プロセスの処理中に親プロセスで残りの区間を補正する
+                serial_repairs = [
+                    self.repair_segment(motion, checker, morph_names, segment_fnos, check_threshold)
+                    for segment_fnos, is_parallel in zip(segments, is_parallels)
+                    if not is_parallel
                 ]
 
-                if not target_ratio_morph_names or not target_ratio_morph_ratios:
-                    # 見つからなかった場合、まばたき等を含めてチェックする
-                    target_ratio_morph_names = [m for m, r in key_morph_ratios.items() if not np.isclose(r, 0.0)]
-                    target_ratio_morph_ratios = [r for r in key_morph_ratios.values() if not np.isclose(r, 0.0)]
+                # 区間の順番に戻す
+                parallel_repair_iter = iter(parallel_repairs)
+                serial_repair_iter = iter(serial_repairs)
+                return [next(parallel_repair_iter) if is_parallel else next(serial_repair_iter) for is_parallel in is_parallels]
+        finally:
+            shared_arrays.close()
 
-                if not target_ratio_morph_names or not target_ratio_morph_ratios:
-                    # それでも見つからなかった場合、スルー
-                    continue
+    def is_linear_segment(self, motion: VmdMotion, checker: MorphBreakageChecker, morph_names: list[str], fnos: list[int]) -> bool:
+        """区間内のどのキーフレでも、回転を含むボーンモーフを持つモーフが変形していないか"""
+        return all(
+            np.isclose(motion.morphs[morph_names[midx]][fno].ratio, 0.0) for midx in checker.nonlinear_morph_indexes for fno in fnos
+        )
 
-                max_ratio_morph_name = target_ratio_morph_names[np.argmax(np.abs(target_ratio_morph_ratios))]
-                target_fno = key_morph_fnos[max_ratio_morph_name]
-                target_morph_original_ratio = motion.morphs[max_ratio_morph_name][target_fno].ratio
-                motion.morphs[max_ratio_morph_name][target_fno].ratio *= 0.9
-                # 出力は補正値のみ設定
-                output_motion.morphs[max_ratio_morph_name].append(
-                    VmdMorphFrame(target_fno, max_ratio_morph_name, target_morph_original_ratio * 0.9)
+    def repair_segment(
+        self,
+        motion: VmdMotion,
+        checker: MorphBreakageChecker,
+        morph_names: list[str],
+        fnos: list[int],
+        check_threshold: float,
+    ) -> list["MorphRepair"]:
+        """区間内のキーフレを順番に補正する"""
+        repairs: list[MorphRepair] = []
+        for fno in fnos:
+            repairs.extend(self.repair_frame(motion, checker, morph_names, fno, check_threshold))
+        return repairs
+
+    def repair_frame(
+        self,
+        motion: VmdMotion,
+        checker: MorphBreakageChecker,
+        morph_names: list[str],
+        fno: int,
+        check_threshold: float,
+    ) -> list["MorphRepair"]:
+        """
+        指定キーフレの破綻を補正する
+        モーションのキーフレの変形量を直接補正し、補正内容を返す
+        """
+        repairs: list[MorphRepair] = []
+        fno_morph_ratios = dict(zip(morph_names, self.get_morph_ratios(motion, morph_names, fno)))
+
+        if check_threshold > sum(list(fno_morph_ratios.values())):
+            return repairs
+
+        repair_count = 0
+        while repair_count < REPAIR_MAX_COUNT:
+            if not checker.check(np.array([list(fno_morph_ratios.values())]))[0]:
+                # 破綻頂点が見つからなかった場合、終了
+                break
+
+            # 最大・最小を超える頂点が一定数ある場合、破綻している可能性があるとみなす
+            key_morph_fnos: dict[str, int] = {}
+            key_morph_ratios: dict[str, float] = {}
+            # 採用しなかった方のキーフレの変形量(絶対値)と、採用したのが前のキーフレであるか
+            other_key_morph_ratios: dict[str, tuple[float, bool]] = {}
+            for morph_name, ratio in fno_morph_ratios.items():
+                if np.isclose(ratio, 0.0):
+                    continue
+                morph_start_fno, _, morph_end_fno = motion.morphs[morph_name].range_indexes(fno)
+                # 絶対値で大きい方の変化量を採用する
+                abs_ratios = [
+                    np.abs(motion.morphs[morph_name][morph_start_fno].ratio),
+                    np.abs(motion.morphs[morph_name][morph_end_fno].ratio),
+                ]
+                morph_ratio = np.max(abs_ratios)
+                morph_flg = np.argmax(abs_ratios)
+                key_morph_fnos[morph_name] = morph_start_fno if morph_flg == 0 else morph_end_fno
+                key_morph_ratios[morph_name] = morph_ratio
+                other_key_morph_ratios[morph_name] = (
+                    0.0 if morph_start_fno == morph_end_fno else float(abs_ratios[1 - morph_flg]),
+                    morph_flg == 0,
                 )
 
-                logger.info(
-                    "モーフ破綻補正[{f}][{m}][{m1}:{f1} ({r1:.3f} -> {r2:.3f})]",
-                    f=fno,
-                    m=", ".join([f"{m}({r:.3f})" for m, r in fno_morph_ratios.items() if not np.isclose(r, 0.0)]),
-                    m1=max_ratio_morph_name,
-                    f1=key_morph_fnos[max_ratio_morph_name],
-                    r1=target_morph_original_ratio,
-                    r2=motion.morphs[max_ratio_morph_name][key_morph_fnos[max_ratio_morph_name]].ratio,
+            # 破綻頂点があるモーフのうち、1番目に変化量が大きいモーフ名(ただしまばたきは除く)
+            target_ratio_morph_names = [m for m, r in key_morph_ratios.items() if not np.isclose(r, 0.0) and m not in IGNORE_MORPH_NAMES]
+            target_ratio_morph_ratios = [r for m, r in key_morph_ratios.items() if not np.isclose(r, 0.0) and m not in IGNORE_MORPH_NAMES]
+
+            if not target_ratio_morph_names or not target_ratio_morph_ratios:
+                # 見つからなかった場合、まばたき等を含めてチェックする
+                target_ratio_morph_names = [m for m, r in key_morph_ratios.items() if not np.isclose(r, 0.0)]
+                target_ratio_morph_ratios = [r for r in key_morph_ratios.values() if not np.isclose(r, 0.0)]
+
+            if not target_ratio_morph_names or not target_ratio_morph_ratios:
+                # それでも見つからなかった場合、補正できないので終了
+                break
+
+            max_ratio_morph_name = target_ratio_morph_names[np.argmax(np.abs(target_ratio_morph_ratios))]
+            target_fno = key_morph_fnos[max_ratio_morph_name]
+
+            # 補正後も同じモーフの同じキーフレが選ばれ続ける条件 (変形量(絶対値)の下限, 下限と同じ値を含まないか)
+            # 同じ変形量の場合は、モーフ名リストで先のモーフ・前のキーフレが選ばれる
+            other_key_ratio, is_start_key = other_key_morph_ratios[max_ratio_morph_name]
+            limit_ratios: list[tuple[float, bool]] = [(other_key_ratio, not is_start_key)]
+            max_ratio_morph_index = morph_names.index(max_ratio_morph_name)
+            for morph_name, ratio in zip(target_ratio_morph_names, target_ratio_morph_ratios):
+                if morph_name != max_ratio_morph_name:
+                    limit_ratios.append((float(np.abs(ratio)), morph_names.index(morph_name) < max_ratio_morph_index))
+
+            # 破綻が解消するか、別のキーフレが選ばれるまでの補正回数を、候補をまとめてチェックして探す
+            repair_step = self.solve_repair_step(
+                motion,
+                checker,
+                fno_morph_ratios,
+                max_ratio_morph_name,
+                target_fno,
+                fno,
+                limit_ratios,
+                REPAIR_MAX_COUNT - repair_count,
+            )
+
+            target_morph_original_ratio = motion.morphs[max_ratio_morph_name][target_fno].ratio
+            for _ in range(repair_step):
+                # 1回ずつ補正した場合と同じ値になるよう、係数を順番に掛ける
+                motion.morphs[max_ratio_morph_name][target_fno].ratio *= REPAIR_RATIO
+            repair_count += repair_step
+
+            repairs.append(
+                MorphRepair(
+                    fno,
+                    max_ratio_morph_name,
+                    target_fno,
+                    target_morph_original_ratio,
+                    motion.morphs[max_ratio_morph_name][target_fno].ratio,
+                    ", ".join([f"{m}({r:.3f})" for m, r in fno_morph_ratios.items() if not np.isclose(r, 0.0)]),
                 )
+            )
 
-                # 再チェックのため、取り直す
-                fno_morph_ratios = {}
-                fno_morph_reads = {}
-
-                for morph_name in target_morph_names:
-                    morph = model.morphs[morph_name]
-                    if morph.morph_type in [MorphType.VERTEX, MorphType.BONE, MorphType.GROUP]:
-                        mf = motion.morphs[morph_name][fno]
-                        fno_morph_ratios[morph_name] = mf.ratio
-                        fno_morph_reads[morph_name] = mf.read
+            # 再チェックのため、取り直す
+            fno_morph_ratios = dict(zip(morph_names, self.get_morph_ratios(motion, morph_names, fno)))
 
-    def get_vertex_positions(self, model: PmxModel, morph_name: str, ratio: float) -> np.ndarray:
-        morph = model.morphs[morph_name]
-        morph_vertices: np.ndarray = np.zeros((len(model.vertices), 3))
-
-        if morph.morph_type == MorphType.VERTEX:
-            for offset in morph.offsets:
-                vertex_offset: VertexMorphOffset = offset
-                morph_vertices[vertex_offset.vertex_index] += (vertex_offset.position * ratio).vector
-
-        elif morph.morph_type == MorphType.BONE:
-            motion = VmdMotion()
-            motion.morphs[morph.name].append(VmdMorphFrame(0, morph.name, ratio))
-            morph_matrixes = motion.animate_bone([0], model)
-
-            for offset in morph.offsets:
-                bone_offset: BoneMorphOffset = offset
-                bone_vertices = model.vertices_by_bones.get(bone_offset.bone_index, [])
-                for bone_vertex_index in bone_vertices:
-                    vertex = model.vertices[bone_vertex_index]
-                    mat = np.zeros((4, 4))
-                    for bone_index, bone_weight in zip(vertex.deform.indexes, vertex.deform.weights):
-                        mat += morph_matrixes[0, model.bones[bone_index].name].local_matrix.vector * bone_weight
-                    # 変形後の頂点位置の差分を保持
-                    morph_vertices[bone_vertex_index] += (MMatrix4x4(mat) * MVector3D()).vector
-
-        elif morph.morph_type == MorphType.GROUP:
-            for offset in morph.offsets:
-                part_offset: GroupMorphOffset = offset
-                part_morph = model.morphs[part_offset.morph_index]
-                if part_morph.morph_type == MorphType.VERTEX:
-                    for vertex_offset in part_morph.offsets:
-                        if vertex_offset.vertex_index not in morph_vertices:
-                            morph_vertices[vertex_offset.vertex_index] = np.zeros(3)
-                        morph_vertices[vertex_offset.vertex_index] += vertex_offset.position.vector
-
-                elif part_morph.morph_type == MorphType.BONE:
-                    motion = VmdMotion()
-                    motion.morphs[part_morph.name].append(VmdMorphFrame(0, part_morph.name, ratio))
-                    morph_matrixes = motion.animate_bone([0], model)
-
-                    for bone_offset in part_morph.offsets:
-                        bone_vertices = model.vertices_by_bones.get(bone_offset.bone_index, [])
-                        for bone_vertex_index in bone_vertices:
-                            vertex = model.vertices[bone_vertex_index]
-                            mat = np.zeros((4, 4))
-                            for bone_index, bone_weight in zip(vertex.deform.indexes, vertex.deform.weights):
-                                mat += morph_matrixes[0, model.bones[bone_index].name].local_matrix.vector * bone_weight
-                            # 変形後の頂点位置の差分を保持
-                            morph_vertices[bone_vertex_index] += (MMatrix4x4(mat) * MVector3D()).vector
-
-        return morph_vertices
+        return repairs
 
+    def solve_repair_step(
+        self,
+        motion: VmdMotion,
+        checker: MorphBreakageChecker,
+        fno_morph_ratios: dict[str, float],
+        morph_name: str,
+        key_fno: int,
+        fno: int,
+        limit_ratios: list[tuple[float, bool]],
+        max_step: int,
+    ) -> int:
+        """
+        補正対象モーフのキーフレの変形量に続けて何回 REPAIR_RATIO を掛けるかを探索する
+        1回ずつ補正する場合に、破綻が解消するか、別のモーフ・キーフレが補正対象に選ばれるまでの回数と同じになる
+        解析的に解くのではなく、補正回数の上限までの候補を1つの変形量行列にまとめて破綻チェックし、最初に解消する回数を選ぶ
+        モーフの変形量はキーフレ間で線形補間されるため、補正対象キーフレの変形量を s 倍した時の
+        チェック対象キーフレの変形量は a + b * s となり、候補の変形量行列はボーン変形なしで作れる
+        (回転を含むボーンモーフも、変形量の補間は線形なので破綻チェックに任せられる)
+        limit_ratios: 補正後も同じキーフレが選ばれ続ける条件 (変形量(絶対値)の下限, 下限と同じ値を含まないか) のリスト
+        max_step: 補正回数の上限
+        """
+        key_mf = motion.morphs[morph_name][key_fno]
+        key_ratio = key_mf.ratio
+
+        # キーフレの変形量を0にした時の変形量から、補間の係数を求める
+        key_mf.ratio = 0.0
+        a = motion.morphs[morph_name][fno].ratio
+        key_mf.ratio = key_ratio
+        b = fno_morph_ratios[morph_name] - a
+
+        # 1回ずつ補正した場合と同じ丸め誤差になるよう、係数を順番に掛ける
+        key_ratios = np.cumprod(np.concatenate([[key_ratio], np.full(max_step, REPAIR_RATIO)]))[1:]
+        scales = key_ratios / key_ratio
+        fno_ratios = a + b * scales
+
+        # 補正後も同じキーフレが選ばれる間だけ続けて補正する
+        abs_key_ratios = np.abs(key_ratios)
+        is_selectables = ~np.isclose(abs_key_ratios, 0.0) & ~np.isclose(fno_ratios, 0.0)
+        for limit_ratio, is_strict in limit_ratios:
+            is_selectables &= (abs_key_ratios > limit_ratio) if is_strict else (abs_key_ratios >= limit_ratio)
+
+        switch_steps = np.where(~is_selectables)[0]
+        if len(switch_steps):
+            fno_ratios = fno_ratios[: switch_steps[0] + 1]
+
+        morph_ratios = np.tile(np.array(list(fno_morph_ratios.values())), (len(fno_ratios), 1))
+        morph_ratios[:, list(fno_morph_ratios.keys()).index(morph_name)] = fno_ratios
+
+        repaired_steps = np.where(~checker.check(morph_ratios))[0]
+        if len(repaired_steps):
+            # 破綻が解消する最小の補正回数
+            return int(repaired_steps[0]) + 1
+
+        return len(fno_ratios)
+
+    def get_morph_ratios(self, motion: VmdMotion, morph_names: list[str], fno: int) -> list[float]:
+        """指定キーフレのモーフ変形量リスト"""
+        return [motion.morphs[morph_name][fno].ratio for morph_name in morph_names]
+
+
+class MorphRepair:
+    def __init__(
+        self,
+        fno: int,
+        morph_name: str,
+        key_fno: int,
+        original_ratio: float,
+        repaired_ratio: float,
+        morph_ratios_text: str,
+    ) -> None:
+        """
+        モーフ破綻補正内容
+        fno: 破綻していたキーフレ
+        morph_name: 補正したモーフ名
+        key_fno: 補正したモーフのキーフレ
+        original_ratio: 補正前の変形量
+        repaired_ratio: 補正後の変形量
+        morph_ratios_text: 破綻していたキーフレのモーフ変形量(ログ出力用)
+        """
+        self.fno = fno
+        self.morph_name = morph_name
+        self.key_fno = key_fno
+        self.original_ratio = original_ratio
+        self.repaired_ratio = repaired_ratio
+        self.morph_ratios_text = morph_ratios_text
+
+
+# 別プロセスで保持する補正用データ
+_process_motion: VmdMotion = VmdMotion()
+_process_checker: Optional[MorphBreakageChecker] = None
+_process_morph_names: list[str] = []
+_process_check_threshold: float = 0.0
+_process_memories: list[SharedMemory] = []
+
+
+def initialize_repair_process(
+    motion: VmdMotion,
+    morph_names: list[str],
+    specs: dict[str, tuple[str, tuple[int, ...], str]],
+    check_threshold: float,
+    memory_budget: int,
+) -> None:
+    """
+    補正用プロセスの初期化(共有メモリ上のモーフ変形量を参照する)
+    モデルは受け渡さないため、回転を含むボーンモーフを持つモーフが変形していない区間だけを補正できる
+    """
+    global _process_motion, _process_checker, _process_morph_names, _process_check_threshold, _process_memories
+
+    arrays, _process_memories = attach_shared_arrays(specs)
+    _process_motion = motion
+    _process_checker = MorphBreakageChecker.from_arrays(morph_names, arrays, memory_budget)
+    _process_morph_names = morph_names
+    _process_check_threshold = check_threshold
+
+
+def repair_segment_process(fnos: list[int]) -> list[MorphRepair]:
+    """別プロセスでの区間の補正"""
+    assert _process_checker is not None, "initialize_repair_process が呼ばれていません"
+    return RepairMorphUsecase().repair_segment(_process_motion, _process_checker, _process_morph_names, fnos, _process_check_threshold)
+
+
+# 並列処理を行う最低限の補正対象キーフレ数
+PARALLEL_MIN_FRAME_COUNT = 30
+# 1回の補正でキーフレの変形量に掛ける係数
+REPAIR_RATIO = 0.9
+# 1キーフレあたりの補正回数の上限
+REPAIR_MAX_COUNT = 20
 
 # 調整対象外モーフ
 IGNORE_MORPH_NAMES = [
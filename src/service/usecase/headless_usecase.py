@@ -0,0 +1,356 @@
+import json
+import multiprocessing
+import os
+import traceback
+from concurrent.futures import ProcessPoolExecutor
+from datetime import datetime
+from multiprocessing.context import BaseContext
+from time import perf_counter
+from typing import Any, Optional
+
+import numpy as np
+
+from mlib.core.exception import MApplicationException
+from mlib.core.logger import LoggingMode, MLogger
+from mlib.pmx.pmx_collection import PmxModel
+from mlib.utils.file_utils import separate_path
+from mlib.vmd.vmd_collection import VmdMotion
+from mlib.vmd.vmd_reader import VmdReader
+from service.usecase.bone_matrix_cache import DEFAULT_WINDOW_SIZE, BoneMatrixCache
+from service.usecase.config.blink_usecase import BLINK_CONDITIONS, BlinkConditions, BlinkUsecase
+from service.usecase.config.gaze_usecase import GazeUsecase
+from service.usecase.config.repair_morph_usecase import RepairMorphUsecase
+from service.usecase.load_usecase import LoadUsecase
+from service.usecase.model_cache import ModelCache
+from service.usecase.save_usecase import SaveUsecase
+
+logger = MLogger(os.path.basename(__file__), level=1)
+__ = logger.get_text
+
+
+class HeadlessStep:
+    """ヘッドレス実行で処理できる工程名"""
+
+    GAZE = "gaze"
+    BLINK = "blink"
+    REPAIR = "repair"
+
+
+HEADLESS_STEPS = [HeadlessStep.GAZE, HeadlessStep.BLINK, HeadlessStep.REPAIR]
+"""ヘッドレス実行のデフォルトの処理順"""
+
+
+class HeadlessConfig:
+    def __init__(self, values: dict[str, Any]) -> None:
+        """
+        ヘッドレス実行時の設定(設定タブの各値に相当し、省略した値は画面の初期値を使う)
+        values: 設定ファイルの内容
+        """
+        self.steps: list[str] = list(values.get("steps", HEADLESS_STEPS))
+        invalid_steps = [step for step in self.steps if step not in HEADLESS_STEPS]
+        if invalid_steps:
+            raise MApplicationException("設定ファイルの処理順に不明な工程が指定されています\n不明な工程: {s}", s=", ".join(invalid_steps))
+
+        self.output_dir: Optional[str] = values.get("output_dir")
+
+        gaze: dict[str, Any] = values.get("gaze", {})
+        self.gaze_infection = float(gaze.get("infection", 0.5))
+        self.gaze_ratio_x = float(gaze.get("ratio_x", 0.7))
+        self.gaze_limit_upper_x = int(gaze.get("limit_upper_x", 3))
+        self.gaze_limit_lower_x = int(gaze.get("limit_lower_x", -8))
+        self.gaze_ratio_y = float(gaze.get("ratio_y", 0.7))
+        self.gaze_limit_upper_y = int(gaze.get("limit_upper_y", 13))
+        self.gaze_limit_lower_y = int(gaze.get("limit_lower_y", -13))
+        self.gaze_reset_num = int(gaze.get("reset", 7))
+
+        blink: dict[str, Any] = values.get("blink", {})
+        # まばたき条件は BlinkConditions の名前(NORMAL など)で指定する
+        self.condition_probabilities: dict[str, float] = dict(BLINK_CONDITIONS)
+        for condition_key, probability in blink.get("conditions", {}).items():
+            if condition_key not in BlinkConditions.__members__:
+                raise MApplicationException("設定ファイルに不明なまばたき条件が指定されています\n不明な条件: {c}", c=condition_key)
+            self.condition_probabilities[BlinkConditions[condition_key].value.name] = float(probability)
+        self.linkage_depth = float(blink.get("linkage_depth", 0.5))
+        self.blink_span = int(blink.get("span", 60))
+
+        morph: dict[str, Any] = values.get("morph", {})
+        self.eyebrow_below_name = str(morph.get("eyebrow_below", "下"))
+        self.blink_name = str(morph.get("blink", "まばたき"))
+        self.smile_name = str(morph.get("smile", "笑い"))
+
+        repair: dict[str, Any] = values.get("repair", {})
+        self.check_threshold = float(repair.get("check_threshold", 0.8))
+        self.repair_factor = float(repair.get("factor", 1.2))
+        # 破綻チェックを単精度で計算するか(大きなモデルで作業領域を抑える)
+        self.repair_float32 = bool(repair.get("float32", False))
+
+        stream: dict[str, Any] = values.get("stream", {})
+        # 長尺モーションで一度に変形する時間窓の長さ(キーフレ番号の幅。0の場合は全キーフレをまとめて変形する)
+        # 区切るのはボーン変形だけで、モーションの読み書きと変動量は全キーフレ分をまとめて扱う
+        self.window_size = int(stream.get("window_size", DEFAULT_WINDOW_SIZE))
+
+    @classmethod
+    def read(cls, config_path: str) -> "HeadlessConfig":
+        """JSONもしくはTOMLの設定ファイルを読み込む"""
+        _, _, config_ext = separate_path(config_path)
+
+        if config_ext.lower() == ".toml":
+            try:
+                import tomllib
+            except ImportError:
+                raise MApplicationException("TOMLの設定ファイルはPython3.11以降でのみ読み込めます\n設定ファイル: {p}", p=config_path)
+
+            with open(config_path, "rb") as f:
+                return cls(tomllib.load(f))
+
+        with open(config_path, "r", encoding="utf-8") as f:
+            return cls(json.load(f))
+
+
+class HeadlessLoggerConfig:
+    def __init__(self, lang: str, root_dir: str, mode: int, level: int, is_out_log: int) -> None:
+        """
+        ヘッドレス実行時のロガーの設定(spawn で生成したプロセスでもロガーを同じ設定で初期化する)
+        mode: LoggingMode の値
+        その他の引数は MLogger.initialize と同じ
+        """
+        self.lang = lang
+        self.root_dir = root_dir
+        self.mode = mode
+        self.level = level
+        self.is_out_log = is_out_log
+
+    def initialize(self) -> None:
+        MLogger.initialize(self.lang, self.root_dir, LoggingMode(self.mode), level=self.level, is_out_log=self.is_out_log)
+
+
+class HeadlessUsecase:
+    def read_model(self, model_path: str) -> PmxModel:
+        """表情生成に使うモデルを読み込んで検証する"""
+        logger.info("人物: 読み込み開始", decoration=MLogger.Decoration.BOX)
+
+        model = ModelCache().read_model(model_path)
+        LoadUsecase().valid_model(model)
+
+        return model
+
+    def execute(self, model: PmxModel, motion_path: str, config: HeadlessConfig, repair_max_workers: Optional[int] = None) -> str:
+        """
+        モーションを読み込んで、設定の処理順に表情を生成して出力する
+        出力したモーションのパスを返す
+        repair_max_workers: モーフ破綻補正の並列プロセス数(指定がない場合はCPU数)
+        """
+        logger.info("モーション読み込み開始", decoration=MLogger.Decoration.BOX)
+
+        motion = LoadUsecase().valid_motion(VmdReader().read_by_filepath(motion_path))
+
+        output_path = self.create_output_path(model.path, motion_path, config.output_dir)
+        output_motion = VmdMotion(output_path)
+
+        # 目線生成・まばたき生成でボーン変形結果を共有する
+        bone_matrix_cache = BoneMatrixCache(config.window_size)
+
+        for step in config.steps:
+            if step == HeadlessStep.GAZE:
+                logger.info("目線生成開始", decoration=MLogger.Decoration.BOX)
+
+                GazeUsecase().create_gaze(
+                    model,
+                    motion,
+                    output_motion,
+                    config.gaze_infection,
+                    config.gaze_ratio_x,
+                    config.gaze_limit_upper_x,
+                    config.gaze_limit_lower_x,
+                    config.gaze_ratio_y,
+                    config.gaze_limit_upper_y,
+                    config.gaze_limit_lower_y,
+                    config.gaze_reset_num,
+                    bone_matrix_cache,
+                )
+            elif step == HeadlessStep.BLINK:
+                logger.info("まばたき生成開始", decoration=MLogger.Decoration.BOX)
+
+                BlinkUsecase().create_blink(
+                    model,
+                    motion,
+                    output_motion,
+                    config.condition_probabilities,
+                    config.linkage_depth,
+                    config.blink_span,
+                    config.eyebrow_below_name,
+                    config.blink_name,
+                    config.smile_name,
+                    bone_matrix_cache,
+                )
+            elif step == HeadlessStep.REPAIR:
+                logger.info("モーフ破綻補正開始", decoration=MLogger.Decoration.BOX)
+
+                RepairMorphUsecase().repair_morph(
+                    model,
+                    motion,
+                    output_motion,
+                    config.check_threshold,
+                    config.repair_factor,
+                    max_workers=repair_max_workers,
+                    dtype=np.float32 if config.repair_float32 else np.float64,
+                )
+
+        logger.info("モーション出力開始", decoration=MLogger.Decoration.BOX)
+
+        SaveUsecase().save(model, output_motion, output_path)
+
+        logger.info("*** モーション出力成功 ***\n出力先: {f}", f=output_path, decoration=MLogger.Decoration.BOX)
+
+        return output_path
+
+    def execute_batch(
+        self,
+        model: PmxModel,
+        motion_paths: list[str],
+        config: HeadlessConfig,
+        summary_path: str,
+        max_workers: Optional[int] = None,
+        logger_config: Optional[HeadlessLoggerConfig] = None,
+    ) -> list["HeadlessResult"]:
+        """
+        読み込み済みのモデルで複数モーションの表情をまとめて生成し、処理結果をサマリーファイルに出力する
+        max_workers: モーション毎に並列で処理するプロセス数(指定がない場合はCPU数)
+        logger_config: spawn で生成したプロセスのロガーの設定(fork の場合は親プロセスの設定を引き継ぐ)
+        """
+        start_time = perf_counter()
+        process_count = min(max_workers or os.cpu_count() or 1, len(motion_paths))
+
+        if 1 < process_count:
+            logger.info("一括表情生成 並列処理 [モーション: {m}][プロセス: {p}]", m=len(motion_paths), p=process_count)
+
+            if "fork" in multiprocessing.get_all_start_methods():
+                # fork できる環境では、モデルはプロセス生成時に親プロセスのメモリをそのまま引き継ぐ
+                initialize_headless_process(model, config)
+                context: BaseContext = multiprocessing.get_context("fork")
+                initargs: tuple = ()
+            else:
+                # fork できない環境では、プロセス毎に一度だけモデルを受け渡し、ロガーも初期化し直す
+                context = multiprocessing.get_context("spawn")
+                initargs = (model, config, logger_config)
+
+            with ProcessPoolExecutor(
+                max_workers=process_count,
+                mp_context=context,
+                initializer=initialize_headless_process,
+                initargs=initargs,
+            ) as executor:
+                results = list(executor.map(execute_headless_process, motion_paths))
+        else:
+            results = [self.execute_motion(model, motion_path, config) for motion_path in motion_paths]
+
+        self.save_summary(summary_path, model, results, perf_counter() - start_time)
+
+        return results
+
+    def execute_motion(
+        self, model: PmxModel, motion_path: str, config: HeadlessConfig, repair_max_workers: Optional[int] = None
+    ) -> "HeadlessResult":
+        """1モーションの表情生成を行い、処理時間とエラー内容を記録する"""
+        start_time = perf_counter()
+        try:
+            output_path = self.execute(model, motion_path, config, repair_max_workers)
+            return HeadlessResult(motion_path, output_path, perf_counter() - start_time, "")
+        except Exception:
+            logger.critical("表情生成で予期せぬエラーが発生しました。\nモーション: {p}", p=motion_path, decoration=MLogger.Decoration.BOX)
+            return HeadlessResult(motion_path, "", perf_counter() - start_time, traceback.format_exc())
+
+    def save_summary(self, summary_path: str, model: PmxModel, results: list["HeadlessResult"], process_time: float) -> None:
+        """
+        一括表情生成の処理結果をJSONで出力する
+        process_time: 一括表情生成全体の経過時間(秒)。並列処理の場合はモーション毎の処理時間の合計より短くなる
+        """
+        summary_dir_path = os.path.dirname(summary_path)
+        if summary_dir_path:
+            os.makedirs(summary_dir_path, exist_ok=True)
+
+        with open(summary_path, "w", encoding="utf-8") as f:
+            json.dump(
+                {
+                    "model": model.path,
+                    "success": len([result for result in results if result.is_success]),
+                    "failure": len([result for result in results if not result.is_success]),
+                    "process_time": round(process_time, 3),
+                    "motion_process_time": round(sum(result.process_time for result in results), 3),
+                    "motions": [result.to_dict() for result in results],
+                },
+                f,
+                ensure_ascii=False,
+                indent=2,
+            )
+
+        logger.info("一括表情生成結果出力: {f}", f=summary_path, decoration=MLogger.Decoration.LINE)
+
+    def create_summary_path(self, motion_paths: list[str], config: HeadlessConfig) -> str:
+        """出力先(指定がない場合は最初のモーションと同じフォルダ)のサマリーファイルパスを生成する"""
+        motion_dir_path, _, _ = separate_path(motion_paths[0])
+
+        return os.path.join(config.output_dir or motion_dir_path, f"Emotion_summary_{datetime.now():%Y%m%d_%H%M%S}.json")
+
+    def create_output_path(self, model_path: str, motion_path: str, output_dir: Optional[str]) -> str:
+        """ファイルタブと同じ命名規則で出力ファイルパスを生成する"""
+        _, model_file_name, _ = separate_path(model_path)
+        motion_dir_path, motion_file_name, motion_file_ext = separate_path(motion_path)
+
+        return os.path.join(
+            output_dir or motion_dir_path,
+            f"{motion_file_name}_Emotion_{model_file_name}_{datetime.now():%Y%m%d_%H%M%S}{motion_file_ext}",
+        )
+
+
+class HeadlessResult:
+    def __init__(self, motion_path: str, output_path: str, process_time: float, error: str) -> None:
+        """
+        1モーション分の一括表情生成結果
+        motion_path: 入力モーションパス
+        output_path: 出力モーションパス(失敗した場合は空)
+        process_time: 処理時間(秒)
+        error: エラー内容(成功した場合は空)
+        """
+        self.motion_path = motion_path
+        self.output_path = output_path
+        self.process_time = process_time
+        self.error = error
+
+    @property
+    def is_success(self) -> bool:
+        return not self.error
+
+    def to_dict(self) -> dict[str, Any]:
+        return {
+            "motion": self.motion_path,
+            "output": self.output_path,
+            "process_time": round(self.process_time, 3),
+            "error": self.error,
+        }
+
+
+# 別プロセスで保持する表情生成用データ
+_process_model: Optional[PmxModel] = None
+_process_config: Optional[HeadlessConfig] = None
+
+
+def initialize_headless_process(
+    model: Optional[PmxModel] = None, config: Optional[HeadlessConfig] = None, logger_config: Optional[HeadlessLoggerConfig] = None
+) -> None:
+    """表情生成用プロセスの初期化(fork した場合は親プロセスで設定済みのモデル・ロガーをそのまま使う)"""
+    global _process_model, _process_config
+
+    if logger_config is not None:
+        logger_config.initialize()
+    if model is not None:
+        _process_model = model
+    if config is not None:
+        _process_config = config
+
+
+def execute_headless_process(motion_path: str) -> HeadlessResult:
+    """別プロセスでの1モーションの表情生成"""
+    assert _process_model is not None and _process_config is not None, "initialize_headless_process が呼ばれていません"
+    # モーション単位で並列にしているので、モーフ破綻補正はプロセス内で直列に行う
+    return HeadlessUsecase().execute_motion(_process_model, motion_path, _process_config, repair_max_workers=1)
@@ -1,11 +1,15 @@
 import os
+import pickle
 
 from mlib.core.exception import MApplicationException
 from mlib.core.logger import MLogger
 from mlib.pmx.pmx_collection import PmxModel
+from mlib.pmx.pmx_reader import PmxReader
 from mlib.vmd.vmd_collection import VmdMotion
+from mlib.vmd.vmd_reader import VmdReader
 from mlib.vmd.vmd_tree import VmdBoneFrameTrees
 from service.usecase.config.blink_usecase import BLINK_CONDITIONS
+from service.usecase.model_cache import ModelCache
 
 logger = MLogger(os.path.basename(__file__), level=1)
 __ = logger.get_text
@@ -43,3 +47,13 @@ class LoadUsecase:
 
     def get_blink_conditions(self) -> dict[str, float]:
         return BLINK_CONDITIONS
+
+
+def read_model_process(reader: PmxReader, model_path: str) -> bytes:
+    """別プロセスでのモデル読み込み(モデルキャッシュがあれば解析しない。プロセス間で受け渡せるようpickle化したまま返す)"""
+    return ModelCache().read_model_bytes(model_path, reader)
+
+
+def read_motion_process(reader: VmdReader, motion_path: str) -> bytes:
+    """別プロセスでのモーション読み込み(モデルと同じくpickle化したまま返す)"""
+    return pickle.dumps(reader.read_by_filepath(motion_path), protocol=pickle.HIGHEST_PROTOCOL)
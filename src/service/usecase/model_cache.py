@@ -0,0 +1,267 @@
+import functools
+import hashlib
+import json
+import os
+import pickle
+import shutil
+from typing import Optional
+
+import numpy as np
+
+import mlib
+from mlib.core.logger import MLogger
+from mlib.pmx import pmx_collection, pmx_part, pmx_reader
+from mlib.pmx.pmx_collection import PmxModel
+from mlib.pmx.pmx_part import MorphType
+from mlib.pmx.pmx_reader import PmxReader
+from mlib.utils.file_utils import get_root_dir
+from service.usecase.config.morph_offset_store import MorphOffsetStore
+from service.usecase.skinning_matrix import SkinningMatrix
+
+logger = MLogger(os.path.basename(__file__), level=1)
+__ = logger.get_text
+
+# キャッシュの形式を変えた場合は上げる(古い形式のキャッシュは使わない)
+MODEL_CACHE_VERSION = 3
+# キャッシュディレクトリの容量の上限(byte)
+MODEL_CACHE_MAX_BYTES = 1024 * 1024 * 1024
+
+MODEL_CACHE_META_NAME = "meta.json"
+MODEL_CACHE_MODEL_NAME = "model.pkl"
+MODEL_CACHE_ARRAY_NAMES = [
+    "vertex_positions",
+    "skinning_indptr",
+    "skinning_bone_indexes",
+    "skinning_weights",
+    "morph_indptr",
+    "morph_vertex_indexes",
+    "morph_positions",
+]
+
+
+@functools.lru_cache(maxsize=None)
+def read_library_version() -> str:
+    """
+    モデル本体をpickle化しているライブラリ(mlib)の版
+    モデルのクラス定義が変わると古いpickleは正しく展開できないため、定義しているモジュールの内容から求める
+    プロセス中にモジュールは変わらないので、求めるのはプロセス毎に一度だけ
+    """
+    sha1 = hashlib.sha1(str(getattr(mlib, "__version__", "")).encode("utf-8"))
+    for module in (pmx_collection, pmx_part, pmx_reader):
+        try:
+            with open(str(module.__file__), "rb") as f:
+                sha1.update(f.read())
+        except OSError:
+            # 実行ファイルに同梱されていてソースが読めない場合はモジュール名だけで判定する
+            sha1.update(module.__name__.encode("utf-8"))
+    return sha1.hexdigest()
+
+
+class ModelCache:
+    """
+    読み込み済みモデルのディスクキャッシュ
+    読み込んだモデルのダイジェスト(model.digest)毎のディレクトリに、モデル本体(pickle)とボーン・モーフのメタ情報、
+    スキニング行列・頂点位置・頂点モーフ変形量の配列(.npy)を保存する
+    一度読み込んだモデルは解析せずに展開でき、配列はメモリマップで読むので並列プロセス間でページを共有できる
+    容量の上限を超えたら、最も使われていないモデルのキャッシュから削除する
+    """
+
+    def __init__(self, cache_dir: Optional[str] = None, max_bytes: int = MODEL_CACHE_MAX_BYTES) -> None:
+        self.cache_dir = cache_dir or os.path.join(get_root_dir(), "cache", "model")
+        self.max_bytes = max_bytes
+        self.library_version = read_library_version()
+
+    def get_dir(self, digest: str) -> str:
+        return os.path.join(self.cache_dir, digest)
+
+    def read_model_bytes(self, model_path: str, reader: Optional[PmxReader] = None) -> bytes:
+        """
+        モデルをpickle化した状態で取得する
+        キャッシュがあればそのまま返し、なければモデルを読み込んでキャッシュに保存する
+        reader: モデルの読み込み処理(指定がなければ標準の読み込み処理)
+        """
+        reader = reader or PmxReader()
+        # 読み込んだ時にモデルに設定されるダイジェストと同じ値でキャッシュを探す
+        digest = reader.read_hash_by_filepath(model_path)
+
+        model_bytes = self.read_cache(digest)
+        if model_bytes is not None:
+            logger.debug("モデルキャッシュ利用 [{d}]", d=digest)
+            return model_bytes
+
+        model = reader.read_by_filepath(model_path)
+        model_bytes = pickle.dumps(model, protocol=pickle.HIGHEST_PROTOCOL)
+        self.write_cache(model, model_bytes)
+
+        return model_bytes
+
+    def read_model(self, model_path: str, reader: Optional[PmxReader] = None) -> PmxModel:
+        return pickle.loads(self.read_model_bytes(model_path, reader))
+
+    def read_cache(self, digest: str) -> Optional[bytes]:
+        """キャッシュ済みのpickle化したモデル(キャッシュがない場合・形式が古い場合は None)"""
+        if self.read_meta(digest) is None:
+            return None
+
+        try:
+            with open(os.path.join(self.get_dir(digest), MODEL_CACHE_MODEL_NAME), "rb") as f:
+                return f.read()
+        except OSError:
+            return None
+
+    def read_meta(self, digest: str) -> Optional[dict]:
+        try:
+            with open(os.path.join(self.get_dir(digest), MODEL_CACHE_META_NAME), "r", encoding="utf-8") as f:
+                meta = json.load(f)
+        except (OSError, ValueError):
+            return None
+
+        if meta.get("version") != MODEL_CACHE_VERSION or meta.get("library_version") != self.library_version:
+            return None
+
+        # 使われた順に削除するため、使ったキャッシュのメタ情報の更新日時を更新する
+        try:
+            os.utime(os.path.join(self.get_dir(digest), MODEL_CACHE_META_NAME))
+        except OSError:
+            pass
+
+        return meta
+
+    def read_arrays(self, digest: str) -> Optional[dict[str, np.ndarray]]:
+        """
+        キャッシュ済みの配列をメモリマップで読み込む(キャッシュがない場合は None)
+        vertex_positions: 頂点位置 (頂点数, 3)
+        skinning_indptr, skinning_bone_indexes, skinning_weights: スキニング行列 (SkinningMatrix)
+        morph_indptr: meta の morph_names 順の頂点モーフ毎の開始位置 (モーフ数+1)
+        morph_vertex_indexes: 頂点モーフの頂点INDEX (同じ頂点の変形量は合算済み)
+        morph_positions: 頂点モーフの頂点変形量 (要素数, 3)
+        """
+        if self.read_meta(digest) is None:
+            return None
+
+        try:
+            return {
+                array_name: np.load(os.path.join(self.get_dir(digest), f"{array_name}.npy"), mmap_mode="r")
+                for array_name in MODEL_CACHE_ARRAY_NAMES
+            }
+        except (OSError, ValueError):
+            return None
+
+    def create_offset_store(self, model: PmxModel) -> MorphOffsetStore:
+        """
+        モーフ変形量ストアを生成する
+        キャッシュがあれば、頂点モーフの変形量とスキニング行列はキャッシュの配列をそのまま使う
+        """
+        if not model.digest:
+            return MorphOffsetStore(model)
+
+        meta = self.read_meta(model.digest)
+        arrays = self.read_arrays(model.digest)
+        if meta is None or arrays is None:
+            return MorphOffsetStore(model)
+
+        morph_offsets: dict[str, tuple[np.ndarray, np.ndarray]] = {}
+        morph_indptr = arrays["morph_indptr"]
+        for n, morph_name in enumerate(meta["morph_names"]):
+            start, end = morph_indptr[n], morph_indptr[n + 1]
+            morph_offsets[morph_name] = (arrays["morph_vertex_indexes"][start:end], arrays["morph_positions"][start:end])
+
+        return MorphOffsetStore(model, morph_offsets, SkinningMatrix.from_arrays(len(model.bones), arrays))
+
+    def write_cache(self, model: PmxModel, model_bytes: bytes) -> None:
+        """
+        モデルをキャッシュに保存する
+        途中で失敗しても読み込みには影響させない(壊れたキャッシュを残さないよう一時ディレクトリに書いてから置き換える)
+        """
+        digest = model.digest
+        cache_dir = self.get_dir(digest)
+        work_dir = f"{cache_dir}.{os.getpid()}.tmp"
+
+        try:
+            os.makedirs(work_dir, exist_ok=True)
+
+            with open(os.path.join(work_dir, MODEL_CACHE_MODEL_NAME), "wb") as f:
+                f.write(model_bytes)
+
+            morph_names, arrays = self.create_arrays(model)
+            for array_name, array in arrays.items():
+                np.save(os.path.join(work_dir, f"{array_name}.npy"), array)
+
+            # メタ情報は最後に書く(メタ情報がなければキャッシュとして使わない)
+            meta = {
+                "version": MODEL_CACHE_VERSION,
+                "library_version": self.library_version,
+                "digest": digest,
+                "path": model.path,
+                "vertex_count": len(model.vertices),
+                "bones": [{"index": bone.index, "name": bone.name, "parent_index": bone.parent_index} for bone in model.bones],
+                "morphs": [{"index": morph.index, "name": morph.name, "morph_type": int(morph.morph_type)} for morph in model.morphs],
+                "morph_names": morph_names,
+            }
+            with open(os.path.join(work_dir, MODEL_CACHE_META_NAME), "w", encoding="utf-8") as f:
+                json.dump(meta, f, ensure_ascii=False)
+
+            if os.path.exists(cache_dir):
+                shutil.rmtree(cache_dir, ignore_errors=True)
+            os.replace(work_dir, cache_dir)
+        except Exception:
+            logger.debug("モデルキャッシュ保存失敗 [{d}]", d=digest)
+            shutil.rmtree(work_dir, ignore_errors=True)
+            return
+
+        self.evict()
+
+    def evict(self) -> None:
+        """容量の上限を超えている場合、メタ情報の更新日時が古いモデルのキャッシュから削除する"""
+        try:
+            cache_dirs = []
+            for entry in os.scandir(self.cache_dir):
+                if not entry.is_dir() or entry.name.endswith(".tmp"):
+                    # 保存中のキャッシュは対象外
+                    continue
+                meta_path = os.path.join(entry.path, MODEL_CACHE_META_NAME)
+                mtime = os.path.getmtime(meta_path) if os.path.isfile(meta_path) else 0.0
+                size = sum(file_entry.stat().st_size for file_entry in os.scandir(entry.path) if file_entry.is_file())
+                cache_dirs.append((mtime, size, entry.path))
+        except OSError:
+            return
+
+        total_bytes = sum(size for _, size, _ in cache_dirs)
+        for _, size, cache_dir in sorted(cache_dirs):
+            if total_bytes <= self.max_bytes:
+                break
+            # 別プロセスで削除済みの場合もあるので、失敗しても続ける
+            shutil.rmtree(cache_dir, ignore_errors=True)
+            total_bytes -= size
+
+    def create_arrays(self, model: PmxModel) -> tuple[list[str], dict[str, np.ndarray]]:
+        """キャッシュに保存するスキニング行列(頂点位置を含む)と頂点モーフ変形量の配列"""
+        skinning_matrix = SkinningMatrix.create(model)
+
+        morph_names: list[str] = []
+        morph_indptr: list[int] = [0]
+        part_vertex_indexes: list[np.ndarray] = [np.zeros(0, dtype=np.int64)]
+        part_positions: list[np.ndarray] = [np.zeros((0, 3))]
+        for morph in model.morphs:
+            if morph.morph_type != MorphType.VERTEX:
+                continue
+
+            vertex_indexes = np.array([offset.vertex_index for offset in morph.offsets], dtype=np.int64)
+            positions = np.array([offset.position.vector for offset in morph.offsets], dtype=np.float64).reshape(-1, 3)
+
+            # 同じ頂点への変形量は合算しておく
+            unique_vertex_indexes, inverse_indexes = np.unique(vertex_indexes, return_inverse=True)
+            unique_positions = np.zeros((len(unique_vertex_indexes), 3))
+            np.add.at(unique_positions, inverse_indexes, positions)
+
+            morph_names.append(morph.name)
+            part_vertex_indexes.append(unique_vertex_indexes)
+            part_positions.append(unique_positions)
+            morph_indptr.append(morph_indptr[-1] + len(unique_vertex_indexes))
+
+        return morph_names, {
+            **skinning_matrix.arrays,
+            "morph_indptr": np.array(morph_indptr, dtype=np.int64),
+            "morph_vertex_indexes": np.concatenate(part_vertex_indexes),
+            "morph_positions": np.concatenate(part_positions),
+        }
@@ -0,0 +1,49 @@
+import os
+from multiprocessing.shared_memory import SharedMemory
+
+import numpy as np
+
+from mlib.core.logger import MLogger
+
+logger = MLogger(os.path.basename(__file__), level=1)
+__ = logger.get_text
+
+
+class SharedArrays:
+    """
+    numpy配列を共有メモリ上に配置して、別プロセスからコピーなしで参照できるようにする
+    生成したプロセスで close を呼ぶまで共有メモリは解放されない
+    """
+
+    def __init__(self, arrays: dict[str, np.ndarray]) -> None:
+        self.memories: list[SharedMemory] = []
+        self.specs: dict[str, tuple[str, tuple[int, ...], str]] = {}
+
+        for key, array in arrays.items():
+            # サイズ0の共有メモリは作れないので最低1byte確保する
+            memory = SharedMemory(create=True, size=max(1, array.nbytes))
+            np.ndarray(array.shape, dtype=array.dtype, buffer=memory.buf)[...] = array
+            self.memories.append(memory)
+            self.specs[key] = (memory.name, array.shape, array.dtype.str)
+
+    def close(self) -> None:
+        for memory in self.memories:
+            memory.close()
+            memory.unlink()
+        self.memories = []
+
+
+def attach_shared_arrays(specs: dict[str, tuple[str, tuple[int, ...], str]]) -> tuple[dict[str, np.ndarray], list[SharedMemory]]:
+    """
+    別プロセスで配置された共有メモリ上の配列を参照する
+    返却した共有メモリは配列を使い終わるまで保持しておくこと
+    """
+    arrays: dict[str, np.ndarray] = {}
+    memories: list[SharedMemory] = []
+
+    for key, (memory_name, shape, dtype) in specs.items():
+        memory = SharedMemory(name=memory_name)
+        arrays[key] = np.ndarray(shape, dtype=np.dtype(dtype), buffer=memory.buf)
+        memories.append(memory)
+
+    return arrays, memories
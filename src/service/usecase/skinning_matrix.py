@@ -0,0 +1,119 @@
+import os
+
+import numpy as np
+
+from mlib.core.logger import MLogger
+from mlib.pmx.pmx_collection import PmxModel
+
+logger = MLogger(os.path.basename(__file__), level=1)
+__ = logger.get_text
+
+
+class SkinningMatrix:
+    """
+    モデルのスキニング行列
+    頂点毎のボーンウェイトを 頂点行 × ボーン列 の疎行列(CSR)として、初期姿勢の頂点位置と合わせてモデル単位で保持する
+    ボーン変形結果から指定頂点の変形後の位置を、ボーン行列の加重和で一度に求める
+    """
+
+    def __init__(
+        self, bone_count: int, indptr: np.ndarray, bone_indexes: np.ndarray, weights: np.ndarray, bind_positions: np.ndarray
+    ) -> None:
+        """
+        bone_count: ボーン数
+        indptr: 頂点毎の要素の開始位置 (頂点数+1)
+        bone_indexes: 要素毎のボーンINDEX
+        weights: 要素毎のウェイト
+        bind_positions: 初期姿勢の頂点位置 (頂点数, 3)
+        """
+        self.bone_count = bone_count
+        self.indptr = indptr
+        self.bone_indexes = bone_indexes
+        self.weights = weights
+        self.bind_positions = bind_positions
+
+        # ボーン毎のウェイトが乗っている頂点 (ボーン列 × 頂点行 の転置)
+        order = np.argsort(bone_indexes, kind="stable")
+        self.bone_vertex_indexes = np.repeat(np.arange(len(indptr) - 1, dtype=np.int64), np.diff(indptr))[order]
+        self.bone_indptr = np.concatenate([[0], np.cumsum(np.bincount(bone_indexes, minlength=bone_count))]).astype(np.int64)
+
+    @classmethod
+    def create(cls, model: PmxModel) -> "SkinningMatrix":
+        """モデルの頂点のデフォームからスキニング行列を生成する"""
+        indptr: list[int] = [0]
+        bone_indexes: list[int] = []
+        weights: list[float] = []
+        for vertex in model.vertices:
+            for bone_index, bone_weight in zip(vertex.deform.indexes, vertex.deform.weights):
+                # 未使用のボーン枠は持たない
+                if 0 <= bone_index and 0 != bone_weight:
+                    bone_indexes.append(bone_index)
+                    weights.append(bone_weight)
+            indptr.append(len(bone_indexes))
+
+        return cls(
+            len(model.bones),
+            np.array(indptr, dtype=np.int64),
+            np.array(bone_indexes, dtype=np.int64),
+            np.array(weights, dtype=np.float64),
+            np.array([vertex.position.vector for vertex in model.vertices], dtype=np.float64).reshape(-1, 3),
+        )
+
+    @property
+    def arrays(self) -> dict[str, np.ndarray]:
+        """スキニング行列を構成する配列(モデルキャッシュへの保存用)"""
+        return {
+            "skinning_indptr": self.indptr,
+            "skinning_bone_indexes": self.bone_indexes,
+            "skinning_weights": self.weights,
+            "vertex_positions": self.bind_positions,
+        }
+
+    @classmethod
+    def from_arrays(cls, bone_count: int, arrays: dict[str, np.ndarray]) -> "SkinningMatrix":
+        return cls(
+            bone_count,
+            arrays["skinning_indptr"],
+            arrays["skinning_bone_indexes"],
+            arrays["skinning_weights"],
+            arrays["vertex_positions"],
+        )
+
+    def get_vertex_indexes(self, bone_indexes: list[int]) -> np.ndarray:
+        """指定ボーンのいずれかにウェイトが乗っている頂点INDEXリスト(昇順)"""
+        if not bone_indexes:
+            return np.zeros(0, dtype=np.int64)
+        return np.unique(
+            np.concatenate(
+                [self.bone_vertex_indexes[self.bone_indptr[bone_index] : self.bone_indptr[bone_index + 1]] for bone_index in bone_indexes]
+            )
+        )
+
+    def get_bone_indexes(self, vertex_indexes: np.ndarray) -> np.ndarray:
+        """指定頂点にウェイトが乗っているボーンINDEXリスト(昇順)"""
+        return np.unique(self.bone_indexes[self.get_entry_indexes(vertex_indexes)[1]])
+
+    def get_entry_indexes(self, vertex_indexes: np.ndarray) -> tuple[np.ndarray, np.ndarray]:
+        """指定頂点の要素の (指定頂点内の行番号, 要素INDEX)"""
+        starts = self.indptr[vertex_indexes]
+        counts = self.indptr[vertex_indexes + 1] - starts
+        rows = np.repeat(np.arange(len(vertex_indexes), dtype=np.int64), counts)
+        # 行毎の要素の開始位置からの連番
+        entry_offsets = np.arange(int(np.sum(counts)), dtype=np.int64) - np.repeat(np.cumsum(counts) - counts, counts)
+        entry_indexes = np.repeat(starts, counts) + entry_offsets
+        return rows, entry_indexes
+
+    def deform(self, vertex_indexes: np.ndarray, bone_matrixes: np.ndarray, positions: np.ndarray) -> np.ndarray:
+        """
+        指定頂点の変形後の位置 (頂点数, 3)
+        vertex_indexes: 変形する頂点INDEXリスト
+        bone_matrixes: ボーン毎の変形行列 (ボーン数, 4, 4)
+        positions: 変形前の頂点位置 (頂点数, 3)
+        """
+        rows, entry_indexes = self.get_entry_indexes(vertex_indexes)
+
+        # 頂点毎にボーン行列をウェイトで加重和する
+        matrixes = np.zeros((len(vertex_indexes), 4, 4), dtype=np.float64)
+        np.add.at(matrixes, rows, bone_matrixes[self.bone_indexes[entry_indexes]] * self.weights[entry_indexes, np.newaxis, np.newaxis])
+
+        return np.einsum("nij,nj->ni", matrixes[:, :3, :3], positions) + matrixes[:, :3, 3]
@@ -0,0 +1,56 @@
+import os
+from collections import OrderedDict
+from threading import Lock
+from typing import Any, Callable, Hashable, TypeVar
+
+from mlib.core.logger import MLogger
+
+logger = MLogger(os.path.basename(__file__), level=1)
+__ = logger.get_text
+
+T = TypeVar("T")
+
+# 保持する処理結果の上限
+STAGE_CACHE_SIZE = 32
+
+
+class StageCache:
+    """
+    処理段階毎のキャッシュ
+    目線生成・まばたき生成の各段階の結果を、その段階の入力から求めたキーで保持する
+    パラメーターを変えて再生成する際は、入力が変わった段階以降だけを計算し直す
+    ライブプレビューの複数スレッドから参照されるため、保持内容の読み書きはロックする
+    (同じ段階を同時に計算した場合は後から終わった方で上書きする)
+    """
+
+    def __init__(self, max_size: int = STAGE_CACHE_SIZE) -> None:
+        self.max_size = max_size
+        self.values: OrderedDict[tuple[str, Hashable], Any] = OrderedDict()
+        self.lock = Lock()
+
+    def get(self, stage_name: str, key: Hashable, create: Callable[[], T]) -> T:
+        """
+        処理段階の結果を取得する(キャッシュがない場合は create で生成して保持する)
+        stage_name: 処理段階名
+        key: 処理段階の入力から求めたキー
+        """
+        cache_key = (stage_name, key)
+        with self.lock:
+            if cache_key in self.values:
+                logger.debug("処理段階キャッシュ利用 [{s}]", s=stage_name)
+                self.values.move_to_end(cache_key)
+                return self.values[cache_key]
+
+        value = create()
+
+        with self.lock:
+            self.values[cache_key] = value
+            self.values.move_to_end(cache_key)
+            if self.max_size < len(self.values):
+                self.values.popitem(last=False)
+
+        return value
+
+    def clear(self) -> None:
+        with self.lock:
+            self.values.clear()
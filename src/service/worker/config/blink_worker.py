@@ -37,6 +37,9 @@ class BlinkWorker(BaseWorker):
             self.frame.config_panel.morph_set.below_eyebrow_morph_ctrl.GetValue(),
             self.frame.config_panel.morph_set.blink_morph_ctrl.GetValue(),
             self.frame.config_panel.morph_set.smile_morph_ctrl.GetValue(),
+            file_panel.bone_matrix_cache,
+            file_panel.stage_cache,
+            analysis_cache=file_panel.analysis_cache,
         )
 
         self.result_data = motion, output_motion
@@ -39,6 +39,9 @@ class GazeWorker(BaseWorker):
             self.frame.config_panel.gaze_limit_upper_y_ctrl.GetValue(),
             self.frame.config_panel.gaze_limit_lower_y_ctrl.GetValue(),
             self.frame.config_panel.gaze_reset_ctrl.GetValue(),
+            file_panel.bone_matrix_cache,
+            file_panel.stage_cache,
+            analysis_cache=file_panel.analysis_cache,
         )
 
         self.result_data = motion, output_motion
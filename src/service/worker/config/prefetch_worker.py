@@ -0,0 +1,137 @@
+import os
+from threading import Condition, Lock, Thread
+from typing import Optional
+
+from mlib.core.logger import MLogger
+from mlib.pmx.canvas import MotionSet
+from mlib.pmx.pmx_collection import PmxModel
+from mlib.vmd.vmd_collection import VmdMotion
+
+logger = MLogger(os.path.basename(__file__), level=1)
+__ = logger.get_text
+
+# 停止中(スライダー操作中)に前後を先読みするキーフレ数(保持するのもこの範囲のキーフレだけ)
+PREFETCH_AROUND_COUNT = 15
+
+
+class PrefetchWorker:
+    """
+    スライダー操作用の先読み
+    停止中に表示位置の前後のキーフレのボーン変形・モーフ変形結果を裏で求めて保持する
+    再生中の先読みはキャンバスの再生処理に任せ、ここでは行わない
+    モデル・モーションはコピーせず、表示中のものをそのまま参照して変形する
+    (生成処理がモーションを書き換える前には stop で先読みを止めるので、先読み中に書き換えられることはない)
+    保持するのは表示位置の前後のキーフレだけで、表示位置が動いたら範囲外の結果は捨てる
+    """
+
+    def __init__(self, around_count: int = PREFETCH_AROUND_COUNT) -> None:
+        self.around_count = around_count
+        self.animations: dict[int, MotionSet] = {}
+        # 表示中のモデル・モーション(先読みに使い、先読み結果がどのデータのものかの判定にも使う)
+        self.model: Optional[PmxModel] = None
+        self.motion: Optional[VmdMotion] = None
+        self.fno = 0
+        # 表示位置が変わった回数(先読み中に変わったら先読みする順番を決め直す)
+        self.generation = 0
+        # モーションが変わった回数(先読み中に変わったら結果を捨てる)
+        self.version = 0
+        self.condition = Condition()
+        # 変形中は保持し続けるロック(先読みを止める時に変形が終わるのを待つ)
+        self.busy_lock = Lock()
+        self.thread: Optional[Thread] = None
+
+    def clear(self) -> None:
+        """モーションの内容が変わった時に、保持している変形結果を全て捨てる"""
+        with self.condition:
+            self.animations.clear()
+            self.model = None
+            self.motion = None
+            self.version += 1
+            self.generation += 1
+
+    def stop(self) -> None:
+        """生成処理がモーションを書き換える前に先読みを止める(UIスレッドから呼び出す)
+        変形中のキーフレがあれば、それが終わるまで待つ"""
+        self.clear()
+        with self.busy_lock:
+            pass
+
+    def get(self, model: PmxModel, motion: VmdMotion, fno: int) -> Optional[MotionSet]:
+        """先読み済みの変形結果(ない場合は None)"""
+        with self.condition:
+            if model is not self.model or motion is not self.motion:
+                return None
+            return self.animations.get(fno)
+
+    def put(self, model: PmxModel, motion: VmdMotion, fno: int, animation: MotionSet) -> None:
+        """画面側で求めた変形結果も保持する"""
+        with self.condition:
+            if model is self.model and motion is self.motion and self.is_around(fno):
+                self.animations[fno] = animation
+
+    def request(self, model: PmxModel, motion: VmdMotion, fno: int) -> None:
+        """停止中の表示位置を通知して先読みを進める(UIスレッドから呼び出す)"""
+        with self.condition:
+            if model is not self.model or motion is not self.motion:
+                self.model = model
+                self.motion = motion
+                self.animations.clear()
+                self.version += 1
+            self.fno = fno
+            # 表示位置から離れたキーフレの結果は捨てる
+            for animation_fno in [animation_fno for animation_fno in self.animations if not self.is_around(animation_fno)]:
+                del self.animations[animation_fno]
+            self.generation += 1
+            self.condition.notify()
+
+        if not self.thread or not self.thread.is_alive():
+            self.thread = Thread(target=self.thread_execute, daemon=True)
+            self.thread.start()
+
+    def is_around(self, fno: int) -> bool:
+        return abs(fno - self.fno) <= self.around_count
+
+    def get_prefetch_fnos(self) -> list[int]:
+        """先読みするキーフレ(近い順)"""
+        max_fno = self.motion.max_fno if self.motion else 0
+        fnos = [self.fno]
+        for n in range(1, self.around_count + 1):
+            fnos.extend([self.fno + n, self.fno - n])
+        return [fno for fno in fnos if 0 <= fno <= max_fno]
+
+    def thread_execute(self) -> None:
+        while True:
+            with self.condition:
+                generation = self.generation
+                version = self.version
+                model = self.model
+                motion = self.motion
+                fnos = [fno for fno in self.get_prefetch_fnos() if fno not in self.animations]
+                if not fnos or not model or not motion:
+                    # 先読みするキーフレがなければ、次の通知まで待つ
+                    self.condition.wait()
+                    continue
+
+            for fno in fnos:
+                with self.busy_lock:
+                    with self.condition:
+                        if version != self.version:
+                            # 先読みが止められたか、モーションが変わった
+                            break
+                    try:
+                        animation: Optional[MotionSet] = MotionSet(model, motion, fno)
+                    except Exception:
+                        animation = None
+                if not animation:
+                    # 求められなかったら、次の通知まで先読みしない
+                    logger.debug("先読み失敗 [{f}]", f=fno)
+                    with self.condition:
+                        if generation == self.generation:
+                            self.condition.wait()
+                    break
+                with self.condition:
+                    if version == self.version and self.is_around(fno):
+                        self.animations[fno] = animation
+                    if generation != self.generation:
+                        # 先読み中に表示位置やモーションが変わった
+                        break
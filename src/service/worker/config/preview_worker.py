@@ -0,0 +1,230 @@
+import os
+import traceback
+from threading import Condition, Thread
+from typing import Callable, Optional
+
+import wx
+
+from mlib.core.logger import MLogger
+from mlib.pmx.pmx_collection import PmxModel
+from mlib.service.form.base_frame import BaseFrame
+from mlib.vmd.vmd_collection import VmdMotion
+from service.form.panel.file_panel import FilePanel
+from service.usecase.cancel_token import CanceledException, CancelToken
+from service.usecase.config.blink_usecase import BlinkUsecase
+from service.usecase.config.gaze_usecase import GazeUsecase
+
+logger = MLogger(os.path.basename(__file__), level=1)
+__ = logger.get_text
+
+# 設定変更からプレビュー生成を始めるまでの待ち時間(ミリ秒)
+PREVIEW_DELAY_MS = 500
+
+
+class PreviewWorker:
+    """
+    ライブプレビュー
+    設定変更から一定時間操作がなければ、裏で目線・まばたきを生成し直して結果のモーションを通知する
+    生成は1つのスレッドで順番に行い、モデルやキャッシュを複数の生成で同時に使わない
+    生成中に設定が変わった場合は、生成中の処理を中断要求で打ち切って(時間窓毎の変形の間でも確認する)新しい設定で生成し直す
+    """
+
+    def __init__(self, frame: BaseFrame, result_event: Callable[[VmdMotion], None], delay_ms: int = PREVIEW_DELAY_MS) -> None:
+        self.frame = frame
+        self.result_event = result_event
+        self.delay_ms = delay_ms
+        self.timer: Optional[wx.CallLater] = None
+        # 次のプレビューで生成し直す処理(前回のプレビュー以降に設定を変えた処理)
+        self.is_gaze = False
+        self.is_blink = False
+        # 最後に開始したプレビューの番号(古いプレビューの結果は捨てる)
+        self.job_no = 0
+        # 生成待ち・生成中のプレビュー(プレビュー用スレッドとの受け渡しはロックする)
+        self.condition = Condition()
+        self.pending_job: Optional[PreviewJob] = None
+        self.running_job: Optional[PreviewJob] = None
+        # プレビュー用スレッドが生成を終えた時に呼び出す処理
+        self.idle_callbacks: list[Callable[[], None]] = []
+        self.thread: Optional[Thread] = None
+
+    def schedule(self, is_gaze: bool = False, is_blink: bool = False) -> None:
+        """設定変更時に呼び出し、一定時間変更がなければプレビュー生成を開始する"""
+        # 実行中のプレビューは待たずに打ち切る(打ち切ったプレビューで生成し直す予定だった処理は次のプレビューに引き継ぐ)
+        self.cancel_jobs(is_inherit=True)
+
+        self.is_gaze |= is_gaze
+        self.is_blink |= is_blink
+
+        if self.timer and self.timer.IsRunning():
+            self.timer.Stop()
+        self.timer = wx.CallLater(self.delay_ms, self.start)
+
+    def cancel(self, idle_callback: Optional[Callable[[], None]] = None) -> None:
+        """
+        予約済み・実行中のプレビューを全て取り消す
+        idle_callback: 実行中のプレビューが止まってから(実行中のプレビューがない場合はすぐに)UIスレッドで呼び出す処理
+        """
+        if self.timer and self.timer.IsRunning():
+            self.timer.Stop()
+        self.timer = None
+        self.cancel_jobs(is_inherit=False)
+        self.is_gaze = False
+        self.is_blink = False
+
+        if idle_callback is None:
+            return
+
+        with self.condition:
+            if self.running_job is not None:
+                self.idle_callbacks.append(idle_callback)
+                return
+        idle_callback()
+
+    def cancel_jobs(self, is_inherit: bool) -> None:
+        """生成待ち・生成中のプレビューを打ち切る"""
+        with self.condition:
+            for job in (self.pending_job, self.running_job):
+                if job is None or job.cancel_token.is_canceled:
+                    continue
+                job.cancel_token.cancel()
+                if is_inherit:
+                    self.is_gaze |= job.is_gaze
+                    self.is_blink |= job.is_blink
+            self.pending_job = None
+
+    def start(self) -> None:
+        """UIスレッドで設定値を取得して、プレビュー用スレッドに生成を依頼する"""
+        file_panel: FilePanel = self.frame.file_panel
+        model: PmxModel = file_panel.model_ctrl.data
+        motion: VmdMotion = file_panel.motion_ctrl.data
+        if not model or not motion or not (self.is_gaze or self.is_blink):
+            return
+
+        config_panel = self.frame.config_panel
+        gaze_params = (
+            config_panel.gaze_infection_ctrl.GetValue(),
+            config_panel.gaze_ratio_x_ctrl.GetValue(),
+            config_panel.gaze_limit_upper_x_ctrl.GetValue(),
+            config_panel.gaze_limit_lower_x_ctrl.GetValue(),
+            config_panel.gaze_ratio_y_ctrl.GetValue(),
+            config_panel.gaze_limit_upper_y_ctrl.GetValue(),
+            config_panel.gaze_limit_lower_y_ctrl.GetValue(),
+            config_panel.gaze_reset_ctrl.GetValue(),
+        )
+        blink_params = (
+            dict(config_panel.blink_set.condition_probabilities),
+            config_panel.blink_set.linkage_depth_ctrl.GetValue(),
+            config_panel.blink_set.blink_span_ctrl.GetValue(),
+            config_panel.morph_set.below_eyebrow_morph_ctrl.GetValue(),
+            config_panel.morph_set.blink_morph_ctrl.GetValue(),
+            config_panel.morph_set.smile_morph_ctrl.GetValue(),
+        )
+
+        self.cancel_jobs(is_inherit=True)
+        self.job_no += 1
+        job = PreviewJob(self.job_no, file_panel, model, motion, gaze_params, blink_params, self.is_gaze, self.is_blink)
+        # 生成し直す処理はプレビュー毎に決める
+        self.is_gaze = False
+        self.is_blink = False
+
+        with self.condition:
+            self.pending_job = job
+            self.condition.notify_all()
+
+        if self.thread is None:
+            self.thread = Thread(target=self.thread_execute, daemon=True)
+            self.thread.start()
+
+    def thread_execute(self) -> None:
+        """プレビュー用スレッド(依頼されたプレビューを1件ずつ生成する)"""
+        while True:
+            with self.condition:
+                while self.pending_job is None:
+                    self.condition.wait()
+                job = self.pending_job
+                self.pending_job = None
+                self.running_job = job
+
+            motion: Optional[VmdMotion] = None
+            try:
+                motion = self.execute_job(job)
+            except CanceledException:
+                logger.debug("プレビュー生成中断 [{n}]", n=job.job_no)
+            except Exception:
+                logger.warning("プレビュー生成に失敗しました\n{e}", e=traceback.format_exc(), decoration=MLogger.Decoration.BOX)
+            finally:
+                with self.condition:
+                    self.running_job = None
+                    idle_callbacks = self.idle_callbacks if self.pending_job is None else []
+                    if self.pending_job is None:
+                        self.idle_callbacks = []
+
+            if motion is not None:
+                wx.CallAfter(self.on_finished, job, motion)
+            for idle_callback in idle_callbacks:
+                wx.CallAfter(idle_callback)
+
+    def execute_job(self, job: "PreviewJob") -> VmdMotion:
+        # 読み込んだモーションは書き換えず、コピーに対して生成する
+        motion = job.motion.copy()
+        output_motion = VmdMotion()
+
+        if job.is_gaze:
+            GazeUsecase().create_gaze(
+                job.model,
+                motion,
+                output_motion,
+                *job.gaze_params,
+                job.file_panel.bone_matrix_cache,
+                job.file_panel.stage_cache,
+                job.cancel_token,
+                job.file_panel.analysis_cache,
+            )
+        if job.is_blink:
+            BlinkUsecase().create_blink(
+                job.model,
+                motion,
+                output_motion,
+                *job.blink_params,
+                job.file_panel.bone_matrix_cache,
+                job.file_panel.stage_cache,
+                job.cancel_token,
+                job.file_panel.analysis_cache,
+            )
+        job.cancel_token.check()
+
+        return motion
+
+    def on_finished(self, job: "PreviewJob", motion: VmdMotion) -> None:
+        # 完了までに新しいプレビューが始まっていたら結果は使わない
+        if job.job_no != self.job_no or job.cancel_token.is_canceled:
+            return
+        self.result_event(motion)
+
+
+class PreviewJob:
+    def __init__(
+        self,
+        job_no: int,
+        file_panel: FilePanel,
+        model: PmxModel,
+        motion: VmdMotion,
+        gaze_params: tuple[float, float, int, int, float, int, int, int],
+        blink_params: tuple[dict[str, float], float, int, str, str, str],
+        is_gaze: bool,
+        is_blink: bool,
+    ) -> None:
+        """
+        プレビュー生成の依頼内容
+        gaze_params, blink_params: UIスレッドで取得した目線生成・まばたき生成の設定値
+        is_gaze, is_blink: 目線・まばたきを生成し直すか
+        """
+        self.job_no = job_no
+        self.cancel_token = CancelToken()
+        self.file_panel = file_panel
+        self.model = model
+        self.motion = motion
+        self.gaze_params = gaze_params
+        self.blink_params = blink_params
+        self.is_gaze = is_gaze
+        self.is_blink = is_blink
@@ -1,4 +1,5 @@
 import os
+from typing import Optional
 
 import wx
 
@@ -9,7 +10,9 @@ from mlib.service.form.base_frame import BaseFrame
 from mlib.utils.file_utils import get_root_dir
 from mlib.vmd.vmd_collection import VmdMotion
 from service.form.panel.file_panel import FilePanel
+from service.usecase.config.morph_offset_store import MorphOffsetStore
 from service.usecase.config.repair_morph_usecase import RepairMorphUsecase
+from service.usecase.model_cache import ModelCache
 
 logger = MLogger(os.path.basename(__file__), level=1)
 __ = logger.get_text
@@ -18,6 +21,7 @@ __ = logger.get_text
 class RepairMorphWorker(BaseWorker):
     def __init__(self, frame: BaseFrame, result_event: wx.Event) -> None:
         super().__init__(frame, result_event)
+        self.offset_store: Optional[MorphOffsetStore] = None
 
     def thread_execute(self):
         file_panel: FilePanel = self.frame.file_panel
@@ -25,6 +29,10 @@ class RepairMorphWorker(BaseWorker):
         motion: VmdMotion = file_panel.motion_ctrl.data
         output_motion: VmdMotion = file_panel.output_motion_ctrl.data
 
+        if not self.offset_store or self.offset_store.model is not model:
+            # モデルが変わった時だけモーフ変形量ストアを作り直す
+            self.offset_store = ModelCache().create_offset_store(model)
+
         logger.info("モーフ破綻補正開始", decoration=MLogger.Decoration.BOX)
 
         RepairMorphUsecase().repair_morph(
@@ -33,6 +41,7 @@ class RepairMorphWorker(BaseWorker):
             output_motion,
             self.frame.config_panel.check_morph_threshold_ctrl.GetValue(),
             self.frame.config_panel.repair_morph_factor_ctrl.GetValue(),
+            self.offset_store,
         )
 
         self.result_data = motion, output_motion
@@ -1,4 +1,6 @@
 import os
+import pickle
+from concurrent.futures import ProcessPoolExecutor
 from typing import Optional
 
 import wx
@@ -9,8 +11,10 @@ from mlib.service.base_worker import BaseWorker
 from mlib.service.form.base_frame import BaseFrame
 from mlib.utils.file_utils import get_root_dir
 from mlib.vmd.vmd_collection import VmdMotion
+from mlib.vmd.vmd_tree import VmdBoneFrameTrees
 from service.form.panel.file_panel import FilePanel
-from service.usecase.load_usecase import LoadUsecase
+from service.usecase.load_usecase import LoadUsecase, read_model_process, read_motion_process
+from service.usecase.model_cache import ModelCache
 
 logger = MLogger(os.path.basename(__file__), level=1)
 __ = logger.get_text
@@ -19,46 +23,81 @@ __ = logger.get_text
 class LoadWorker(BaseWorker):
     def __init__(self, frame: BaseFrame, result_event: wx.Event) -> None:
         super().__init__(frame, result_event)
+        self.executor: Optional[ProcessPoolExecutor] = None
 
     def thread_execute(self):
         file_panel: FilePanel = self.frame.file_panel
         model: Optional[PmxModel] = None
         motion: Optional[VmdMotion] = None
+        bone_matrixes: Optional[VmdBoneFrameTrees] = None
 
         is_model_change = False
         usecase = LoadUsecase()
 
-        if file_panel.model_ctrl.valid() and not file_panel.model_ctrl.data:
-            logger.info("人物: 読み込み開始", decoration=MLogger.Decoration.BOX)
+        is_model_read = bool(file_panel.model_ctrl.valid() and not file_panel.model_ctrl.data)
+        is_motion_read = bool(file_panel.motion_ctrl.valid() and (not file_panel.motion_ctrl.data or is_model_read))
 
-            original_model = file_panel.model_ctrl.reader.read_by_filepath(file_panel.model_ctrl.path)
+        if is_model_read and is_motion_read:
+            # モデルとモーションは別プロセスで同時に読み込む
+            logger.info("人物・モーション: 読み込み開始", decoration=MLogger.Decoration.BOX)
+
+            if self.executor is None:
+                # 読み込みの度にプロセスを起動しないよう、読み込み用のプロセスは使い回す
+                self.executor = ProcessPoolExecutor(max_workers=2)
+
+            model_future = self.executor.submit(read_model_process, file_panel.model_ctrl.reader, file_panel.model_ctrl.path)
+            motion_future = self.executor.submit(read_motion_process, file_panel.motion_ctrl.reader, file_panel.motion_ctrl.path)
+
+            # モデルを読み込めたら、モーションの読み込みを待たずに初期姿勢を求める
+            original_model = pickle.loads(model_future.result())
 
             usecase.valid_model(original_model)
 
-            model = original_model.copy()
+            # 読み込んだモデルは書き換えないので、コピーせずにそのまま使う
+            model = original_model
+            bone_matrixes = usecase.get_bone_matrixes(model)
+
+            original_motion = pickle.loads(motion_future.result())
+
+            motion = usecase.valid_motion(original_motion)
 
             is_model_change = True
-        elif file_panel.model_ctrl.original_data:
-            original_model = file_panel.model_ctrl.original_data
-            model = file_panel.model_ctrl.data
         else:
-            original_model = PmxModel()
-            model = PmxModel()
+            if is_model_read:
+                logger.info("人物: 読み込み開始", decoration=MLogger.Decoration.BOX)
 
-        if file_panel.motion_ctrl.valid() and (not file_panel.motion_ctrl.data or is_model_change):
-            logger.info("モーション読み込み開始", decoration=MLogger.Decoration.BOX)
+                original_model = ModelCache().read_model(file_panel.model_ctrl.path, file_panel.model_ctrl.reader)
 
-            original_motion = file_panel.motion_ctrl.reader.read_by_filepath(file_panel.motion_ctrl.path)
+                usecase.valid_model(original_model)
 
-            motion = usecase.valid_motion(original_motion)
-        elif file_panel.motion_ctrl.original_data:
-            motion = file_panel.motion_ctrl.original_data
-        else:
-            motion = VmdMotion("empty")
+                # 読み込んだモデルは書き換えないので、コピーせずにそのまま使う
+                model = original_model
+
+                is_model_change = True
+            elif file_panel.model_ctrl.original_data:
+                original_model = file_panel.model_ctrl.original_data
+                model = file_panel.model_ctrl.data
+            else:
+                original_model = PmxModel()
+                model = PmxModel()
+
+            if is_motion_read:
+                logger.info("モーション読み込み開始", decoration=MLogger.Decoration.BOX)
+
+                original_motion = file_panel.motion_ctrl.reader.read_by_filepath(file_panel.motion_ctrl.path)
+
+                motion = usecase.valid_motion(original_motion)
+            elif file_panel.motion_ctrl.original_data:
+                original_motion = file_panel.motion_ctrl.original_data
+                motion = file_panel.motion_ctrl.original_data
+            else:
+                original_motion = VmdMotion("empty")
+                motion = VmdMotion("empty")
 
         blink_conditions = usecase.get_blink_conditions()
 
-        bone_matrixes = usecase.get_bone_matrixes(model)
+        if bone_matrixes is None:
+            bone_matrixes = usecase.get_bone_matrixes(model)
 
         self.result_data = (
             original_model,
@@ -69,6 +108,12 @@ class LoadWorker(BaseWorker):
             bone_matrixes,
         )
 
+    def shutdown(self) -> None:
+        """読み込み用のプロセスを終了する(画面を閉じる時に呼び出す)"""
+        if self.executor is not None:
+            self.executor.shutdown(wait=False, cancel_futures=True)
+            self.executor = None
+
     def output_log(self):
         file_panel: FilePanel = self.frame.file_panel
         output_log_path = os.path.join(get_root_dir(), f"{os.path.basename(file_panel.output_motion_ctrl.path)}_load.log")
@@ -0,0 +1,95 @@
+import importlib.abc
+import importlib.machinery
+import sys
+import types
+from typing import Any, Optional, Sequence
+
+# 仮モジュールに置き換えるパッケージ名
+STUB_PACKAGE_NAME = "mlib"
+
+
+class StubMeta(type):
+    """仮のクラス(属性は何を参照しても仮のクラスを返す)"""
+
+    def __getattr__(cls, name: str) -> Any:
+        if name.startswith("__"):
+            raise AttributeError(name)
+        return create_stub_class(name)
+
+    def __getitem__(cls, item: Any) -> Any:
+        return cls
+
+
+class StubBase(metaclass=StubMeta):
+    def __init__(self, *args: Any, **kwargs: Any) -> None:
+        pass
+
+    def __getattr__(self, name: str) -> Any:
+        if name.startswith("__"):
+            raise AttributeError(name)
+        return create_stub_class(name)
+
+    def __class_getitem__(cls, item: Any) -> Any:
+        return cls
+
+
+def create_stub_class(name: str) -> type:
+    return StubMeta(name, (StubBase,), {})
+
+
+class StubLogger:
+    """ログは出力せず、翻訳は原文を返すロガー"""
+
+    class Decoration:
+        IN_BOX = "IN_BOX"
+        BOX = "BOX"
+        LINE = "LINE"
+
+    def __init__(self, *args: Any, **kwargs: Any) -> None:
+        pass
+
+    @classmethod
+    def initialize(cls, *args: Any, **kwargs: Any) -> None:
+        pass
+
+    def get_text(self, text: str, **kwargs: Any) -> str:
+        return text.format(**kwargs) if kwargs else text
+
+    def __getattr__(self, name: str) -> Any:
+        return lambda *args, **kwargs: None
+
+
+class StubModule(types.ModuleType):
+    def __getattr__(self, name: str) -> Any:
+        if name.startswith("__"):
+            raise AttributeError(name)
+        if name == "MLogger":
+            value: Any = StubLogger
+        else:
+            value = create_stub_class(name)
+        setattr(self, name, value)
+        return value
+
+
+class StubLoader(importlib.abc.Loader):
+    def create_module(self, spec: importlib.machinery.ModuleSpec) -> types.ModuleType:
+        return StubModule(spec.name)
+
+    def exec_module(self, module: types.ModuleType) -> None:
+        module.__path__ = []  # type: ignore[attr-defined]
+
+
+class StubFinder(importlib.abc.MetaPathFinder):
+    def find_spec(
+        self, fullname: str, path: Optional[Sequence[str]], target: Optional[types.ModuleType] = None
+    ) -> Optional[importlib.machinery.ModuleSpec]:
+        if fullname.split(".")[0] != STUB_PACKAGE_NAME:
+            return None
+        return importlib.machinery.ModuleSpec(fullname, StubLoader(), is_package=True)
+
+
+def install_mlib_stub() -> None:
+    """mlib 以下のモジュールを全て仮モジュールとして読み込むようにする"""
+    for name in [name for name in sys.modules if name.split(".")[0] == STUB_PACKAGE_NAME]:
+        del sys.modules[name]
+    sys.meta_path.insert(0, StubFinder())
@@ -0,0 +1,268 @@
+import importlib
+import os
+import sys
+import unittest
+from enum import IntEnum
+from typing import Any, Optional
+
+import numpy as np
+
+sys.path.insert(0, os.path.dirname(os.path.abspath(__file__)))
+from mlib_stub import install_mlib_stub  # noqa: E402
+
+install_mlib_stub()
+
+
+class MorphType(IntEnum):
+    GROUP = 0
+    VERTEX = 1
+    BONE = 2
+
+
+importlib.import_module("mlib.pmx.pmx_part").MorphType = MorphType
+
+from service.usecase.bone_matrix_cache import BoneMatrixCache  # noqa: E402
+
+
+class Part:
+    def __init__(self, **kwargs: Any) -> None:
+        self.__dict__.update(kwargs)
+
+
+class Parts:
+    """名前とINDEXのどちらでも参照できる一覧"""
+
+    def __init__(self, parts: list[Part]) -> None:
+        self.parts = parts
+
+    def __getitem__(self, key: Any) -> Part:
+        if isinstance(key, int):
+            return self.parts[key]
+        return [part for part in self.parts if part.name == key][0]
+
+    def __iter__(self) -> Any:
+        return iter(self.parts)
+
+
+def create_bone(index: int, name: str, parent_index: int, effect_index: int = -1, ik: Optional[Part] = None) -> Part:
+    return Part(
+        index=index,
+        name=name,
+        parent_index=parent_index,
+        effect_index=effect_index,
+        is_external_rotation=0 <= effect_index,
+        is_external_translation=False,
+        is_ik=ik is not None,
+        ik=ik,
+    )
+
+
+def create_model() -> Part:
+    """
+    0:センター - 1:上半身 - 2:頭 - 3:両目
+    0:センター - 4:左ひざ - 5:左足首 (左ひざは左足IKのリンク)
+    0:センター - 6:左足IK (ターゲットは左足首)
+    0:センター - 7:回転付与 - 8:付与先 (付与先は回転付与の付与親)
+    0:センター - 9:指
+    """
+    bones = Parts(
+        [
+            create_bone(0, "センター", -1),
+            create_bone(1, "上半身", 0),
+            create_bone(2, "頭", 1),
+            create_bone(3, "両目", 2),
+            create_bone(4, "左ひざ", 0),
+            create_bone(5, "左足首", 4),
+            create_bone(6, "左足IK", 0, ik=Part(bone_index=5, links=[Part(bone_index=4)])),
+            create_bone(7, "回転付与", 0),
+            create_bone(8, "付与先", 0, effect_index=7),
+            create_bone(9, "指", 0),
+        ]
+    )
+    morphs = Parts(
+        [
+            Part(index=0, name="頭傾け", morph_type=MorphType.BONE, offsets=[Part(bone_index=2)]),
+            Part(index=1, name="指曲げ", morph_type=MorphType.BONE, offsets=[Part(bone_index=9)]),
+            Part(index=2, name="表情セット", morph_type=MorphType.GROUP, offsets=[Part(morph_index=0)]),
+        ]
+    )
+    bone_trees = dict(
+        [
+            ("両目", Part(names=["センター", "上半身", "頭", "両目"])),
+            ("上半身", Part(names=["センター", "上半身"])),
+            ("左足首", Part(names=["センター", "左ひざ", "左足首"])),
+        ]
+    )
+    return Part(digest="model", bones=bones, morphs=morphs, bone_trees=bone_trees)
+
+
+class Frames:
+    def __init__(self) -> None:
+        self.data: dict[str, list[Part]] = {}
+
+    @property
+    def names(self) -> list[str]:
+        return list(self.data.keys())
+
+    def __getitem__(self, name: str) -> list[Part]:
+        return self.data.setdefault(name, [])
+
+
+def create_bone_frame(index: int, x: float) -> Part:
+    return Part(
+        index=index,
+        position=Part(vector=np.array([x, 0.0, 0.0])),
+        rotation=Part(scalar=1.0, x=0.0, y=0.0, z=0.0),
+        interpolations=Part(vals=[20, 20, 107, 107]),
+    )
+
+
+class Motion(Part):
+    """変形したキーフレ・ボーンを記録し、キーフレ番号とボーンのキーフレ数から行列を求めるモーション"""
+
+    def animate_bone(self, fnos: list[int], model: Part, bone_names: list[str], out_fno_log: bool = False) -> "Matrixes":
+        self.animated.append((fnos, bone_names))
+        return Matrixes(self, model, bone_names)
+
+
+class Matrixes:
+    def __init__(self, motion: Part, model: Part, bone_names: list[str]) -> None:
+        self.motion = motion
+        self.tree_bone_names = set([tree_bone_name for bone_name in bone_names for tree_bone_name in model.bone_trees[bone_name].names])
+
+    def __getitem__(self, key: tuple[int, str]) -> Part:
+        fno, bone_name = key
+        assert bone_name in self.tree_bone_names
+        position = np.array([fno, len(bone_name), len(self.motion.bones[bone_name])], dtype=np.float64)
+        global_matrix = np.eye(4)
+        global_matrix[:3, 3] = position
+        return Part(global_matrix=Part(vector=global_matrix), position=Part(vector=position))
+
+
+def create_motion() -> Part:
+    motion = Motion(digest="motion", bones=Frames(), morphs=Frames(), show_iks=[], animated=[])
+    for bone_name in ["センター", "上半身", "頭", "左ひざ", "左足首", "左足IK", "回転付与", "付与先", "指"]:
+        motion.bones[bone_name].append(create_bone_frame(0, 0.0))
+    for morph_name in ["頭傾け", "指曲げ", "表情セット"]:
+        motion.morphs[morph_name].append(Part(index=0, ratio=0.0))
+    return motion
+
+
+class BoneMatrixCacheTest(unittest.TestCase):
+    def assert_key_changed(self, bone_names: list[str], change: Any, expected: bool) -> None:
+        model = create_model()
+        motion = create_motion()
+        cache = BoneMatrixCache()
+        key = cache.create_key(model, motion, bone_names)  # type: ignore
+        change(motion)
+        self.assertEqual(expected, key != cache.create_key(model, motion, bone_names))  # type: ignore
+
+    def test_dependency_bone_names(self) -> None:
+        """親ボーン・付与親・IKボーンとそのターゲットを辿ったボーンとモーフが影響するものとして求まること"""
+        cache = BoneMatrixCache()
+        model = create_model()
+
+        self.assertEqual(
+            (["センター", "上半身", "両目", "頭"], ["表情セット", "頭傾け"]),
+            cache.get_dependency_names(model, ["両目"]),  # type: ignore
+        )
+        self.assertEqual(
+            (["センター", "左ひざ", "左足IK", "左足首"], []),
+            cache.get_dependency_names(model, ["左足首"]),  # type: ignore
+        )
+        self.assertEqual((["センター", "付与先", "回転付与"], []), cache.get_dependency_names(model, ["付与先"]))  # type: ignore
+
+    def test_key_parent(self) -> None:
+        """親ボーンのキーフレが変わったらキーが変わること"""
+        self.assert_key_changed(["両目"], lambda motion: motion.bones["上半身"].append(create_bone_frame(10, 1.0)), True)
+
+    def test_key_ik(self) -> None:
+        """IKボーンのキーフレが変わったら、IKリンクの子ボーンのキーが変わること"""
+        self.assert_key_changed(["左足首"], lambda motion: motion.bones["左足IK"].append(create_bone_frame(10, 1.0)), True)
+
+    def test_key_effect(self) -> None:
+        """付与親のキーフレが変わったらキーが変わること"""
+        self.assert_key_changed(["付与先"], lambda motion: motion.bones["回転付与"].append(create_bone_frame(10, 1.0)), True)
+
+    def test_key_morph(self) -> None:
+        """親ボーンを動かすボーンモーフ・グループモーフのキーフレが変わったらキーが変わること"""
+        self.assert_key_changed(["両目"], lambda motion: motion.morphs["頭傾け"].append(Part(index=10, ratio=1.0)), True)
+        self.assert_key_changed(["両目"], lambda motion: motion.morphs["表情セット"].append(Part(index=10, ratio=1.0)), True)
+
+    def test_key_ik_onoff(self) -> None:
+        """IKのON/OFFが変わったら、IKリンクの子ボーンのキーが変わること"""
+        self.assert_key_changed(
+            ["左足首"], lambda motion: motion.show_iks.append(Part(index=10, iks=[Part(name="左足IK", onoff=False)])), True
+        )
+
+    def test_key_unrelated(self) -> None:
+        """影響しないボーン・モーフのキーフレが変わってもキーは変わらないこと"""
+        self.assert_key_changed(["両目"], lambda motion: motion.bones["指"].append(create_bone_frame(10, 1.0)), False)
+        self.assert_key_changed(["両目"], lambda motion: motion.morphs["指曲げ"].append(Part(index=10, ratio=1.0)), False)
+        self.assert_key_changed(["両目"], lambda motion: motion.bones["左足IK"].append(create_bone_frame(10, 1.0)), False)
+
+    def test_key_empty_frames(self) -> None:
+        """キーフレのないボーン・モーフの一覧を参照しただけではキーは変わらないこと"""
+        self.assert_key_changed(["両目"], lambda motion: motion.bones["両目"], False)
+        self.assert_key_changed(["両目"], lambda motion: motion.morphs["頭傾け"].clear(), True)
+
+    def test_reuse_parent_arrays(self) -> None:
+        """両目を変形した後は、両目キーフレが変わっても上半身は変形し直さずに両目だけを変形し直すこと"""
+        model = create_model()
+        motion = create_motion()
+        cache = BoneMatrixCache()
+
+        cache.animate_bone_arrays(model, motion, [0, 5, 10], ["両目"])  # type: ignore
+        motion.bones["両目"].append(create_bone_frame(5, 1.0))
+        arrays = cache.animate_bone_arrays(model, motion, [0, 5, 10], ["上半身", "両目"])  # type: ignore
+
+        self.assertEqual([([0, 5, 10], ["両目"]), ([0, 5, 10], ["両目"])], motion.animated)
+        self.assertEqual(1, arrays["両目"][1][0, 2])
+        self.assertEqual([0, 5, 10], arrays["上半身"][1][:, 0].tolist())
+
+    def test_missing_frames(self) -> None:
+        """キーが変わっていなければ、足りないキーフレだけを変形すること"""
+        model = create_model()
+        motion = create_motion()
+        cache = BoneMatrixCache()
+
+        cache.animate_bone_arrays(model, motion, [0, 5], ["両目"])  # type: ignore
+        arrays = cache.animate_bone_arrays(model, motion, [0, 3, 5, 8], ["両目"])  # type: ignore
+        cache.animate_bone_arrays(model, motion, [3, 5], ["両目"])  # type: ignore
+
+        self.assertEqual([([0, 5], ["両目"]), ([3, 8], ["両目"])], motion.animated)
+        self.assertEqual([0, 3, 5, 8], arrays["両目"][1][:, 0].tolist())
+        self.assertEqual([0, 3, 5, 8], arrays["両目"][0][:, 0, 3].tolist())
+
+    def test_parent_changed(self) -> None:
+        """親ボーンのキーフレが変わったら、保持している配列は使わずに変形し直すこと"""
+        model = create_model()
+        motion = create_motion()
+        cache = BoneMatrixCache()
+
+        cache.animate_bone_arrays(model, motion, [0, 5], ["両目"])  # type: ignore
+        motion.bones["上半身"].append(create_bone_frame(5, 1.0))
+        arrays = cache.animate_bone_arrays(model, motion, [0, 5], ["両目", "上半身"])  # type: ignore
+
+        self.assertEqual([([0, 5], ["両目"]), ([0, 5], ["上半身", "両目"])], motion.animated)
+        self.assertEqual([2, 2], arrays["上半身"][1][:, 2].tolist())
+
+    def test_window(self) -> None:
+        """時間窓毎に変形しても、まとめて変形した場合と同じ配列になること"""
+        model = create_model()
+        fnos = [0, 2, 4, 7, 9, 13, 20]
+
+        motion = create_motion()
+        arrays = BoneMatrixCache().animate_bone_arrays(model, motion, fnos, ["両目", "左足首"])  # type: ignore
+
+        window_motion = create_motion()
+        window_arrays = BoneMatrixCache(5).animate_bone_arrays(model, window_motion, fnos, ["両目", "左足首"])  # type: ignore
+
+        self.assertEqual([[0, 2, 4], [7, 9], [13], [20]], [animated_fnos for animated_fnos, _ in window_motion.animated])
+        for bone_name in ["両目", "左足首"]:
+            self.assertTrue(np.array_equal(arrays[bone_name][0], window_arrays[bone_name][0]))
+            self.assertTrue(np.array_equal(arrays[bone_name][1], window_arrays[bone_name][1]))
+
+
+if __name__ == "__main__":
+    unittest.main()
@@ -0,0 +1,130 @@
+import json
+import multiprocessing
+import os
+import subprocess
+import sys
+import tempfile
+import unittest
+
+# 表情生成を置き換えた状態でヘッドレス実行を起動する(ファイル名に fail を含むモーションは失敗させる)
+EXECUTOR_SCRIPT = """
+import runpy
+import sys
+
+sys.path.insert(0, "tests")
+from mlib_stub import install_mlib_stub
+
+install_mlib_stub()
+
+import importlib  # noqa: E402
+import os  # noqa: E402
+
+file_utils = importlib.import_module("mlib.utils.file_utils")
+
+
+def separate_path(path):
+    file_name, file_ext = os.path.splitext(os.path.basename(path))
+    return os.path.dirname(path), file_name, file_ext
+
+
+file_utils.separate_path = separate_path
+
+from service.usecase import headless_usecase  # noqa: E402
+
+
+class Model:
+    def __init__(self, path):
+        self.path = path
+
+
+def read_model(self, model_path):
+    return Model(model_path)
+
+
+def execute(self, model, motion_path, config, repair_max_workers=None):
+    if "fail" in motion_path:
+        raise ValueError(f"failed: {{motion_path}}")
+    return f"{{motion_path}}.out.vmd"
+
+
+headless_usecase.HeadlessUsecase.read_model = read_model
+headless_usecase.HeadlessUsecase.execute = execute
+
+sys.argv = ["headless_executor.py"] + {args!r}
+runpy.run_path("headless_executor.py", run_name="__main__")
+"""
+
+
+class HeadlessExecutorTest(unittest.TestCase):
+    def setUp(self) -> None:
+        self.temp_dir = tempfile.TemporaryDirectory()
+        self.config_path = os.path.join(self.temp_dir.name, "config.json")
+        with open(self.config_path, "w", encoding="utf-8") as f:
+            json.dump({"steps": ["gaze", "blink"]}, f)
+        self.summary_path = os.path.join(self.temp_dir.name, "summary", "summary.json")
+
+    def tearDown(self) -> None:
+        self.temp_dir.cleanup()
+
+    def execute(self, motion_names: list[str], max_workers: int) -> tuple[subprocess.CompletedProcess, dict]:
+        args = [
+            "--model",
+            "model.pmx",
+            "--motion",
+            *[os.path.join(self.temp_dir.name, motion_name) for motion_name in motion_names],
+            "--config",
+            self.config_path,
+            "--summary",
+            self.summary_path,
+            "--max_workers",
+            str(max_workers),
+        ]
+        src_dir_path = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+        result = subprocess.run(
+            [sys.executable, "-c", EXECUTOR_SCRIPT.format(args=args)],
+            cwd=src_dir_path,
+            capture_output=True,
+            text=True,
+        )
+        with open(self.summary_path, "r", encoding="utf-8") as f:
+            summary = json.load(f)
+        return result, summary
+
+    def test_success(self) -> None:
+        """全モーション成功した場合は終了コード0で、サマリーに出力先が記録されること"""
+        result, summary = self.execute(["a.vmd", "b.vmd"], 1)
+
+        self.assertEqual(0, result.returncode, result.stderr)
+        self.assertEqual("model.pmx", summary["model"])
+        self.assertEqual(2, summary["success"])
+        self.assertEqual(0, summary["failure"])
+        self.assertEqual(["a.vmd", "b.vmd"], [os.path.basename(motion["motion"]) for motion in summary["motions"]])
+        self.assertEqual(["a.vmd.out.vmd", "b.vmd.out.vmd"], [os.path.basename(motion["output"]) for motion in summary["motions"]])
+        self.assertEqual(["", ""], [motion["error"] for motion in summary["motions"]])
+        self.assertLessEqual(0, summary["process_time"])
+        self.assertLessEqual(0, summary["motion_process_time"])
+
+    def test_failure(self) -> None:
+        """失敗したモーションがある場合は終了コード1で、サマリーにエラー内容が記録されること"""
+        result, summary = self.execute(["a.vmd", "fail.vmd"], 1)
+
+        self.assertEqual(1, result.returncode, result.stderr)
+        self.assertEqual(1, summary["success"])
+        self.assertEqual(1, summary["failure"])
+        self.assertEqual("", summary["motions"][0]["error"])
+        self.assertEqual("", summary["motions"][1]["output"])
+        self.assertIn("failed: ", summary["motions"][1]["error"])
+
+    @unittest.skipUnless("fork" in multiprocessing.get_all_start_methods(), "fork できない環境では表情生成の置き換えが子プロセスに引き継がれません")
+    def test_parallel(self) -> None:
+        """並列処理でも、モーションの指定順にサマリーに記録されること"""
+        result, summary = self.execute(["a.vmd", "fail.vmd", "c.vmd"], 2)
+
+        self.assertEqual(1, result.returncode, result.stderr)
+        self.assertEqual(2, summary["success"])
+        self.assertEqual(1, summary["failure"])
+        self.assertEqual(["a.vmd", "fail.vmd", "c.vmd"], [os.path.basename(motion["motion"]) for motion in summary["motions"]])
+
+
+if __name__ == "__main__":
+    unittest.main()
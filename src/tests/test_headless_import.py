@@ -0,0 +1,75 @@
+import importlib.machinery
+import os
+import subprocess
+import sys
+import unittest
+
+# 画面用のライブラリ(インストールされていても読み込めない状態にする)
+GUI_MODULE_NAMES = ["wx", "OpenGL"]
+
+# 画面用のライブラリの読み込みを禁止した状態で、ヘッドレス実行に必要なモジュールを読み込む
+IMPORT_SCRIPT = """
+import importlib.abc
+import sys
+
+GUI_MODULE_NAMES = {gui_module_names!r}
+
+if {is_stub!r}:
+    # mlib は仮モジュールにして、このリポジトリのモジュールだけの依存関係を確認する
+    sys.path.insert(0, "tests")
+    from mlib_stub import install_mlib_stub
+
+    install_mlib_stub()
+
+
+class GuiModuleBlocker(importlib.abc.MetaPathFinder):
+    def find_spec(self, fullname, path, target=None):
+        if fullname.split(".")[0] in GUI_MODULE_NAMES:
+            raise ImportError(f"blocked: {{fullname}}")
+        return None
+
+
+sys.meta_path.insert(0, GuiModuleBlocker())
+
+from service.usecase.headless_usecase import HeadlessConfig, HeadlessUsecase  # noqa: E402
+import headless_executor  # noqa: E402,F401
+
+loaded_gui_module_names = [name for name in sys.modules if name.split(".")[0] in GUI_MODULE_NAMES]
+if loaded_gui_module_names:
+    raise SystemExit(f"loaded: {{loaded_gui_module_names}}")
+"""
+
+
+def is_mlib_available() -> bool:
+    """mlib(サブモジュール)が展開されているか(他のテストが組み込んだ仮モジュールは見ない)"""
+    mlib_spec = importlib.machinery.PathFinder.find_spec("mlib")
+    if mlib_spec is None or not mlib_spec.submodule_search_locations:
+        return False
+    return importlib.machinery.PathFinder.find_spec("mlib.core", list(mlib_spec.submodule_search_locations)) is not None
+
+
+def run_import_script(is_stub: bool) -> subprocess.CompletedProcess:
+    src_dir_path = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+    return subprocess.run(
+        [sys.executable, "-c", IMPORT_SCRIPT.format(gui_module_names=GUI_MODULE_NAMES, is_stub=is_stub)],
+        cwd=src_dir_path,
+        capture_output=True,
+        text=True,
+    )
+
+
+class HeadlessImportTest(unittest.TestCase):
+    def test_import_without_gui(self) -> None:
+        """wx/OpenGL を読み込まずにヘッドレス実行のモジュールが読み込めること(mlib は仮モジュール)"""
+        result = run_import_script(is_stub=True)
+        self.assertEqual(0, result.returncode, result.stderr)
+
+    @unittest.skipUnless(is_mlib_available(), "mlib が展開されていないため実行できません")
+    def test_import_without_gui_with_mlib(self) -> None:
+        """wx/OpenGL がない環境でも、mlib を含めてヘッドレス実行のモジュールが読み込めること"""
+        result = run_import_script(is_stub=False)
+        self.assertEqual(0, result.returncode, result.stderr)
+
+
+if __name__ == "__main__":
+    unittest.main()
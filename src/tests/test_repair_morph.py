@@ -0,0 +1,221 @@
+import bisect
+import copy
+import importlib
+import os
+import sys
+import unittest
+from typing import Any, Optional
+from unittest import mock
+
+import numpy as np
+
+sys.path.insert(0, os.path.dirname(os.path.abspath(__file__)))
+from mlib_stub import install_mlib_stub  # noqa: E402
+
+install_mlib_stub()
+
+
+class MorphFrame:
+    def __init__(self, index: int, name: str, ratio: float) -> None:
+        self.index = index
+        self.name = name
+        self.ratio = ratio
+
+    def copy(self) -> "MorphFrame":
+        return MorphFrame(self.index, self.name, self.ratio)
+
+
+importlib.import_module("mlib.vmd.vmd_part").VmdMorphFrame = MorphFrame
+
+from service.usecase.config import repair_morph_usecase  # noqa: E402
+from service.usecase.config.repair_morph_usecase import RepairMorphUsecase  # noqa: E402
+
+
+class MorphNameFrames:
+    """キーフレ間を線形補間するモーフのキーフレ一覧"""
+
+    def __init__(self, name: str, ratios: dict[int, float]) -> None:
+        self.name = name
+        self.data = {fno: MorphFrame(fno, name, ratio) for fno, ratio in ratios.items()}
+
+    @property
+    def indexes(self) -> list[int]:
+        return sorted(self.data)
+
+    def range_indexes(self, fno: int) -> tuple[int, int, int]:
+        if fno in self.data:
+            return fno, fno, fno
+        indexes = self.indexes
+        idx = bisect.bisect_left(indexes, fno)
+        return indexes[max(0, idx - 1)], fno, indexes[min(len(indexes) - 1, idx)]
+
+    def __getitem__(self, fno: int) -> MorphFrame:
+        if fno in self.data:
+            return self.data[fno]
+        start_fno, _, end_fno = self.range_indexes(fno)
+        if start_fno == end_fno or fno < start_fno:
+            return MorphFrame(fno, self.name, self.data[start_fno].ratio)
+        if end_fno < fno:
+            return MorphFrame(fno, self.name, self.data[end_fno].ratio)
+        t = (fno - start_fno) / (end_fno - start_fno)
+        return MorphFrame(fno, self.name, self.data[start_fno].ratio * (1 - t) + self.data[end_fno].ratio * t)
+
+    def __iter__(self) -> Any:
+        return iter(self.data[fno] for fno in self.indexes)
+
+    def append(self, mf: MorphFrame) -> None:
+        self.data[mf.index] = mf
+
+
+class Motion:
+    def __init__(self, morphs: dict[str, MorphNameFrames]) -> None:
+        self.morphs = morphs
+
+    def get_key_ratios(self) -> dict[tuple[str, int], float]:
+        return {(morph_name, fno): mf.ratio for morph_name, mfs in self.morphs.items() for fno, mf in mfs.data.items()}
+
+
+class Checker:
+    """モーフ変形量の重み付き和が閾値を超えたら破綻とみなす破綻チェック"""
+
+    def __init__(self, weights: np.ndarray, threshold: float, nonlinear_morph_indexes: Optional[list[int]] = None) -> None:
+        self.weights = weights
+        self.threshold = threshold
+        self.nonlinear_morph_indexes = np.array(nonlinear_morph_indexes or [], dtype=np.int64)
+        self.offset_store: Optional[object] = object()
+        # 別プロセスに受け渡す配列(共有メモリは使わないので空)
+        self.arrays: dict[str, np.ndarray] = {}
+        self.memory_budget = 0
+
+    def check(self, morph_ratios: np.ndarray) -> np.ndarray:
+        morph_ratios = np.asarray(morph_ratios)
+        if self.offset_store is None and len(self.nonlinear_morph_indexes):
+            # モデルがない状態で、回転を含むボーンモーフを持つモーフの変形量を求めようとしていないか
+            assert np.allclose(morph_ratios[:, self.nonlinear_morph_indexes], 0.0)
+        return morph_ratios @ self.weights > self.threshold
+
+
+def create_motion(rng: np.random.Generator, morph_names: list[str], max_fno: int) -> Motion:
+    morphs: dict[str, MorphNameFrames] = {}
+    for morph_name in morph_names:
+        fnos = sorted(set(rng.integers(0, max_fno, size=rng.integers(1, 6)).tolist()) | {0})
+        ratios = rng.choice([0.0, 0.5, 0.8, 0.95, 1.0, float(rng.uniform(0, 1.2))], size=len(fnos))
+        morphs[morph_name] = MorphNameFrames(morph_name, dict(zip(fnos, ratios.tolist())))
+    return Motion(morphs)
+
+
+def create_morph_names(rng: np.random.Generator) -> list[str]:
+    morph_names = [f"m{midx}" for midx in range(int(rng.integers(1, 5)))]
+    if rng.random() < 0.2:
+        morph_names[0] = "まばたき"
+    return morph_names
+
+
+class RepairMorphTest(unittest.TestCase):
+    def test_solve_repair_step(self) -> None:
+        """補正回数をまとめて求めても、1回ずつ補正した場合と同じ変形量になること"""
+        rng = np.random.default_rng(0)
+        for _ in range(200):
+            morph_names = create_morph_names(rng)
+            motion = create_motion(rng, morph_names, 40)
+            checker = Checker(rng.uniform(0.1, 1.5, size=len(morph_names)), float(rng.uniform(0.2, 1.2)))
+            fno = int(rng.integers(0, 40))
+
+            step_motion = copy.deepcopy(motion)
+            step_usecase = RepairMorphUsecase()
+            with mock.patch.object(step_usecase, "solve_repair_step", return_value=1):
+                step_usecase.repair_frame(step_motion, checker, morph_names, fno, 0.0)
+
+            RepairMorphUsecase().repair_frame(motion, checker, morph_names, fno, 0.0)
+
+            self.assertEqual(step_motion.get_key_ratios(), motion.get_key_ratios())
+
+    def test_split_segments(self) -> None:
+        """区間毎に別々に補正しても、全キーフレを順番に補正した場合と同じ変形量になること"""
+        rng = np.random.default_rng(1)
+        for _ in range(60):
+            morph_names = create_morph_names(rng)
+            motion = create_motion(rng, morph_names, 60)
+            checker = Checker(rng.uniform(0.1, 1.5, size=len(morph_names)), float(rng.uniform(0.2, 1.2)))
+            fnos = sorted(set(rng.integers(0, 60, size=10).tolist()))
+
+            sequential_motion = copy.deepcopy(motion)
+            RepairMorphUsecase().repair_segment(sequential_motion, checker, morph_names, fnos, 0.0)
+
+            # 区間毎に元のモーションのコピーを補正し、後ろの区間から反映する
+            segment_motion = copy.deepcopy(motion)
+            for segment_fnos in reversed(RepairMorphUsecase().split_segments(motion, morph_names, fnos)):
+                repairs = RepairMorphUsecase().repair_segment(copy.deepcopy(motion), checker, morph_names, segment_fnos, 0.0)
+                for repair in repairs:
+                    segment_motion.morphs[repair.morph_name][repair.key_fno].ratio = repair.repaired_ratio
+
+            self.assertEqual(sequential_motion.get_key_ratios(), segment_motion.get_key_ratios())
+
+    def test_repair_segments_parallel(self) -> None:
+        """回転を含むボーンモーフを持つモーフが変形している区間だけ親プロセスで補正し、結果は順番に補正した場合と同じになること"""
+        rng = np.random.default_rng(2)
+        for _ in range(50):
+            morph_names = create_morph_names(rng)
+            motion = create_motion(rng, morph_names, 60)
+            weights = rng.uniform(0.1, 1.5, size=len(morph_names))
+            threshold = float(rng.uniform(0.2, 1.2))
+            nonlinear_morph_indexes = [len(morph_names) - 1] if rng.random() < 0.5 else []
+            fnos = sorted(set(rng.integers(0, 60, size=10).tolist()))
+            segments = RepairMorphUsecase().split_segments(motion, morph_names, fnos)
+
+            sequential_motion = copy.deepcopy(motion)
+            sequential_repairs = [
+                RepairMorphUsecase().repair_segment(
+                    sequential_motion, Checker(weights, threshold, nonlinear_morph_indexes), morph_names, segment_fnos, 0.0
+                )
+                for segment_fnos in segments
+            ]
+
+            parallel_motion = copy.deepcopy(motion)
+            parallel_repairs = self.repair_segments_parallel(
+                parallel_motion, Checker(weights, threshold, nonlinear_morph_indexes), morph_names, segments
+            )
+
+            self.assertEqual(
+                [[(r.fno, r.morph_name, r.key_fno, r.repaired_ratio) for r in repairs] for repairs in sequential_repairs],
+                [[(r.fno, r.morph_name, r.key_fno, r.repaired_ratio) for r in repairs] for repairs in parallel_repairs],
+            )
+
+    def repair_segments_parallel(self, motion: Motion, checker: Checker, morph_names: list[str], segments: list[list[int]]) -> list:
+        """別プロセスの代わりに、受け渡す内容だけで初期化した補正処理をその場で実行する"""
+
+        class Executor:
+            def __init__(self, max_workers: int, initializer: Any, initargs: tuple) -> None:
+                morph_motion, _, _, _, _ = initargs
+                # 別プロセスには破綻チェックを構成する配列だけを渡し、モーフ変形量ストア(モデル)は渡さない
+                process_checker = Checker(checker.weights, checker.threshold, checker.nonlinear_morph_indexes.tolist())
+                process_checker.offset_store = None
+                with mock.patch.object(repair_morph_usecase.MorphBreakageChecker, "from_arrays", return_value=process_checker):
+                    initializer(*initargs)
+                # 親プロセスのモーションとは別のデータを補正する
+                self.morph_motion = morph_motion
+
+            def __enter__(self) -> "Executor":
+                return self
+
+            def __exit__(self, *args: Any) -> None:
+                pass
+
+            def map(self, fn: Any, segments: list[list[int]]) -> list:
+                return [fn(segment_fnos) for segment_fnos in segments]
+
+        class VmdMotion(Motion):
+            def __init__(self) -> None:
+                super().__init__({morph_name: MorphNameFrames(morph_name, {}) for morph_name in morph_names})
+
+        with (
+            mock.patch.object(repair_morph_usecase, "ProcessPoolExecutor", Executor),
+            mock.patch.object(repair_morph_usecase, "SharedArrays"),
+            mock.patch.object(repair_morph_usecase, "attach_shared_arrays", return_value=({}, [])),
+            mock.patch.object(repair_morph_usecase, "VmdMotion", VmdMotion),
+        ):
+            return RepairMorphUsecase().repair_segments_parallel(motion, checker, morph_names, segments, 0.0, 2)  # type: ignore
+
+
+if __name__ == "__main__":
+    unittest.main()